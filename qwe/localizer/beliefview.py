@@ -0,0 +1,83 @@
+#!/usr/bin/python
+
+# Live view of a running localizer's particle cloud and guess, read from the shared
+# memory snapshot it publishes (see snapshot.py). Runs in its own process at its own
+# refresh rate and only ever reads, so it can't slow the filter down.
+
+from particleplot import *
+from robotplot import *
+from mapplot import *
+import map, snapshot
+
+from traits.api import String
+from chaco.api import OverlayPlotContainer
+from pyface.timer.api import Timer
+
+import argparse
+import logging
+import time
+from numpy import column_stack
+
+import sys
+sys.path.append('..')
+import mapping.map_class
+sys.modules['map_class'] = mapping.map_class  # deal with the fact we pickled a module in another dir
+import mapping.pickler
+
+class Cloud(object):
+  """ Snapshot particles in the shape ParticlePlotter wants """
+  def __init__(self, snap):
+    self.x = snap['x']
+    self.y = snap['y']
+    self.v = column_stack((cos(snap['theta']), sin(snap['theta'])))
+
+class BeliefView(HasTraits):
+  container = Instance(OverlayPlotContainer)
+  info = String('')
+
+  traits_view = View(Item('container', editor=ComponentEditor(), show_label=False),
+                     Item('info', show_label=False),
+                     resizable=True)
+
+  def __init__(self, snap, themap, rate, logger):
+    self.snap = snap
+    self.seq = None
+    first = snap.read() or { 'x': zeros(0), 'y': zeros(0), 'theta': zeros(0), 'guess': Pose(0, 0, 0) }
+
+    m = MapPlot(map = themap, logger = logger)
+    self.pplotter = ParticlePlotter(particles = Cloud(first), xsize = themap.x_inches, ysize = themap.y_inches)
+    self.guessplotter = RobotPlotter(robot = Robot(first['guess']), xsize = themap.x_inches, ysize = themap.y_inches,
+                                     color = 'green')
+    c = OverlayPlotContainer()
+    c.add(m.plot)
+    c.add(self.pplotter.qplot)
+    c.add(self.guessplotter.plot)
+    self.container = c
+    self.timer = Timer(1000.0 / rate, self.refresh)
+
+  def refresh(self):
+    snap = self.snap.read()
+    if snap is None or snap['seq'] == self.seq:
+      return
+    self.seq = snap['seq']
+    self.pplotter.particles = Cloud(snap)
+    self.pplotter.do_redraw()
+    self.pplotter.qplot.request_redraw()
+    self.guessplotter.robot.pose = snap['guess']
+    self.guessplotter.do_redraw()
+    sd = snap['cov'].diagonal() ** 0.5
+    self.info = "update %d: %d particles, guess %s, sd (%0.2f, %0.2f) in %0.3f rad, %0.2f s old" % (
+        snap['updates'], len(snap['x']), snap['guess'], sd[0], sd[1], sd[2], time.time() - snap['stamp'])
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Live view of the localizer particle snapshot')
+  parser.add_argument('snapshot', help='Snapshot file', nargs='?', default=snapshot.default_path())
+  parser.add_argument('-m', '--map', help='Pickled course map', default='../mapping/map.pkl')
+  parser.add_argument('-r', '--rate', help='Refreshes per second', type=float, default=5.0)
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.WARN)
+  logger = logging.getLogger(__name__)
+  themap = map.Map.from_map_class(mapping.pickler.unpickle_map(args.map), logger = logger)
+
+  BeliefView(snapshot.Snapshot(args.snapshot, readonly = True), themap, args.rate, logger).configure_traits()
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+
+# Cost and accuracy of the straight-beam vs K-ray cone ultrasonic models on the course map.
+# The simulated robot senses with a dense cone, every filter tracks it with its own model.
+
+import argparse
+import logging
+import sys
+import time
+
+from numpy import random, pi, hypot, sqrt, mean
+
+import particles, map, raytable, robot
+from sensors import Ultrasonic, Compass
+import std_sensors, std_noise
+from pose import Pose
+
+sys.path.append('..')
+import mapping.map_class
+sys.modules['map_class'] = mapping.map_class  # deal with the fact we pickled a module in another dir
+import mapping.pickler
+
+parser = argparse.ArgumentParser(description='Ultrasonic cone model benchmark')
+parser.add_argument('-n', '--num', help='Number of particles', type=int, default=1000)
+parser.add_argument('-u', '--updates', help='Updates per run', type=int, default=40)
+parser.add_argument('-k', '--rays', help='Cone ray counts to try (1 is the straight beam)', type=int, nargs='+', default=[1, 3, 5, 9])
+parser.add_argument('-w', '--width', help='Cone width (degrees)', type=float, default=30.0)
+parser.add_argument('--truth', help='Rays in the simulated robot\'s cone', type=int, default=15)
+parser.add_argument('--raycast', help='Raycast instead of using the ray table', action='store_true')
+parser.add_argument('-m', '--map', help='Pickled course map', default='../mapping/map.pkl')
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.WARN)
+logger = logging.getLogger(__name__)
+
+themap = map.Map.from_map_class(mapping.pickler.unpickle_map(args.map), logger = logger)
+if not args.raycast:
+  themap.raytable = raytable.RayTable(themap, logger = logger)
+start = Pose(20.0, 20.0, 0.0)
+
+def layout(rays):
+  """ std_sensors.offset_str with every ultrasonic modeled as a rays-ray cone """
+  sensors = {}
+  for name,s in std_sensors.offset_str.items():
+    if isinstance(s, Ultrasonic):
+      sensors[name] = Ultrasonic(name, s.rel_pose, s.noise, cone = rays > 1, failure = s.failure,
+                                 cone_width = args.width * pi / 180, cone_rays = rays)
+    else:
+      sensors[name] = s
+  return sensors
+
+def bench(rays):
+  random.seed(1)
+  simbot = robot.SimRobot(start, layout(args.truth), std_noise.noise_params)
+  loc = particles.ParticleLocalizer(layout(rays), std_noise.noise_params, themap, args.num, start, logger = logger)
+  sense_time = 0.0
+  err = []
+  for i in range(args.updates):
+    turn = random.random() * pi/4 - pi/8
+    simbot.move(turn, 0.5)
+    loc.move(turn, 0.5)
+    measured = simbot.sense(themap)
+    t = time.time()
+    loc.measure(measured)
+    sense_time += time.time() - t
+    loc.weigh()
+    loc.resample()
+    guess = loc.guess()
+    err.append(hypot(guess.x - simbot.x, guess.y - simbot.y))
+  return sense_time / args.updates, sqrt(mean([e*e for e in err]))
+
+print "%s, %d particles, %d updates, %0.0f degree cone, truth %d rays, %s" % (
+    themap, args.num, args.updates, args.width, args.truth, "raycast" if args.raycast else "ray table")
+for rays in args.rays:
+  cost, rmse = bench(rays)
+  print "  %s: %7.2f ms/update sensing, position RMSE %5.2f in" % (
+      "straight " if rays == 1 else "%2d rays  " % rays, cost * 1000, rmse)
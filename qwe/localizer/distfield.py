@@ -0,0 +1,107 @@
+from numpy import arange, where, minimum, maximum, sqrt, floor, memmap, uint16
+import hashlib
+import os
+
+from raytable import table_dir
+
+# Distance from every map cell to the nearest wall, for the likelihood-field sensor model.
+#
+# The grid is (ydim, xdim) uint16 in tenths of an inch, clamped at max_dist, and is
+# cached in a memory-mapped file named after a hash of the wall layer like the ray table.
+
+class DistanceField(object):
+
+  def __init__(self, map, max_dist = 12.0, logger = None):
+    self.map = map
+    self.max_dist = max_dist  # inches, anything further is as good as no wall at all
+    self.logger = logger
+    self.load()
+
+  def key(self):
+    """ Content hash of everything the field depends on """
+    h = hashlib.sha1()
+    h.update(self.map.data.astype(uint16).tostring())
+    h.update("%s %s %r %r" % (self.map.xdim, self.map.ydim, self.map.scale, self.max_dist))
+    return h.hexdigest()[:16]
+
+  @property
+  def max_cells(self):
+    return int(self.max_dist / self.map.scale) + 1
+
+  def load(self):
+    """ Map the field for the current map contents, building it first if nobody has yet """
+    self.path = os.path.join(table_dir, 'field_%s.u16' % self.key())
+    shape = (self.map.ydim, self.map.xdim)
+    if not os.path.exists(self.path):
+      self.logger.info("DistanceField: building %s field for %s" % (shape, self.map))
+      if not os.path.isdir(table_dir):
+        os.makedirs(table_dir)
+      tmp = "%s.%d.tmp" % (self.path, os.getpid())
+      field = memmap(tmp, dtype=uint16, mode='w+', shape=shape)
+      field[:] = self.encode(distances(self.map.walls, self.max_cells))
+      field.flush()
+      del field
+      os.rename(tmp, self.path)
+    else:
+      self.logger.debug("DistanceField: mapping existing field %s" % self.path)
+    self.field = memmap(self.path, dtype=uint16, mode='c', shape=shape)
+
+  def encode(self, cells):
+    """ Center to center distances (cells) to clamped wall surface distances in tenths of an inch """
+    inches = minimum(maximum(cells - 0.5, 0.0) * self.map.scale, self.max_dist)
+    return (inches * 10 + 0.5).astype(uint16)
+
+  def refresh(self, rects = None):
+    """
+    Bring the field back in line with the map after its walls changed
+
+    A wall change only moves distances within max_dist of it, so each changed
+    (x1, y1, x2, y2) rect (x2, y2 exclusive) is recomputed over a window that far
+    around it. Without rects the whole field is reloaded.
+    """
+    if rects is None:
+      self.load()
+      return
+    k = self.max_cells
+    ydim, xdim = self.map.ydim, self.map.xdim
+    walls = self.map.walls
+    for x1, y1, x2, y2 in rects:
+      # cells that can change, and every wall that can be nearest to one of them
+      ox1, oy1, ox2, oy2 = max(x1 - k, 0), max(y1 - k, 0), min(x2 + k, xdim), min(y2 + k, ydim)
+      ix1, iy1, ix2, iy2 = max(ox1 - k, 0), max(oy1 - k, 0), min(ox2 + k, xdim), min(oy2 + k, ydim)
+      cells = distances(walls[iy1:iy2, ix1:ix2], k)
+      self.field[oy1:oy2, ox1:ox2] = self.encode(cells[oy1-iy1:oy2-iy1, ox1-ix1:ox2-ix1])
+    self.logger.debug("DistanceField: recomputed around %d changed regions" % len(rects))
+
+  def lookup(self, x, y):
+    """ Distance (inches) to the nearest wall for arrays of points, max_dist off the map """
+    scale = self.map.scale
+    cx = floor(x / scale).astype(int)
+    cy = floor(y / scale).astype(int)
+    inside = (0 <= cx) & (cx < self.map.xdim) & (0 <= cy) & (cy < self.map.ydim)
+    dist = self.field[cy * inside, cx * inside] * 0.1
+    dist[~inside] = self.max_dist
+    return dist
+
+######################################################
+
+def distances(walls, max_cells):
+  """
+  Exact euclidean distance (cells, center to center) from each cell to the nearest
+  wall cell, clamped at max_cells
+
+  Separable: the nearest wall along each row first, then for every cell the best
+  combination of a row within max_cells above or below and that row's distance.
+  """
+  ydim, xdim = walls.shape
+  far = xdim + max_cells + 1
+  x = arange(xdim)
+  left = maximum.accumulate(where(walls, x, -far), axis=1)
+  right = minimum.accumulate(where(walls, x, 2*far)[:, ::-1], axis=1)[:, ::-1]
+  g = minimum(minimum(x - left, right - x), max_cells).astype(float)
+  g *= g
+  d = g.copy()
+  for dy in range(1, min(max_cells, ydim)):
+    minimum(d[dy:], g[:-dy] + dy*dy, out=d[dy:])
+    minimum(d[:-dy], g[dy:] + dy*dy, out=d[:-dy])
+  return minimum(sqrt(d), max_cells)
@@ -0,0 +1,46 @@
+from numpy import zeros, flatnonzero, random, pi
+
+# Flat index of the map cells a robot pose can be in, for sampling valid poses in bulk.
+#
+# A cell counts when it is not a wall and, with a footprint radius, when the map's
+# distance field puts it at least that far from the nearest wall.
+
+class FreeSpace(object):
+
+  def __init__(self, map, radius = 0.0, logger = None):
+    self.map = map
+    self.radius = radius  # inches
+    self.logger = logger
+    self.refresh()
+
+  def free(self, x1, y1, x2, y2):
+    """ Free cell mask over a window of the map """
+    free = ~self.map.walls[y1:y2, x1:x2]
+    if self.radius > 0.0 and self.map.distfield:
+      free &= self.map.distfield.field[y1:y2, x1:x2] >= self.radius * 10
+    return free
+
+  def refresh(self, rects = None):
+    """ Rebuild the index, recomputing the mask only around the changed (x1, y1, x2, y2) rects if given """
+    xdim, ydim = self.map.xdim, self.map.ydim
+    if rects is None:
+      self.mask = self.free(0, 0, xdim, ydim)
+    else:
+      # the footprint reaches this many cells past the rect
+      k = int(self.radius / self.map.scale) + 1
+      for x1, y1, x2, y2 in rects:
+        x1, y1, x2, y2 = max(x1 - k, 0), max(y1 - k, 0), min(x2 + k, xdim), min(y2 + k, ydim)
+        self.mask[y1:y2, x1:x2] = self.free(x1, y1, x2, y2)
+    self.index = flatnonzero(self.mask)
+    self.logger.debug("FreeSpace: %d of %d cells free" % (len(self.index), self.mask.size))
+
+  def sample(self, count, out = None):
+    """ Uniformly random (x, y, theta) rows for count poses in free space, written into out if given """
+    if out is None:
+      out = zeros((3, count))
+    cells = self.index[random.randint(0, len(self.index), count)]
+    xdim = self.map.xdim
+    out[0] = (cells % xdim + random.random_sample(count)) * self.map.scale
+    out[1] = (cells // xdim + random.random_sample(count)) * self.map.scale
+    out[2] = random.random_sample(count) * 2*pi
+    return out
@@ -0,0 +1,153 @@
+from numpy import arange, zeros, ones, exp, pi, cos, sin, floor, roll, unravel_index, newaxis
+
+from sensors import sense_all
+from pose import Pose
+
+# Coarse grid (histogram) localizer, for finding the robot with no idea where it is.
+#
+# The belief is a probability for every (theta, y, x) cell of a coarse grid over
+# the map. Motion shifts each heading layer by the move, with linear interpolation
+# for the fractional part, and then blurs it with separable gaussian kernels sized
+# to the motion noise. Sensing multiplies in the likelihood of the readings given
+# the expected readings from each cell center, which are computed once per map (from
+# the ray table when the map has one). Every update costs the same no matter what
+# the belief looks like, so it can run alongside the particle filter and be used to
+# reseed it when the particles are lost.
+
+class GridLocalizer(object):
+
+  def __init__(self, sensors, noise, map, cell = 3.0, angles = 36, uniform = 1e-4, logger = None):
+    # cell: grid size in inches, angles: heading bins
+    # uniform: share of probability spread evenly over the free cells on every update,
+    #   so the belief can always move to somewhere it had given up on
+    self.sensors = sensors
+    self.noise = noise
+    self.map = map
+    self.cell = cell
+    self.angles = angles
+    self.step = 2*pi / angles
+    self.uniform = uniform
+    self.logger = logger
+    self.nx = int(map.x_inches / cell)
+    self.ny = int(map.y_inches / cell)
+    self.theta = arange(angles) * self.step
+    self.refresh()
+    self.belief = self.free / self.free.sum()
+    map.watchers.append(self.map_changed)
+    logger.debug("GridLocalizer: %d x %d x %d grid, %0.1f in cells" % (self.nx, self.ny, angles, cell))
+
+  def refresh(self):
+    """ Free cells and expected sensor readings from every cell center, for the current map """
+    xs = (arange(self.nx) + 0.5) * self.cell
+    ys = (arange(self.ny) + 0.5) * self.cell
+    scale = self.map.scale
+    walls = self.map.walls[(ys / scale).astype(int)][:, (xs / scale).astype(int)]
+    self.free = ones((self.angles, self.ny, self.nx)) * ~walls
+
+    shape = self.free.shape
+    x = zeros(shape) + xs
+    y = zeros(shape) + ys[:, newaxis]
+    theta = zeros(shape) + self.theta[:, newaxis, newaxis]
+    self.x, self.y = x.ravel(), y.ravel()
+    self.poses = (self.x, self.y, theta.ravel())
+    beams = dict( (name, s) for name,s in self.sensors.items() if s.model != 'field' )
+    self.expected = sense_all(beams, self.x, self.y, theta.ravel(), self.map)
+
+  def map_changed(self, rects):
+    self.refresh()
+    self.belief *= self.free
+    self.normalize()
+
+  def move(self, turn, move):
+    """ Motion update """
+    b = self.belief
+    # turn, with the whole of the heading noise applied as a blur along theta
+    b[:] = interpolate(b, turn / self.step, 0, wrap = True)
+    b[:] = blur(b, self.noise['turn'] / self.step, 0, wrap = True)
+    # move every heading layer along its own heading
+    sigma = abs(move) * self.noise['move'] / self.cell
+    for a in range(self.angles):
+      layer = interpolate(b[a], move * cos(self.theta[a]) / self.cell, 1)
+      layer = interpolate(layer, move * sin(self.theta[a]) / self.cell, 0)
+      if sigma > 0.0:
+        layer = blur(blur(layer, sigma, 0), sigma, 1)
+      b[a] = layer
+    b *= self.free
+    self.normalize()
+
+  def update(self, measured):
+    """ Sensor update """
+    loglik = zeros(len(self.x))
+    for name,sensor in self.sensors.items():
+      if measured[name] < 0:
+        continue
+      if sensor.model == 'field':
+        dist = sensor.endpoint_distance(self.poses[0], self.poses[1], self.poses[2], measured[name], self.map)
+        loglik += sensor.field_log_likelihood(dist, measured[name], self.map)
+      else:
+        loglik += sensor.log_likelihood(self.expected[name], measured[name])
+    loglik -= loglik.max()
+    self.belief *= exp(loglik).reshape(self.belief.shape)
+    self.normalize()
+
+  def normalize(self):
+    b = self.belief
+    total = b.sum()
+    if total <= 0.0:
+      self.logger.warn("GridLocalizer: belief vanished, starting over from uniform")
+      b[:] = self.free
+      total = b.sum()
+    b /= total
+    b *= 1.0 - self.uniform
+    b += self.free * (self.uniform / self.free.sum())
+
+  def mode(self):
+    """ Center of the most likely cell """
+    a, y, x = unravel_index(self.belief.argmax(), self.belief.shape)
+    return Pose((x + 0.5) * self.cell, (y + 0.5) * self.cell, self.theta[a])
+
+  def confidence(self):
+    """ Probability mass within one cell (and heading bin) of the mode """
+    a, y, x = unravel_index(self.belief.argmax(), self.belief.shape)
+    near = self.belief[:, max(y-1, 0):y+2, max(x-1, 0):x+2]
+    return near[[(a + d) % self.angles for d in (-1, 0, 1)]].sum()
+
+######################################################
+
+def translate(a, n, axis):
+  """ a shifted n whole cells along axis, zero filled """
+  out = zeros(a.shape)
+  if abs(n) >= a.shape[axis]:
+    return out
+  src = [slice(None)] * a.ndim
+  dst = [slice(None)] * a.ndim
+  if n >= 0:
+    src[axis], dst[axis] = slice(0, a.shape[axis] - n), slice(n, None)
+  else:
+    src[axis], dst[axis] = slice(-n, None), slice(0, a.shape[axis] + n)
+  out[tuple(dst)] = a[tuple(src)]
+  return out
+
+def shifted(a, n, axis, wrap):
+  return roll(a, n, axis) if wrap else translate(a, n, axis)
+
+def interpolate(a, d, axis, wrap = False):
+  """ a shifted a fractional d cells along axis, linearly interpolated """
+  n = int(floor(d))
+  f = d - n
+  out = shifted(a, n, axis, wrap)
+  if f > 0.0:
+    out = out * (1.0 - f) + shifted(a, n + 1, axis, wrap) * f
+  return out
+
+def blur(a, sigma, axis, wrap = False):
+  """ Gaussian blur along axis, sigma in cells """
+  if sigma < 0.25:
+    return a
+  r = int(3 * sigma) or 1
+  k = exp(-(arange(-r, r + 1) ** 2) / (2.0 * sigma ** 2))
+  k /= k.sum()
+  out = a * k[r]
+  for i in range(1, r + 1):
+    out += (shifted(a, i, axis, wrap) + shifted(a, -i, axis, wrap)) * k[r + i]
+  return out
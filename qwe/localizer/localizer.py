@@ -1,9 +1,11 @@
 #!/usr/bin/python
 
-from numpy import random, pi, zeros
+from numpy import random, pi, zeros, cos, sin, hypot, arctan2
 
-import robot, particles, map, pose
+import robot, particles, sharded, histogram, map, pose, raytable, distfield, freespace, recorder, metrics, snapshot
 import time  # sleep
+from datetime import datetime
+from Queue import Empty
 
 import std_sensors, std_noise
 
@@ -15,50 +17,153 @@ import mapping.map_class
 sys.modules['map_class'] = mapping.map_class  # deal with the fact we pickled a module in another dir
 import mapping.pickler
 
+# particle filter settings: starting particle count, the range KLD-sampling may adapt it within,
+# the effective sample size (fraction of the count) below which particles get resampled,
+# how many worker processes to shard the particles over (0 runs everything in this process),
+# whether to run the coarse grid localizer alongside to reseed the particles once their
+# mean likelihood stays under lost_score for lost_updates updates in a row, the radius
+# (inches) the robot's center keeps from walls, for placing random particles, where
+# to record everything the localizer is sent (strftime pattern, None to not record),
+# the shared memory file other processes can read update timings from (see metrics.py),
+# the seconds a particle update may take before the pose is published, the rest of
+# it running while nav has nothing queued (None for no limit, ignored with workers),
+# and the shared memory file the particle cloud is copied to for live viewers, at most
+# snapshot_rate times a second (see snapshot.py, None to not publish it)
+config = { "pcount" : 500, "pmin" : 100, "pmax" : 5000, "ess_threshold" : 0.5, "workers" : 0,
+           "grid" : True, "lost_score" : 1e-6, "lost_updates" : 3, "footprint" : 4.0,
+           "record" : "logs/localizer-%Y%m%d-%H%M%S.rec", "metrics" : metrics.default_path(),
+           "budget" : None, "snapshot" : snapshot.default_path(), "snapshot_rate" : 10.0 }
+
 def run( bot_loc, zones, map_properties, course_map, waypoints, ipc_channel, bot_state, logger=None ):
 
   logger.debug("Localizer entry point: run()")
 
   start_pose = pose.Pose(bot_loc["x"],bot_loc["y"],bot_loc["theta"])
-  ideal = robot.SimRobot(start_pose, std_sensors.offset_str)
   logger.debug("Initial pose: %s" % start_pose)
 
   themap = map.Map.from_map_class(course_map, logger = logger)
-  last_zone_change = 0
+  themap.raytable = raytable.RayTable(themap, logger = logger)  # sensing becomes table lookups
+  themap.distfield = distfield.DistanceField(themap, logger = logger)  # for 'field' model sensors
+  themap.freespace = freespace.FreeSpace(themap, config["footprint"], logger = logger)
 
   if not ipc_channel:
     logging.debug("Using Fake_IPC queue")
     ipc_channel = Fake_IPC(start_pose, themap, delay = 1.0, logger = logger)
 
-  #localizer = DumbLocalizer(start_pose)
-  localizer = particles.ParticleLocalizer(std_sensors.offset_str, std_noise.noise_params, themap, 50, start_pose, logger = logger)
+  rec = None
+  if config["record"]:
+    rec = recorder.Recorder(datetime.now().strftime(config["record"]), logger = logger)
+  tracker = Tracker(themap, start_pose, logger, rec)
 
   while True:
-    msg = ipc_channel.get()
-    logger.debug("From qNav (raw): %s" % msg)
-    if type(msg) == str and msg == 'die':
+    # everything nav has sent since the last update is folded into this one
+    msgs = drain(ipc_channel, tracker.localizer.work)
+    logger.debug("From qNav (raw): %s" % msgs)
+    die = msgs[-1] == 'die'  # drain() stops at a die, so it can only be last
+    if die:
+      msgs.pop()
+
+    if msgs:  # whatever nav sent before dying still counts
+      tracker.sync_zones(zones, waypoints, bot_state)
+      tracker.step(msgs)
+      tracker.publish(bot_loc, bot_state)
+
+    if die:
       logger.debug("Received die signal, exiting...")
+      tracker.stop()
       exit(0)
-    
-    turn, move = msg['dTheta'], msg['dXY']
-    logger.debug("Turn: %+0.2f, Move: %0.2f" % (turn, move))
-
-    sensorData = msg['sensorData']
-    logger.debug( "SensorData: %s" % sensorData)
-    # pull out ultrasonic/heading data
-    sensors = {}
-    for key,val in sensorData['ultrasonic'].items():
-      sensors[key] = val
-    sensors['heading'] = sensorData['heading']
-    logger.debug( "Sensors-only dict: %s" % sensors)
 
-    # update map if zone status has changed
+def drain(ipc_channel, idle = None):
+  """
+  Wait for a message, then take whatever else is already queued behind it
+
+  While nothing has arrived, idle() is called to get on with background work for as
+  long as it returns that there is more.
+  """
+  msgs = []
+  while not msgs:
+    try:
+      msgs.append(ipc_channel.get_nowait())
+    except Empty:
+      if not (idle and idle()):
+        msgs.append(ipc_channel.get())
+  while msgs[-1] != 'die':
+    try:
+      msgs.append(ipc_channel.get_nowait())
+    except Empty:
+      break
+  return msgs
+
+def compose(msgs):
+  """
+  Net motion of a run of turn-then-move messages, as turn, move, turn
+
+  The first turn points along the net displacement, the second brings the heading
+  round to where all the turns add up to.
+  """
+  x = y = theta = 0.0
+  for msg in msgs:
+    theta += msg['dTheta']
+    x += msg['dXY'] * cos(theta)
+    y += msg['dXY'] * sin(theta)
+  move = hypot(x, y)
+  turn = arctan2(y, x) if move > 1e-9 else 0.0
+  return turn, move, theta - turn
+
+def read_sensors(msg):
+  """ Sensor dict for the localizer out of a nav message's sensorData """
+  sensorData = msg['sensorData']
+  # pull out ultrasonic/heading data
+  sensors = {}
+  for key,val in sensorData['ultrasonic'].items():
+    sensors[key] = val
+  sensors['heading'] = sensorData['heading']
+  return sensors
+
+class Tracker(object):
+  """ Localizer process state: the map, the filters, and one update step per batch of nav messages """
+
+  def __init__(self, themap, start_pose, logger, rec = None):
+    self.map = themap
+    self.logger = logger
+    self.rec = rec  # optional recorder.Recorder, gets the inputs and published poses
+    if rec:
+      rec.write(recorder.START, {'x': start_pose.x, 'y': start_pose.y, 'theta': start_pose.theta})
+    self.ideal = robot.SimRobot(start_pose, std_sensors.offset_str)
+    self.last_zone_change = 0
+    self.lag = 0.0
+    self.coalesced = 0
+
+    #localizer = DumbLocalizer(start_pose)
+    self.metrics = metrics.Metrics(path = config["metrics"])
+    settings = dict(logger = logger, pmin = config["pmin"], pmax = config["pmax"], ess_threshold = config["ess_threshold"],
+                    metrics = self.metrics)
+    if config["workers"]:
+      self.localizer = sharded.ShardedLocalizer(std_sensors.offset_str, std_noise.noise_params, themap, config["pcount"],
+                                                start_pose, workers = config["workers"], **settings)
+    else:
+      self.localizer = particles.ParticleLocalizer(std_sensors.offset_str, std_noise.noise_params, themap, config["pcount"],
+                                                   start_pose, budget = config["budget"], **settings)
+
+    self.grid = None
+    if config["grid"]:
+      self.grid = histogram.GridLocalizer(std_sensors.offset_str, std_noise.noise_params, themap, logger = logger)
+    self.lost = 0
+
+    self.snapshot = None
+    if config["snapshot"]:
+      self.snapshot = snapshot.Snapshot(config["snapshot"], self.localizer.pmax, config["snapshot_rate"])
+
+  def sync_zones(self, zones, waypoints, bot_state):
+    """ Update map if zone status has changed """
+    logger = self.logger
+    themap = self.map
     zone_change = bot_state['zone_change']
-    logger.debug("Checking for block zone change (last update: %d, now: %d)" % (last_zone_change, zone_change))
-    if zone_change > last_zone_change:  
+    logger.debug("Checking for block zone change (last update: %d, now: %d)" % (self.last_zone_change, zone_change))
+    if zone_change > self.last_zone_change:
       logger.debug("Map zones are behind, updating")
       logger.debug("Current zones dict: %s" % zones)
-      logger.debug("Wall count before update: %d" % len(themap.data[themap.data==1]))
+      logger.debug("Wall count before update: %d" % themap.data.sum())
       for zone, state in zones.items():
         if state == True:
           logger.debug("Wall-filling location: %s" % zone)
@@ -67,20 +172,73 @@ def run( bot_loc, zones, map_properties, course_map, waypoints, ipc_channel, bot
         else:
           themap.map_obj.fillLoc(waypoints, zone, {'desc':0})
       themap.update()
-      last_zone_change = zone_change
-      logger.debug("Wall count after update: %d" % len(themap.data[themap.data==1]))
+      self.last_zone_change = zone_change
+      if self.rec:
+        self.rec.write(recorder.ZONES, {'zones': dict(zones.items()), 'zone_change': zone_change})
+      logger.debug("Wall count after update: %d" % themap.data.sum())
 
-    ideal.move(turn, move)
+  def step(self, msgs):
+    """ One motion update for all of msgs combined, and one sensor update from the newest reading """
+    logger = self.logger
+    localizer = self.localizer
+    if self.rec:
+      self.rec.write(recorder.MSGS, msgs)
+    turn, move, final = compose(msgs)
+    logger.debug("Turn: %+0.2f, Move: %0.2f, Turn: %+0.2f (from %d messages)" % (turn, move, final, len(msgs)))
+    sensors = read_sensors(msgs[-1])
+    logger.debug( "Sensors-only dict: %s" % sensors)
+
+    for msg in msgs:
+      self.ideal.move(msg['dTheta'], msg['dXY'])
     localizer.move(turn, move)
-    logger.debug( "Ideal pose: %s" % ideal.pose)
+    if final:
+      localizer.move(final, 0.0)
+    logger.debug( "Ideal pose: %s" % self.ideal.pose)
     localizer.update(sensors)
-    guess = localizer.guess()
-    logger.debug("Guess pose: %s" %  guess)
 
-    bot_loc['x'] = guess.x
-    bot_loc['y'] = guess.y
-    bot_loc['theta'] = guess.theta
+    grid = self.grid
+    if grid:
+      grid.move(turn, move)
+      if final:
+        grid.move(final, 0.0)
+      grid.update(sensors)
+      self.lost = self.lost + 1 if localizer.score() < config["lost_score"] else 0
+      if self.lost >= config["lost_updates"] and grid.confidence() > 0.5:
+        logger.warn("Particle filter lost for %d updates, reseeding around grid mode %s" % (self.lost, grid.mode()))
+        localizer.reseed(grid.mode(), grid.cell, grid.step)
+        self.lost = 0
+
+    # how far behind real time the oldest reading we just used was
+    stamp = msgs[0].get('timestamp')
+    self.lag = (datetime.now() - stamp).total_seconds() if stamp else 0.0
+    self.coalesced = len(msgs)
+
+  def publish(self, bot_loc, bot_state):
+    guess = self.localizer.guess()
+    self.logger.debug("Guess pose: %s" %  guess)
+
+    bot_loc['x'] = float(guess.x)
+    bot_loc['y'] = float(guess.y)
+    bot_loc['theta'] = float(guess.theta)
+    bot_loc['lag'] = self.lag  # seconds
     bot_loc['dirty'] = False
+    if self.rec:
+      self.rec.write(recorder.POSE, {'x': bot_loc['x'], 'y': bot_loc['y'], 'theta': bot_loc['theta']})
+
+    stats = self.localizer.stats()
+    stats['coalesced'] = self.coalesced
+    bot_state['loc_stats'] = stats
+    self.logger.debug("Localizer stats: %s" % stats)
+    if self.snapshot:
+      self.snapshot.publish(self.localizer, guess)
+
+  def stop(self):
+    if self.snapshot:
+      self.snapshot.publish(self.localizer, self.localizer.guess(), force = True)  # the rate limit may have held back the last
+    if config["workers"]:
+      self.localizer.stop()
+    if self.rec:
+      self.rec.close()
 
 #################################
 class Fake_IPC(object):
@@ -119,10 +277,13 @@ class Fake_IPC(object):
     sensorDict['ultrasonic'] = self.simbot.sense(self.map)
 
     # %todo: x, y, theta -> dx, dy, dtheta
-    msg = {'dTheta': turn, 'dXY': move, 'sensorData': sensorDict, 'timestamp': None}
+    msg = {'dTheta': turn, 'dXY': move, 'sensorData': sensorDict, 'timestamp': datetime.now()}
     time.sleep(self.delay)
     return msg
 
+  def get_nowait(self):
+    raise Empty  # never anything queued up, get() makes messages on demand
+
 #################################
 
 class DumbLocalizer(object):
@@ -1,20 +1,34 @@
 #!/usr/bin/python
 
-from numpy import array, zeros
-import csv
+from numpy import zeros, uint8, loadtxt, load, save, flipud, nonzero, column_stack, ascontiguousarray
 
-# loads map into 2d list:
+# loads map into a 2d uint8 array of 0s and 1s (1 is wall):
 #   [y][x] are map coordinates
 #   [0][0] is bottom left corner
+# .map files are CSV with the top row first, .npy files are what save() wrote
+
+# map_class desc value -> wall layer value
+desc_to_walls = zeros(10, dtype=uint8)
+desc_to_walls[8] = 1
+
 class Map():
   def __init__(self, filename = None, scale = 1, logger = None):
     self.logger = logger
+    self.data = None      # set through set_data(), which keeps the extents below in step
+    self.walls = None     # bool view of data
+    self.xdim = self.ydim = 0
+    self.x_inches = self.y_inches = 0.0
+    self.scale = scale    # inches per element
+    self.raytable = None  # optional raytable.RayTable, kept in step with data by update()
+    self.distfield = None  # optional distfield.DistanceField, likewise
+    self.freespace = None  # optional freespace.FreeSpace, likewise
+    self.axis_walls = None  # raycast.axis_index() cache
+    self.watchers = []    # called as watcher(rects) after every update(), rects None for a full rebuild
     if filename:
-      data = list( csv.reader(open(filename, 'r')))
-      data = [ [int(x) for x in y] for y in data  ]  # convert string to ints
-      data.reverse()
-      self.data = array(data)
-      self.scale = scale  # inches per element
+      if filename.endswith('.npy'):
+        self.set_data(load(filename))
+      else:
+        self.set_data(flipud(loadtxt(filename, delimiter=',', dtype=uint8, ndmin=2)))
       self.map_obj = None
       self.logger.debug("Map initialized from file: %s" % filename)
       self.logger.debug("Map dimensions %s" % self)
@@ -22,12 +36,20 @@ class Map():
   def xy(self):
     """ Converts from matrix of 0s and 1s to an array of xy pairs.
         New coordinates are offset by 0.5 to represent center of wall (for plotting) """
-    xy = []
-    for y in range(len(self.data)):
-      for x in range(len(self.data[0])):
-        if self.data[y][x] == 1:
-          xy.append([x+0.5,y+0.5])
-    return array(xy)
+    y, x = nonzero(self.walls)
+    return column_stack((x + 0.5, y + 0.5))
+
+  def set_data(self, data):
+    """ Replace the wall grid, as a contiguous uint8 array of 0s and 1s """
+    self.data = ascontiguousarray(data == 1, dtype=uint8)
+    self.walls = self.data.view(bool)
+    self.ydim, self.xdim = self.data.shape
+    self.x_inches = self.xdim * self.scale
+    self.y_inches = self.ydim * self.scale
+
+  def save(self, filename):
+    """ Write the wall grid as .npy, which Map() loads much faster than CSV """
+    save(filename, self.data)
 
   @classmethod
   def from_map_class(self, map_obj, logger = None):
@@ -41,28 +63,46 @@ class Map():
     return m
 
   def update(self):
-    self.logger.debug("Repopulating map data from class")
-    desc_to_walls = zeros(10,dtype=int)
-    desc_to_walls[8] = 1
-    self.data = array([desc_to_walls[i] for i in self.map_obj.grid[:][:]['desc']])
+    rects = self.map_obj.takeDirty()
     self.scale = 1.0 / self.map_obj.scale
+    if self.data is None or self.data.shape != self.map_obj.grid.shape:
+      self.logger.debug("Repopulating map data from class")
+      self.set_data(desc_to_walls[self.map_obj.grid['desc']])
+      rects = None
+    elif not rects:
+      # the grid was changed without going through fillCoords (or update() was
+      # called for nothing), so diff all of it and refresh around what moved
+      walls = desc_to_walls[self.map_obj.grid['desc']]
+      y, x = nonzero(walls != self.data)
+      rects = []
+      if len(x):
+        rects = [(int(x.min()), int(y.min()), int(x.max()) + 1, int(y.max()) + 1)]
+        self.data[...] = walls
+      self.logger.debug("Map walls changed outside dirty areas: %s" % rects)
+    else:
+      # only walk the areas fillCoords touched since the last update
+      changed = []
+      for x1,y1,x2,y2 in rects:
+        walls = desc_to_walls[self.map_obj.grid['desc'][y1:y2, x1:x2]]
+        if (walls != self.data[y1:y2, x1:x2]).any():
+          self.data[y1:y2, x1:x2] = walls
+          changed.append((x1,y1,x2,y2))
+      self.logger.debug("Map walls changed in %d of %d dirty areas: %s" % (len(changed), len(rects), changed))
+      rects = changed
     self.logger.debug("Map dimensions %s" % self)
+    self.refresh(rects)
+    for watcher in self.watchers:
+      watcher(rects)
 
-  @property
-  def xdim(self):
-    return len(self.data[0])
-
-  @property
-  def ydim(self):
-    return len(self.data)
-
-  @property
-  def x_inches(self):
-    return len(self.data[0]) * self.scale
-
-  @property
-  def y_inches(self):
-    return len(self.data) * self.scale
+  def refresh(self, rects = None):
+    """ Bring the lookup tables built from data up to date, after rects (or everything) changed """
+    self.axis_walls = None
+    if self.raytable:
+      self.raytable.refresh(rects)
+    if self.distfield:
+      self.distfield.refresh(rects)
+    if self.freespace:
+      self.freespace.refresh(rects)  # after distfield, it erodes with it
 
   def __str__(self):
     return "Map: (%d, %d) = (%0.2f, %0.2f) inches" % (self.xdim, self.ydim, self.xdim * self.scale, self.ydim * self.scale)
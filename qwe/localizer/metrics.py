@@ -0,0 +1,143 @@
+#!/usr/bin/python
+
+from numpy import zeros, memmap, float64, percentile, isnan, nan
+import ctypes
+import os
+import sys
+import time
+
+# Fixed-size ring buffers of per-update localizer timings and figures.
+#
+# One float64 array holds a header row and a ring of `size` slots per field. When
+# it's backed by a file (in /dev/shm where there is one) any other process can
+# memory map the same file and read the latest figures with no pickling or IPC
+# round trip; reads are unsynchronized, so a reader can see the update being
+# written half done, which is fine for monitoring.
+
+FIELDS = ('move', 'sense', 'weight', 'resample', 'guess', 'pcount', 'ess', 'score')
+TIMINGS = FIELDS[:5]  # seconds
+
+def default_path():
+  shm = '/dev/shm'
+  return os.path.join(shm if os.path.isdir(shm) else '/tmp', 'qwe-localizer.metrics')
+
+######################################################
+# monotonic clock, time.time() can jump when the board syncs its clock
+
+class _timespec(ctypes.Structure):
+  _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _clock_gettime():
+  if hasattr(time, 'monotonic'):
+    return time.monotonic
+  for lib in ('librt.so.1', 'libc.so.6'):
+    try:
+      gettime = ctypes.CDLL(lib, use_errno=True).clock_gettime
+    except (OSError, AttributeError):
+      continue
+    ts = _timespec()
+    def monotonic():
+      if gettime(1, ctypes.byref(ts)) != 0:  # CLOCK_MONOTONIC
+        return time.time()
+      return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+  return time.time
+
+monotonic = _clock_gettime()
+
+######################################################
+
+class Metrics(object):
+  """
+  Rings of the last size values of each of FIELDS
+
+  Values for the update in progress go into the open slot, commit() publishes
+  it and opens the next. The header row holds the number of committed updates.
+  """
+
+  def __init__(self, size = 256, path = None, readonly = False):
+    self.path = path
+    rows = len(FIELDS) + 1
+    if readonly:
+      self.data = memmap(path, dtype=float64, mode='r')
+      self.data = self.data.reshape(rows, len(self.data) // rows)
+    elif path:
+      # grow the file in place rather than recreating it (like Snapshot): a reader that
+      # still has it mapped would fault on pages past the end of a file cut to zero
+      fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+      try:
+        have = os.fstat(fd).st_size // (rows * 8)
+        if have < size:
+          os.ftruncate(fd, rows * size * 8)
+        else:
+          size = have  # never shrink it under a reader either, keep the ring it has
+      finally:
+        os.close(fd)
+      self.data = memmap(path, dtype=float64, mode='r+', shape=(rows, size))
+    else:
+      self.data = zeros((rows, size))
+    self.size = self.data.shape[1]
+    self.rings = dict( (f, self.data[i + 1]) for i,f in enumerate(FIELDS) )
+    self.last = monotonic()
+    if not readonly:
+      self.data[0] = 0
+      self.data[1:] = nan
+
+  @property
+  def count(self):
+    return int(self.data[0, 0])
+
+  def set(self, field, value, committed = False):
+    """ Store a value for the open update, or the last committed one """
+    slot = (self.count - committed) % self.size
+    self.rings[field][slot] = value
+
+  def mark(self):
+    self.last = monotonic()
+
+  def lap(self, field, committed = False):
+    """ Store the time since the last mark/lap as field, and start timing again """
+    now = monotonic()
+    self.set(field, now - self.last, committed)
+    self.last = now
+
+  def commit(self):
+    count = self.count
+    self.data[0, 0] = count + 1
+    # clear the slot being reused, so fields nobody sets this time aren't stale
+    self.data[1:, (count + 1) % self.size] = nan
+
+  def recent(self, field):
+    """ Committed values of field, oldest first """
+    count = min(self.count, self.size)
+    ring = self.rings[field]
+    end = self.count % self.size
+    values = ring[:end] if count < self.size else ring[end:].tolist() + ring[:end].tolist()
+    return [v for v in values if not isnan(v)]
+
+  def summary(self):
+    """ Latest value, mean and 50/90/99th percentiles of every field, timings in ms """
+    out = { 'updates': self.count }
+    for field in FIELDS:
+      values = self.recent(field)
+      if not values:
+        continue
+      k = 1000.0 if field in TIMINGS else 1.0
+      p50, p90, p99 = percentile(values, [50, 90, 99])
+      out[field] = { 'last': values[-1] * k, 'mean': sum(values) / len(values) * k,
+                     'p50': p50 * k, 'p90': p90 * k, 'p99': p99 * k }
+    return out
+
+def main():
+  path = sys.argv[1] if len(sys.argv) > 1 else default_path()
+  summary = Metrics(path = path, readonly = True).summary()
+  print "%s: %d updates" % (path, summary.pop('updates'))
+  for field in FIELDS:
+    if field in summary:
+      s = summary[field]
+      unit = 'ms' if field in TIMINGS else ''
+      print "  %-8s last %9.3f  mean %9.3f  p50 %9.3f  p90 %9.3f  p99 %9.3f %s" % (
+          field, s['last'], s['mean'], s['p50'], s['p90'], s['p99'], unit)
+
+if __name__ == '__main__':
+  main()
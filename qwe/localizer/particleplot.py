@@ -1,6 +1,6 @@
 # Enthought library imports
 from enable.api import Component, ComponentEditor
-from traits.api import HasTraits, Instance, Property, Int, Float, Array, Range, cached_property
+from traits.api import HasTraits, Instance, Property, Int, Float, Array, Range, Any, cached_property
 from traitsui.api import Item, View, Group
 
 # Chaco imports
@@ -20,7 +20,7 @@ class ParticlePlotter(HasTraits):
     xsize = Float
     ysize = Float
 
-    particles = Instance(Particles)
+    particles = Any  # Particles, or anything else with x, y and v (Nx2 heading vectors) arrays
    
     xs = ArrayDataSource()
     ys = ArrayDataSource()
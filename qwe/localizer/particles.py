@@ -1,13 +1,17 @@
 #!/usr/bin/python
 
 # Major library imports
-from numpy import array, sort, pi, cos, sin, zeros, arctan2
+from numpy import array, sort, pi, cos, sin, zeros, arange, arctan2, exp, log, inf, unique
+from numpy import in1d, concatenate
+from numpy import float32, frombuffer
 from numpy import random  # for random.random, random.normal (gaussian)
+import copy
 
 # for sense 
-from raycast import wall
+from sensors import sense_all
 from numpy.linalg import norm
-from probability import gaussian, ngaussian
+from probability import gaussian, ngaussian, logsumexp, kld_bound
+from metrics import Metrics, monotonic
 
 from robot import *
 from pose import *
@@ -18,28 +22,104 @@ class ParticleLocalizer(object):
   #
   # public: move(), update(), score()
   #
-  def __init__(self, sensor_list, noise_params, map, pcount, start_pose = None, logger = None):
+  def __init__(self, sensor_list, noise_params, map, pcount, start_pose = None, logger = None,
+               pmin = None, pmax = None, kld_err = 0.05, kld_z = 2.33, kld_bins = (2.0, 2.0, pi/18),
+               kld_chunk = 100, ess_threshold = None, metrics = None, budget = None, chunk = 250):
+    # pmin/pmax turn on KLD-sampling: every resample picks the particle count, between
+    # pmin and pmax, needed to keep the KL divergence from the true posterior under
+    # kld_err with (upper normal quantile) kld_z confidence, judged from how many
+    # kld_bins sized (x, y, theta) histogram bins the new samples occupy. Samples are
+    # drawn kld_chunk at a time until there are enough.
+    self.pmin = pmin or pcount
+    self.pmax = max(pmax or pcount, pcount)
+    self.adaptive = self.pmin < self.pmax
+    self.kld_err = kld_err
+    self.kld_z = kld_z
+    self.kld_bins = array(kld_bins).reshape(3, 1)
+    self.kld_chunk = kld_chunk
+    # ess_threshold: only resample once the effective sample size drops below this
+    # fraction of the particle count, weights carry over between updates until then.
+    # None resamples on every update.
+    self.ess_threshold = ess_threshold
+    # metrics: metrics.Metrics to record per-update timings and figures in, e.g. one
+    # backed by shared memory for other processes to read
+    self.metrics = metrics or Metrics()
+    # budget: seconds update() may spend sensing before it returns. Particles are then
+    # shuffled and sensed chunk at a time until the budget is spent, guess() meanwhile
+    # goes by the chunks weighed so far, and work() senses the rest while there is time.
+    # Whatever is still unsensed by the next move()/update() is settled without being
+    # sensed, so no update holds up the next one. None senses everything in one go.
+    self.budget = budget
+    self.chunk = chunk
+    self.partial = None  # [measurement, particles sensed, seconds sensing] of an unfinished update
 
-    self.p = Particles(sensor_list, noise_params, map, pcount, start_pose, logger = logger)
-    self.pcount = pcount
-    self.weight = zeros(pcount)    # probability measurement, "weight"
-    self.raw_error = zeros(pcount)
+    self.p = Particles(sensor_list, noise_params, map, pcount, start_pose, logger = logger, capacity = self.pmax,
+                       buffer = self.alloc(state_size(self.pmax)))
+    self._log_lik = self.array(self.pmax)
+    self._raw_error = self.array(self.pmax)
+    self.bind(pcount)
+    self.log_norm = 0.0            # log of the sum of the last update's likelihoods
     self.logger = logger
-    logger.debug("ParticleLocalizer (N=%d) initialized, Start pose: %s" % (pcount, start_pose))
 
-    self.score_hist = []
+    # degeneracy telemetry, see stats()
+    self.ess = float(pcount)
+    self.entropy = log(pcount)
+    self.resample_rate = 1.0  # moving average of resamples per update
+    self.updates = 0
+    self.resamples = 0
+    self.cut_short = 0  # budgeted updates settled before every particle was sensed
+
+    # preallocated scratch space so resampling doesn't allocate every update
+    self._cdf = zeros(self.pmax)
+    self._pointers = zeros(self.pmax)
+    self._ramp = arange(self.pmax, dtype=float)
+    self._picks = zeros(self.pmax, dtype=int)
+    self._extent = array([[map.x_inches], [map.y_inches], [2*pi]])
+    logger.debug("ParticleLocalizer (N=%d, range %d-%d) initialized, Start pose: %s" % (pcount, self.pmin, self.pmax, start_pose))
     
+  # storage hooks, overridden to put the per-particle arrays somewhere other processes can see
+  def alloc(self, nbytes):
+    return None  # let Particles allocate its own state block
+
+  def array(self, n):
+    return zeros(n)
+
+  def bind(self, pcount):
+    """ Set the active particle count, all per-particle arrays become views of the first pcount slots """
+    self.pcount = pcount
+    self.p.resize(pcount)
+    self.weight = self.p.w            # probability measurement, "weight", normalized to sum to 1
+    self.log_weight = self.p.logw     # log of weight, carried across updates
+    self.log_lik = self._log_lik[:pcount]        # log-likelihood of the last measurement alone
+    self.raw_error = self._raw_error[:pcount]
+
   def move(self, turn, move):
     # this seems silly
+    self.settle()
+    self.metrics.mark()
     self.p.move(turn, move)
+    self.metrics.lap('move')
 
   # Sense, weigh, and resample
   def update(self, measured):
 
     self.logger.debug("ParticleLocalizer: update using: %s" % measured)
+    self.settle()
+    if self.budget is not None:
+      self.start(measured)
+      return
+    metrics = self.metrics
+    metrics.mark()
     old = self.score()
-    self.p.particle_sense()
-    self.calc_weights(measured)
+    self.measure(measured)
+    metrics.lap('sense')
+    self.finish()
+
+  def finish(self):
+    """ Weigh and maybe resample with the likelihoods in log_lik, and record the update """
+    metrics = self.metrics
+    self.weigh()
+    metrics.lap('weight')
     new = self.score()
     #if new > old:
     #  print "Improved!!"
@@ -48,89 +128,265 @@ class ParticleLocalizer(object):
     #  self.resample(10.0)
     #  print "Worse"
 
-    self.resample(0.0)
-    self.logger.debug("ParticleLocalizer: update copmlete")
+    self.updates += 1
+    ess = self.ess
+    resample = self.maybe_resample()
+    metrics.lap('resample')
+    metrics.set('pcount', self.pcount)
+    metrics.set('ess', ess)
+    metrics.set('score', new)
+    metrics.commit()
+    self.logger.debug("ParticleLocalizer: update copmlete (ESS %0.1f, resampled: %s)" % (self.ess, resample))
+
+  def start(self, measured):
+    """ Budgeted update: sense random chunks of particles until the budget runs out """
+    t = monotonic()
+    deadline = t + self.budget
+    self.p.permute(random.permutation(self.pcount))  # so any prefix is a fair sample
+    self.bind(self.pcount)
+    self.partial = [measured, 0, 0.0]
+    # always at least one chunk, then only as many as look like they'll fit
+    while self.work():
+      now = monotonic()
+      if now + (now - t) > deadline:
+        break
+      t = now
+    if self.partial:
+      self.estimate()
+
+  def work(self):
+    """ Sense the next chunk of an unfinished update, settling it after the last; returns whether any is left """
+    if not self.partial:
+      return False
+    t = monotonic()
+    measured, lo, sensing = self.partial
+    hi = min(lo + self.chunk, self.pcount)
+    part = self.p.shard(lo, hi)
+    part.particle_sense()
+    self.likelihood(part, measured, self.log_lik[lo:hi], self.raw_error[lo:hi])
+    self.partial = [measured, hi, sensing + monotonic() - t]
+    if hi < self.pcount:
+      return True
+    self.settle()
+    return False
+
+  def estimate(self):
+    """ Interim weights and score from just the particles sensed so far, for guess() and score() """
+    done = self.partial[1]
+    loglik = self.log_lik[:done]
+    logw = self.log_weight[:done] + loglik
+    total = logsumexp(logw)
+    if total == -inf:
+      return  # nothing sensed so far fits, keep the last update's estimate
+    self.log_norm = logsumexp(loglik) - log(done) + log(self.pcount)
+    self.weight[:] = 0.0
+    exp(logw - total, out=self.weight[:done])
+
+  def settle(self):
+    """ Finish an unfinished update now, particles not sensed yet get the mean likelihood of those that were """
+    if not self.partial:
+      return
+    measured, done, sensing = self.partial
+    self.partial = None
+    if done < self.pcount:
+      self.log_lik[done:] = logsumexp(self.log_lik[:done]) - log(done)
+      self.raw_error[done:] = self.raw_error[:done].mean()
+      self.cut_short += 1
+      self.logger.debug("ParticleLocalizer: settled with %d of %d particles sensed" % (done, self.pcount))
+    self.metrics.set('sense', sensing)
+    self.metrics.mark()
+    self.finish()
+
+  def maybe_resample(self):
+    """ Resample if the weights have degenerated past ess_threshold, returns whether it did """
+    resample = self.ess_threshold is None or self.ess < self.ess_threshold * self.pcount
+    if resample:
+      self.resample(0.0)
+      self.resamples += 1
+    self.resample_rate += 0.1 * (resample - self.resample_rate)
+    return resample
+
+  def stats(self):
+    """ Particle count and weight degeneracy figures, for monitoring """
+    return { 'pcount': self.pcount, 'ess': self.ess, 'ess_ratio': self.ess / self.pcount,
+             'entropy': self.entropy, 'resample_rate': self.resample_rate,
+             'updates': self.updates, 'resamples': self.resamples, 'cut_short': self.cut_short }
 
   # Sense and Resample
   def score(self):
-    total = self.weight.sum()
-    mean = self.weight.mean()
-    best = self.weight.max()
-    std = self.weight.std()
+    # mean unnormalized likelihood, from the log-sum-exp of the last calc_weights
+    mean = exp(self.log_norm) / self.pcount
     raw = self.raw_error.mean()
-    self.score_hist.append(mean)
     #print "Scores: mean: %0.4f, best: %0.4f, std %0.4f, raw: %0.2f" % (mean, best, std, raw)
     return mean
 
   def calc_weights(self, measured):
-    #print "Particles: updating weights:"
-    # create an array of particle weights to use as resampling probability
-    prob = self.weight
-    raw = self.raw_error
-    for i in range(self.pcount):
-      # what if we init to 1.0 once, then refine this probability continuously?
-      prob[i] = 1.0
-      raw[i] = 0
-      #print self.p.x[i], self.p.y[i]
-      # TODO test particle on wall
-      if not ((0 <= self.p.x[i] <= self.p.map.x_inches) and (0 <= self.p.y[i] <= self.p.map.y_inches)):
-        self.logger.warn("Bad ploc: (%0.2f, %0.2f)! Setting weight to 0.0" % (self.p.x[i], self.p.y[i]))
-        prob[i] = 0.0
-      for name,sensor in self.p.sensors.items():
-        # only weight valid sensor data
-        if measured[name] >= 0:
-          # compare measured input of sensor versus the particle's value, adjusting prob accordingly
-          #         perhaps this should actually just lookup the measurement difference in
-          #         a precomputed PDF for the sensor (gaussian around zero diff and a bump at max)
-          prob[i] *= ngaussian(self.p.sensed[name][i], sensor.gauss_var, measured[name])
-          raw[i] += abs(self.p.sensed[name][i] - measured[name])
-          #print "sensor: %s, sense: %0.2f, meas %0.2f, prob: %0.4f" % (name, self.p.sensed[name][i], measured[name], prob[i])
-        else:
-          pass
-          #print "sensor: %s, bad reading, skipping" % name
-      #print "  %d : raw_err: %0.2f,  prob: %0.2f" % (i, raw[i], prob[i])
-      #print
-
-  def random_particles(self, count):
-    x = random.random(count) * self.p.map.x_inches
-    y = random.random(count) * self.p.map.y_inches
-    theta = random.random(count)*2*pi
-    return zip( zeros(len(x)), x, y, theta, zeros(len(x)) )
+    self.likelihood(self.p, measured, self.log_lik, self.raw_error)
+    self.weigh()
+
+  def measure(self, measured):
+    """ Sense from every particle and fill log_lik and raw_error for the measurement """
+    self.p.particle_sense()
+    self.likelihood(self.p, measured, self.log_lik, self.raw_error)
+
+  def likelihood(self, particles, measured, loglik, raw):
+    # per-particle log-likelihood of the measurements, summed over every valid sensor
+    loglik[:] = 0.0
+    raw[:] = 0.0
+    for name,sensor in particles.sensors.items():
+      # only weight valid sensor data
+      if measured[name] < 0:
+        continue
+      if sensor.model == 'field':
+        dist = sensor.endpoint_distance(particles.x, particles.y, particles.theta, measured[name], particles.map,
+                                        particles.cos, particles.sin)
+        loglik += sensor.field_log_likelihood(dist, measured[name], particles.map)
+        raw += dist
+      else:
+        sensed = particles.sensed[name]
+        loglik += sensor.log_likelihood(sensed, measured[name])
+        raw += abs(sensed - measured[name])
+
+    x = particles.x
+    y = particles.y
+    off_map = ~((0 <= x) & (x <= particles.map.x_inches) & (0 <= y) & (y <= particles.map.y_inches))
+    if off_map.any():
+      self.logger.warn("%d particles off the map! Setting weight to 0.0" % off_map.sum())
+      loglik[off_map] = -inf
+
+  def weigh(self):
+    # fold the last likelihoods into the carried log weights, normalized with an underflow-safe log-sum-exp
+    loglik = self.log_lik
+    self.log_norm = logsumexp(loglik)
+
+    logw = self.log_weight
+    logw += loglik
+    total = logsumexp(logw)
+    if total == -inf:
+      # nothing fits, start the next update from uniform weights again
+      logw.fill(-log(self.pcount))
+      self.weight[:] = 0.0
+      self.ess = self.entropy = 0.0
+      return
+    logw -= total
+    exp(logw, out=self.weight)
+
+    w = self.weight
+    self.ess = 1.0 / float((w * w).sum())
+    self.entropy = -float((w[w > 0] * logw[w > 0]).sum())
+
+  def reseed(self, pose, xy_sigma, theta_sigma):
+    """ Start the particle cloud over around pose, e.g. the grid localizer's mode once the filter is lost """
+    self.settle()
+    p = self.p
+    n = self.pcount
+    p.x[:] = random.randn(n) * xy_sigma + pose.x
+    p.y[:] = random.randn(n) * xy_sigma + pose.y
+    p.theta[:] = random.randn(n) * theta_sigma + pose.theta
+    p.x.clip(0, p.map.x_inches, out=p.x)
+    p.y.clip(0, p.map.y_inches, out=p.y)
+    p.theta %= 2*pi
+    heading(p.state)
+    self.weight.fill(1.0 / n)
+    self.log_weight.fill(-log(n))
+    self.logger.info("ParticleLocalizer: reseeded %d particles around %s" % (n, pose))
+
+  def random_particles(self, count, out = None):
+    """ Uniformly random (x, y, theta) rows for count particles, written into out if given """
+    if self.p.map.freespace:
+      return self.p.map.freespace.sample(count, out)  # only where the robot can actually be
+    if out is None:
+      out = zeros((3, count))
+    out[:] = random.random_sample(out.shape)
+    out *= self._extent
+    return out
 
   def resample(self, rand_percent = 0.0):
-    x = self.p.x
-    y = self.p.y
-    theta = self.p.theta
     weight = self.weight
     if weight.sum() == 0.0:
       self.logger.warn("Zero particle weights, skipping resample!")
       print "Zero particle weights, skipping resample!"
       return
-    # resample (x, y, theta) using wheel resampler
-    rand_count = int(self.pcount * (rand_percent/100.0))  # use some% entirely random
-    #print "New random: %d" % rand_count
-    new = self.random_particles(rand_count)
-    step = max(weight) * 2.0
-    cur = int(random.random() * self.pcount)
-    beta = 0.0
-    for i in range(self.pcount - rand_count):
-      beta += random.random() * step  # 0 - step size
-      while beta > weight[cur]:
-        beta -= weight[cur]
-        cur = (cur+1) % self.pcount
-        #print "b: %0.2f, cur: %d, prob = %0.2f" % (beta, cur, weight[cur])
-      new.append((cur, x[cur], y[cur], theta[cur], weight[cur]))
-    #print "Resampled:"
-    #for i in range(self.pcount):
-    #  print " %d : %0.2f, %0.2f @ %+0.2f = %0.2e " % new[i]
-    self.p.x = array([e[1] for e in new])
-    self.p.y = array([e[2] for e in new])
-    self.p.theta = array([e[3] for e in new])
+    n = self.pcount
+    cdf = weight.cumsum(out=self._cdf[:n])
+    if self.adaptive:
+      picks = self.kld_picks(cdf)
+      n = len(picks)
+    else:
+      picks = self.systematic(cdf, n)
+
+    rand_count = int(n * (rand_percent/100.0))  # use some% entirely random
+    keep = n - rand_count
+
+    # survivors and fresh random particles go into the back buffer, which then becomes the front
+    front = self.p.state
+    back = self.p.back
+    for row in range(SIN + 1):
+      front[row].take(picks[:keep], out=back[row, :keep], mode='clip')
+    if rand_count:
+      self.random_particles(rand_count, out=back[:THETA+1, keep:n])
+      heading(back[:, keep:n])
+    self.p.flip()
+    self.bind(n)
+    self.weight.fill(1.0 / n)
+    self.log_weight.fill(-log(n))
+
+  def systematic(self, cdf, count):
+    """ count indexes into cdf by systematic resampling: a single random offset, then evenly spaced pointers """
+    pointers = self._pointers[:count]
+    pointers[:] = self._ramp[:count]
+    pointers += random.random()
+    pointers *= cdf[-1] / count
+    picks = cdf.searchsorted(pointers)
+    picks.clip(0, len(cdf) - 1, out=picks)
+    return picks
+
+  def kld_picks(self, cdf):
+    """
+    Draw picks kld_chunk at a time until they satisfy the KLD bound for the bins they occupy
+
+    Each chunk is shuffled, so it can be cut off wherever the bound is met. A
+    concentrated cloud stops after a chunk or two instead of drawing pmax.
+    """
+    picks = self._picks
+    seen = zeros(0, dtype=int)  # bin ids occupied so far
+    drawn = 0
+    occupied = 0
+    while drawn < self.pmax:
+      count = min(self.kld_chunk, self.pmax - drawn)
+      chunk = picks[drawn:drawn + count]
+      chunk[:] = self.systematic(cdf, count)
+      random.shuffle(chunk)  # any prefix is now a fair sample
+      pose = self.p.pose[:, chunk]
+      bins = (pose / self.kld_bins).astype(int)
+      bins[2] %= int(round(2*pi / self.kld_bins[2, 0]))
+      ids = (bins[0] * 4096 + bins[1]) * 4096 + bins[2]
+      ids, first = unique(ids, return_index=True)
+      new = ~in1d(ids, seen)
+      seen = concatenate((seen, ids[new]))
+      grew = zeros(count)
+      grew[first[new]] = 1
+      grew = occupied + grew.cumsum()  # distinct bins among the samples so far
+      samples = arange(drawn + 1, drawn + count + 1)
+      enough = ((samples >= kld_bound(grew, self.kld_err, self.kld_z)) & (samples >= self.pmin)).nonzero()[0]
+      if len(enough):
+        n = drawn + enough[0] + 1
+        occupied = grew[enough[0]]
+        break
+      drawn += count
+      occupied = grew[-1]
+    else:
+      n = self.pmax
+    self.logger.debug("KLD-sampling: %d bins occupied, %d particles" % (occupied, n))
+    return picks[:n]
 
   # TODO: try using a guess based on weighted particles?
   def guess(self):
-    return self.guess_wmean()
-    #return self.guess_best()
+    self.metrics.mark()
+    guess = self.guess_wmean()
+    #guess = self.guess_best()
+    self.metrics.lap('guess', committed = self.partial is None)  # belongs with the update it follows
+    return guess
 
   def guess_mean(self):
     x = self.p.x.mean()
@@ -166,35 +422,104 @@ class ParticleLocalizer(object):
 
 ######################################################
 
+# rows of the particle state block
+X, Y, THETA, COS, SIN, W, LOGW = range(7)
+FIELDS = 7
+
+def state_size(capacity):
+  """ Bytes of float32 storage Particles needs for capacity particles, both buffers """
+  return 2 * FIELDS * capacity * 4
+
+def heading(state):
+  """ Refresh the cached heading unit vector rows from theta """
+  cos(state[THETA], out=state[COS])
+  sin(state[THETA], out=state[SIN])
+
 class Particles(object):
   """ Essentially a large array of simbots (pose, sensor list, and noise params) """
 
-  def __init__(self, sensors, noise, map, pcount = 100, start_pose = None, logger = None):
+  def __init__(self, sensors, noise, map, pcount = 100, start_pose = None, logger = None, capacity = None,
+               buffer = None):
     # initialize particle filter
     #  - number of particles
     #  - map
     #  - robot params: sensors, movement error/noise
-    self.pcount = pcount
+    #  - capacity: most particles this set will ever hold, defaults to pcount
+    #  - buffer: optional writable buffer of state_size(capacity) bytes (e.g. shared memory)
+    #    to hold the particle state instead of a private allocation
+    self.capacity = capacity or pcount
     self.map = map
     self.sensors = sensors
-    self.sensed = {}
+    self._sensed = {}
     for s in sensors:
-      self.sensed[s] = zeros(self.pcount)  # modeled sensor data
+      self._sensed[s] = zeros(self.capacity)  # modeled sensor data
     self.noise = noise
     self.logger = logger
 
+    # one float32 block of FIELDS rows (x, y, theta, cos, sin, w, logw) by capacity,
+    # double buffered so resampling can write the next generation without allocating.
+    # Rows rather than columns keep every field contiguous for the vector math;
+    # x, y, theta, etc. are all views of the front buffer.
+    if buffer is None:
+      self.block = zeros((2, FIELDS, self.capacity), dtype=float32)
+    else:
+      self.block = frombuffer(buffer, dtype=float32, count=2*FIELDS*self.capacity).reshape(2, FIELDS, self.capacity)
+    self.buffers = [self.block[0], self.block[1]]
+    self.front = 0
+    self.resize(pcount)
+
     # Create starting points for the vectors.
 
-    if not start_pose:
-      self.x = sort(random.random(self.pcount)) * map.x_inches  # only sorted for gui axis auto sizing?
-      self.y = random.random(self.pcount) * map.y_inches
-      self.theta = random.random(self.pcount)*2*pi
+    if not start_pose and map.freespace:
+      map.freespace.sample(self.pcount, out=self.pose)
+      self.pose[:] = self.pose[:, self.x.argsort()]  # only sorted for gui axis auto sizing?
+    elif not start_pose:
+      self.x[:] = sort(random.random(self.pcount)) * map.x_inches  # only sorted for gui axis auto sizing?
+      self.y[:] = random.random(self.pcount) * map.y_inches
+      self.theta[:] = random.random(self.pcount)*2*pi
     else:
       xy_var = noise['move']
       theta_var = noise['turn']
-      self.x = random.randn(self.pcount) * xy_var*2 + start_pose.x
-      self.y = random.randn(self.pcount) * xy_var*2 + start_pose.y
-      self.theta = random.randn(self.pcount) * theta_var*2 + start_pose.theta
+      self.x[:] = random.randn(self.pcount) * xy_var*2 + start_pose.x
+      self.y[:] = random.randn(self.pcount) * xy_var*2 + start_pose.y
+      self.theta[:] = random.randn(self.pcount) * theta_var*2 + start_pose.theta
+    self.theta %= 2*pi
+    heading(self.state)
+    self.w.fill(1.0 / self.pcount)
+    self.logw.fill(-log(self.pcount))
+
+  def shard(self, lo, hi):
+    """ Particles over slots lo:hi of the current set, sharing its storage """
+    part = copy.copy(self)
+    part.pcount = hi - lo
+    part.state = self.state[:, lo:hi]
+    part.pose = part.state[:THETA+1]
+    part.x, part.y, part.theta, part.cos, part.sin, part.w, part.logw = part.state
+    part.sensed = dict( (s, a[lo:hi]) for s,a in self.sensed.items() )
+    return part
+
+  def resize(self, pcount):
+    """ Use the first pcount slots of the buffers as the particle set """
+    self.pcount = pcount
+    self.bind()
+
+  def bind(self):
+    self.state = self.buffers[self.front][:, :self.pcount]
+    self.back = self.buffers[1 - self.front]
+    self.pose = self.state[:THETA+1]
+    self.x, self.y, self.theta, self.cos, self.sin, self.w, self.logw = self.state
+    self.sensed = dict( (s, a[:self.pcount]) for s,a in self._sensed.items() )
+
+  def permute(self, order):
+    """ Reorder the particles by order (a permutation of range(pcount)), through the back buffer """
+    for row in range(FIELDS):
+      self.state[row].take(order, out=self.back[row, :self.pcount])
+    self.flip()
+
+  def flip(self):
+    """ Make the back buffer (just filled by resampling) the current particle set """
+    self.front = 1 - self.front
+    self.bind()
 
   def __str__(self):
     out = "Particles:\n"
@@ -204,7 +529,8 @@ class Particles(object):
 
   @property
   def v(self):
-    return array( zip(cos(self.theta), sin(self.theta)) )
+    # Nx2 heading unit vectors, a view of the cached cos/sin rows
+    return self.state[COS:SIN+1].T
 
   # update particles based on movement model, predicting new pose
   #   ? how do we handle moving off map?  or into any wall?  just let resampling handle it?
@@ -213,32 +539,27 @@ class Particles(object):
     x = self.x
     y = self.y
     theta = self.theta
-    for i in range(self.pcount):
-      theta[i] = (theta[i] + dtheta) % (2*pi)
-      theta[i] = gauss(theta[i], self.noise['turn'])  # turn error is not proportional
-      dx = forward * cos(theta[i])
-      dy = forward * sin(theta[i])
-      x[i] = gauss(x[i] + dx, dx * self.noise['move'])
-      y[i] = gauss(y[i] + dy, dy * self.noise['move'])
+    # draw turn, x and y noise for the whole cloud in one go
+    noise = random.randn(3, self.pcount)
+    theta += dtheta + noise[0] * self.noise['turn']  # turn error is not proportional
+    theta %= 2*pi
+    heading(self.state)
+    dx = forward * self.cos
+    dy = forward * self.sin
+    x += dx + noise[1] * abs(dx) * self.noise['move']
+    y += dy + noise[2] * abs(dy) * self.noise['move']
 
     # quick and dirty, keep things in range
-    self.y = y.clip(0,self.map.y_inches)
-    self.x = x.clip(0,self.map.x_inches)
-
-    self.theta = theta
+    x.clip(0, self.map.x_inches, out=x)
+    y.clip(0, self.map.y_inches, out=y)
 
   # called by update
   def particle_sense(self):
     self.logger.debug("ParticleLocalizer: particle_sense begin")
-    x = self.x
-    y = self.y
-    for name,sensor in self.sensors.items():
-      # get the full set of particle senses for this sensor
-      for i in range(self.pcount):
-        self.sensed[name][i] = sensor.sense(Pose(self.x[i], self.y[i], self.theta[i]), self.map)
-    #print "Particle sense:"
-    #for i in range(self.pcount):
-    #  print "  %0.2f, %0.2f @ %0.2f = " % (x[i], y[i], self.theta[i]),
-    #  print ", ".join( [ "%s: %0.2f" % (s.name, self.sensed[s.index,i]) for s in self.robot.sensors ])
+    # one batched raycast covers every particle and every sensor, field model sensors
+    # are scored straight from the measurement and need no expected reading
+    beams = dict( (name, s) for name,s in self.sensors.items() if s.model != 'field' )
+    sensed = sense_all(beams, self.x, self.y, self.theta, self.map, c = self.cos, s = self.sin)
+    for name in beams:
+      self.sensed[name][:] = sensed[name]
     self.logger.debug("ParticleLocalizer: particle_sense complete")
-
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+
+# Headless particle filter benchmark.
+#
+# Drives a noisy SimRobot over a scripted trajectory on each map, then replays the
+# same motions and readings into ParticleLocalizers for every combination of
+# particle count and sensor model. Prints (or writes) a JSON report with update
+# rate, time per phase, peak memory and pose error, so runs can be compared across
+# commits. Needs nothing beyond numpy, so it runs on the robot and in CI.
+#
+# Each run happens in a forked child, so its peak memory is its own: the loaded map
+# and script it inherits, plus whatever that particle count and model needed.
+
+import argparse
+import json
+import logging
+import multiprocessing
+import resource
+import subprocess
+import sys
+import time
+
+from numpy import random, pi, sqrt, mean, arctan2, sin, cos
+
+import particles, map, raytable, distfield, freespace, robot
+from sensors import Ultrasonic
+import std_sensors, std_noise
+from pose import Pose
+
+sys.path.append('..')
+import mapping.map_class
+sys.modules['map_class'] = mapping.map_class  # deal with the fact we pickled a module in another dir
+import mapping.pickler
+
+parser = argparse.ArgumentParser(description='Headless particle filter benchmark')
+parser.add_argument('--maps', help='"course" for the pickled course map, or .map files', nargs='+',
+                    default=['course', 'maps/test3.map'])
+parser.add_argument('--res', help='Resolutions (inches/block) to load .map files at', type=float, nargs='+', default=[3.0])
+parser.add_argument('-n', '--counts', help='Particle counts', type=int, nargs='+', default=[100, 500, 2000])
+parser.add_argument('--models', help='Sensor models: beam, cone, field', nargs='+', default=['beam', 'cone', 'field'])
+parser.add_argument('-u', '--updates', help='Updates per run', type=int, default=50)
+parser.add_argument('-s', '--seed', help='Random seed', type=int, default=1)
+parser.add_argument('--raycast', help='Raycast instead of using the ray table', action='store_true')
+parser.add_argument('-o', '--output', help='Write the JSON report here instead of stdout')
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.WARN)
+logger = logging.getLogger(__name__)
+
+def models(name):
+  """ std_sensors.offset_str layout with every ultrasonic using the named model """
+  sensors = {}
+  for key,s in std_sensors.offset_str.items():
+    if isinstance(s, Ultrasonic):
+      sensors[key] = Ultrasonic(key, s.rel_pose, s.noise, failure = s.failure,
+                                cone = name == 'cone', model = 'field' if name == 'field' else 'beam')
+    else:
+      sensors[key] = s
+  return sensors
+
+def load(name, res):
+  if name == 'course':
+    m = map.Map.from_map_class(mapping.pickler.unpickle_map('../mapping/map.pkl'), logger = logger)
+  else:
+    m = map.Map(name, res, logger = logger)
+  if not args.raycast:
+    m.raytable = raytable.RayTable(m, logger = logger)
+  m.distfield = distfield.DistanceField(m, logger = logger)
+  m.freespace = freespace.FreeSpace(m, 4.0, logger = logger)
+  return m
+
+def script(m):
+  """ Start pose and (turn, move, readings, true pose) steps of a wander that turns away from walls """
+  random.seed(args.seed)
+  x, y, theta = m.freespace.sample(1)[:, 0]
+  start = Pose(x, y, theta)
+  sim = robot.SimRobot(start.copy(), std_sensors.offset_str, std_noise.noise_params)
+  steps = []
+  for i in range(args.updates):
+    turn = random.random() * pi/4 - pi/8
+    front = sim.sense(m, noisy = False)['front']
+    if 0 <= front < 6.0:
+      turn += pi/2 + random.random() * pi
+    move = random.random() * 1.5
+    sim.move(turn, move)
+    sim.pose.x = min(max(sim.pose.x, 0.0), m.x_inches)
+    sim.pose.y = min(max(sim.pose.y, 0.0), m.y_inches)
+    steps.append((turn, move, sim.sense(m), sim.pose.copy()))
+  return start, steps
+
+# what each phase_ms figure covers
+PHASES = { 'move': 'motion update',
+           'sense': 'expected readings (raytable lookups or raycasts) for beam and cone sensors',
+           'weight': 'likelihoods and normalization; for field sensors this includes their distance field lookups, '
+                     'which is their sensing',
+           'resample': 'ESS check and resampling' }
+
+def bench(m, start, steps, model, count):
+  random.seed(args.seed)
+  loc = particles.ParticleLocalizer(models(model), std_noise.noise_params, m, count, start, logger = logger,
+                                    ess_threshold = 0.5)
+  phase = dict(move = 0.0, sense = 0.0, weight = 0.0, resample = 0.0)
+  err_xy = []
+  err_theta = []
+  t_start = time.time()
+  for turn, move, measured, truth in steps:
+    t0 = time.time()
+    loc.move(turn, move)
+    t1 = time.time()
+    loc.p.particle_sense()
+    t2 = time.time()
+    loc.likelihood(loc.p, measured, loc.log_lik, loc.raw_error)
+    loc.weigh()
+    t3 = time.time()
+    loc.maybe_resample()
+    t4 = time.time()
+    phase['move'] += t1 - t0
+    phase['sense'] += t2 - t1
+    phase['weight'] += t3 - t2
+    phase['resample'] += t4 - t3
+    guess = loc.guess()
+    err_xy.append((guess.x - truth.x) ** 2 + (guess.y - truth.y) ** 2)
+    err_theta.append(arctan2(sin(guess.theta - truth.theta), cos(guess.theta - truth.theta)) ** 2)
+  elapsed = time.time() - t_start
+  return { 'updates_per_s': len(steps) / elapsed,
+           'phase_ms': dict( (k, v / len(steps) * 1000) for k,v in phase.items() ),
+           'rmse_xy': float(sqrt(mean(err_xy))),
+           'rmse_theta': float(sqrt(mean(err_theta))),
+           'final_pcount': loc.pcount,
+           'resample_rate': loc.resamples / float(len(steps)) }
+
+def isolated(m, start, steps, model, count):
+  """ bench in a forked child, with that child's peak resident memory """
+  def child(conn):
+    result = bench(m, start, steps, model, count)
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # this child only
+    conn.send(result)
+    conn.close()
+  conn, child_conn = multiprocessing.Pipe(False)
+  proc = multiprocessing.Process(target=child, args=(child_conn,))
+  proc.start()
+  result = conn.recv()
+  proc.join()
+  return result
+
+def revision():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+runs = []
+for name in args.maps:
+  for res in ([None] if name == 'course' else args.res):
+    m = load(name, res)
+    start, steps = script(m)
+    for model in args.models:
+      for count in args.counts:
+        run = dict(map = name, res = m.scale, cells = [m.xdim, m.ydim], model = model, particles = count,
+                   lookup = 'raycast' if args.raycast else 'table')
+        run.update(isolated(m, start, steps, model, count))
+        runs.append(run)
+        logger.warn("%s @ %s, %s, %d particles: %0.1f updates/s, RMSE %0.2f in" % (
+                    name, m.scale, model, count, run['updates_per_s'], run['rmse_xy']))
+
+report = dict(revision = revision(), seed = args.seed, updates = args.updates, phases = PHASES, runs = runs)
+out = json.dumps(report, indent = 2, sort_keys = True)
+if args.output:
+  open(args.output, 'w').write(out + '\n')
+else:
+  print out
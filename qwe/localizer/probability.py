@@ -1,4 +1,4 @@
-from numpy import exp, sqrt, pi
+from numpy import exp, sqrt, pi, log, logaddexp, arange, clip, inf, maximum
 
 # gaussian normalized a unity area
 def gaussian(mu, sigma, x):
@@ -11,3 +11,38 @@ def ngaussian(mu, sigma, x):
   var = sigma**2
   # calculates the probability of x for 1-dim Gaussian with mean mu and var. sigma
   return exp(- ((mu - x) ** 2) / ( 2.0 * var))
+
+# log(sum(exp(a))) without underflowing when every entry is very negative
+def logsumexp(a):
+  top = a.max()
+  if top == -inf:
+    return -inf
+  return top + log(exp(a - top).sum())
+
+# Fox's KLD-sampling bound: samples needed so that, with upper normal quantile z,
+# the KL divergence between the sampled and true distribution stays under err
+# when the samples occupy k histogram bins
+def kld_bound(k, err, z):
+  k = maximum(k - 1, 1)
+  a = 2.0 / (9.0 * k)
+  return k / (2.0 * err) * (1.0 - a + sqrt(a) * z) ** 3
+
+class TabulatedPDF(object):
+  """
+  Sensor model sampled once onto a grid of (expected - measured) errors
+
+  A unity peak gaussian around the expected value, mixed with a flat failure
+  component, kept as log-probabilities so multiplying many readings together
+  never underflows.
+  """
+  def __init__(self, sigma, span, step, failure = 0.0):
+    self.span = span
+    self.step = step
+    err = arange(-span, span + step, step)
+    self.table = -(err ** 2) / (2.0 * sigma**2)
+    if failure > 0.0:
+      self.table = logaddexp(log(1.0 - failure) + self.table, log(failure))
+
+  def log_prob(self, err):
+    i = ((err + self.span) / self.step + 0.5).astype(int)
+    return self.table[clip(i, 0, len(self.table) - 1)]
@@ -1,5 +1,5 @@
-from numpy import array, clip, sin, cos, sign
-from numpy.linalg import norm
+from numpy import array, asarray, sin, cos, sign, arange, zeros, ones, floor, where, nonzero, inf, newaxis
+from numpy import maximum, minimum
 
 def find_wall(x,y,theta,max_dist,map):
 
@@ -58,46 +58,120 @@ def raywall(x1, y1, x2, y2, map):
   return -1,-1
 
 
-################### old/experimental/broken ############################
+def cast_rays(x, y, theta, max_dist, map):
+  """
+  Exact distance (inches) from arrays of sensor poses to the first wall face along
+  theta, inf where there is none within max_dist. Any matching shapes.
+
+  Amanatides-Woo grid traversal from the true (fractional) start position, run in
+  lock-step over the whole batch. Rays along the grid axes, which is most of them
+  on this course, skip the walk and look their wall up in axis_index().
+  """
+  x = asarray(x, dtype=float)
+  y = asarray(y, dtype=float)
+  theta = asarray(theta, dtype=float) + zeros(x.shape)
+  shape = x.shape
+  px = x.ravel() / map.scale
+  py = y.ravel() / map.scale
+  c = cos(theta.ravel())
+  s = sin(theta.ravel())
+  c[abs(c) < 1e-12] = 0.0
+  s[abs(s) < 1e-12] = 0.0
+  max_cells = (asarray(max_dist, dtype=float) + zeros(shape)).ravel() / map.scale
+
+  dist = zeros(len(px)) + inf
+  axis = (c == 0.0) | (s == 0.0)
+  ray = nonzero(axis)[0]
+  dist[ray] = axis_walls(px[ray], py[ray], c[ray], s[ray], map)
+  ray = nonzero(~axis)[0]
+  dist[ray] = dda(px[ray], py[ray], c[ray], s[ray], max_cells[ray], map)
+
+  dist[dist > max_cells] = inf
+  return (dist * map.scale).reshape(shape)
+
+
+def dda(px, py, c, s, max_cells, map):
+  """ Lock-step Amanatides-Woo walk for rays that are not axis aligned, distances in cells """
+  xmax = map.xdim
+  ymax = map.ydim
+  walls = map.walls.ravel()
+  dist = zeros(len(px)) + inf
+
+  ix = floor(px).astype(int)
+  iy = floor(py).astype(int)
+  step_x = where(c > 0, 1, -1)
+  step_y = where(s > 0, 1, -1)
+  # distance along the ray to the next vertical / horizontal grid line, and between them
+  t_x = where(c > 0, ix + 1 - px, px - ix) / abs(c)
+  t_y = where(s > 0, iy + 1 - py, py - iy) / abs(s)
+  dt_x = 1.0 / abs(c)
+  dt_y = 1.0 / abs(s)
+  t = zeros(len(px))  # where the ray entered the current cell
+  ray = arange(len(px))
+  live = ones(len(px), dtype=bool)
+
+  while len(ray):
+    inside = (0 <= ix) & (ix < xmax) & (0 <= iy) & (iy < ymax)
+    hit = walls[where(inside, iy*xmax + ix, 0)] & inside & live
+    dist[ray[hit]] = t[hit]
+
+    # into whichever neighbour the ray reaches first
+    xstep = t_x < t_y
+    t = minimum(t_x, t_y)
+    ix += step_x * xstep
+    iy += step_y * ~xstep
+    t_x += dt_x * xstep
+    t_y += dt_y * ~xstep
+
+    live &= inside & ~hit & (t <= max_cells)
+    # finished rays ride along until dropping them is worth the copying
+    if live.sum() < 0.75 * len(live):
+      ray, ix, iy, t, t_x, t_y = ray[live], ix[live], iy[live], t[live], t_x[live], t_y[live]
+      step_x, step_y, dt_x, dt_y, max_cells = step_x[live], step_y[live], dt_x[live], dt_y[live], max_cells[live]
+      live = live[live]
+
+  return dist
+
+
+def axis_index(map):
+  """
+  Nearest wall column left/right of and wall row below/above every cell, built once
+  per map contents and kept on the map (Map.refresh() drops it)
+  """
+  if getattr(map, 'axis_walls', None) is None:
+    walls = map.walls
+    ydim, xdim = walls.shape
+    col = arange(xdim)
+    row = arange(ydim)[:, newaxis]
+    left = maximum.accumulate(where(walls, col, -1), axis=1)
+    right = minimum.accumulate(where(walls, col, xdim)[:, ::-1], axis=1)[:, ::-1]
+    down = maximum.accumulate(where(walls, row, -1), axis=0)
+    up = minimum.accumulate(where(walls, row, ydim)[::-1], axis=0)[::-1]
+    map.axis_walls = (left, right, down, up)
+  return map.axis_walls
+
+
+def axis_walls(px, py, c, s, map):
+  """ Distances (cells) for rays along the grid axes, straight from axis_index() """
+  left, right, down, up = axis_index(map)
+  ix = floor(px).astype(int)
+  iy = floor(py).astype(int)
+  dist = zeros(len(px)) + inf
+  inside = (0 <= ix) & (ix < map.xdim) & (0 <= iy) & (iy < map.ydim)
+  # direction, wall index, index value meaning no wall, distance to the near face of wall w
+  for toward, index, none, face in ((c > 0, right, map.xdim, lambda w: w - px),
+                                    (c < 0, left, -1, lambda w: px - (w + 1)),
+                                    (s > 0, up, map.ydim, lambda w: w - py),
+                                    (s < 0, down, -1, lambda w: py - (w + 1))):
+    go = inside & toward
+    w = zeros(len(px), dtype=int) + none
+    w[go] = index[iy[go], ix[go]]
+    found = w != none
+    dist[found] = maximum(face(w)[found], 0.0)
+  return dist
 
-def wall(x,y,theta,map,max_dist):
-  """ x,y: sensor location in inches """
-  print "wall: (%0.2f,%0.2f) @ %0.2f" % (x,y,theta)
-  x /= map.scale
-  y /= map.scale
-  max_dist /= map.scale
-  xpath,ypath = calc_line(x,y,theta,map.xdim-1,map.ydim-1, max_dist)  # dimension-1 since grid coords start at 0
-  # TODO: move this check inside the line algorithm for speed
-  for i in range(len(xpath)):
-    if map.data[ypath[i]][xpath[i]] == 1:
-      return xpath[i]*map.scale,ypath[i]*map.scale
-  return -1,-1  # no wall
-
-def calc_line(x,y,theta,grid_max_x,grid_max_y, max_dist):
-  """ At this point, all x,y, and distances are in now normalized to grid size """
-  """ Valid grid coordinates are (0..grid_max_x,0..grid_max_y) """
-  print "calc_line: (%0.2f,%0.2f) @ %0.2f" % (x,y,theta)
-  # find endpoints of line max_dist away
-  x_end = x + max_dist * cos(theta)
-  y_end = y + max_dist * sin(theta)
-  print "calc_line: endpoints: ", x_end, y_end
- 
-  # calc some reasonable bounds for bresen alg
-  # NB: this does NOT try to find a point on the line which is both 
-  #     within the grid bounds and within max_dist, which might be better
-  b_min_x = b_min_y = 0
-  b_max_x = grid_max_x
-  b_max_y = grid_max_y
-  if( x < x_end < grid_max_x):
-    b_max_x = x_end
-  if( 0 < x_end < x):
-    b_min_x = x_end
-  if( y < y_end < grid_max_y):
-    b_max_y = y_end
-  if( 0 < y_end < y):
-    b_min_y = y_end
-  
-  return b2(x,y,x_end,y_end, b_min_x,b_max_x,b_min_y,b_max_y)
+
+################### old/experimental/broken ############################
 
 def raytrace(x0, y0, x1, y1):
   """ calculates all squares intersected by a line """
@@ -131,95 +205,3 @@ def raytrace(x0, y0, x1, y1):
     n -= 1
 
   return array([xdata,ydata])
-
-
-def bresen(x1,y1, x2,y2, x_min,x_max, y_min,y_max):
-  print "bresen: (%d,%d)->(%d,%d) bounds: (%0.2f,%0.2f),(%0.2f,%0.2f)" % (x1, y1, x2, y2, x_min, y_min, x_max,y_max)
-
-  dx = x2 - x1
-  dy = y2 - y1
-  xmod = sign(dx)
-  ymod = sign(dy)
-  dx = abs(dx)
-  dy = abs(dy)
-  print "dx,dy: ", dx,dy
-
-  # algorithm assumes dx >= dy, so swap if necessary
-  if( dx < dy ):
-    b = bresen(y1,x1,y2,x2,y_min,y_max,x_min,x_max)
-    return array([b[1],b[0]])
-
-  xdata = [x1]
-  ydata = [y1]
-
-  x_off = x1 - int(x1)
-  y_off = x1 - int(y1)
-
-  # TODO: preset this error term based on subpixel offset instead
-  D = 2*dy - dx
-
-  x = x1
-  y = y1
-  while (x_min < x < x_max) and (y_min < y < y_max): 
-    x+=xmod
-    if D > 0:
-      y = y+ymod  # +1 or -1 dep on direction
-      xdata.append(x); ydata.append(y)
-      D += (2*dy - 2*dx)
-    else:
-      xdata.append(x); ydata.append(y)
-      D += 2*dy
-
-  return array([xdata,ydata])
-
-def slope_walker(x1,y1, x2,y2):
-  """ walk along the line using the slope
-      relies on floating opint calculations
-  """
-  print "b2: (%d,%d)->(%d,%d) " % (x1, y1, x2, y2)
-
-  dx = x2 - x1
-  dy = y2 - y1
-  xdir = sign(dx)
-  ydir = sign(dy)
-  dx = abs(dx)
-  dy = abs(dy)
-  print "dx,dy: ", dx,dy
-
-  # algorithm assumes dx >= dy, so swap if necessary
-  if( dx < dy ):
-    b = b2(y1,x1,y2,x2,y_min,y_max,x_min,x_max)
-    return array([b[1],b[0]])
-
-  xdata = [x1]
-  ydata = [y1]
-
-  x = x1
-  y = y1
-
-  x_step = xdir 
-  y_step = ydir * dy/dx
-
-  x_diff = (x2 -x) * xdir
-  y_diff = (y2- y)*ydir
-  while (x_diff > 0) and (y_diff > 0): 
-    x_int = int(x)
-    y_int = int(y)
-    #x_frac = x_int - x + 1
-    #y_frac = y_int - y + 1
-    #print "start fractionals: (%0.2f,%0.2f)" % (x_frac, y_frac)
-    x += x_step
-    y += y_step
-    x_int2 = int(x)
-    y_int2 = int(y)
-    if (x_int != x_int2) and (y_int != y_int2):
-      print "both changed"  
-      # calculate overshoot (consider direction!)
-      
-    xdata.append(x)
-    ydata.append(y)
-    x_diff = (x2 -x) * xdir
-    y_diff = (y2- y)*ydir
-    
-
-  return array([xdata,ydata])
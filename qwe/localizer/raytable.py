@@ -0,0 +1,317 @@
+from numpy import array, arange, zeros, memmap, floor, ceil, cos, sin, pi, inf
+from numpy import uint16, nonzero, repeat, searchsorted, where, minimum, maximum
+from multiprocessing import Pool, cpu_count
+import hashlib
+import logging
+import glob
+import os
+
+# Expected ultrasonic range from the center of every map cell at a fixed set of headings.
+#
+# The table is (angles, ydim, xdim) uint16 in tenths of an inch, and lives in a
+# memory-mapped file named after a hash of the wall layer, so any process that
+# sees the same map just maps the existing file instead of rebuilding it.
+
+NO_WALL = 0xffff      # table entry for "nothing within max range"
+BAND = 0.5            # width of the parallel ray bands used by the builder (cells)
+KEEP = 4              # most recently used tables left in table_dir, older ones are deleted
+
+table_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tables')
+
+class RayTable(object):
+
+  def __init__(self, map, angles = 72, max_dist = 196.0, procs = None, logger = None):
+    self.map = map
+    self.angles = angles
+    self.max_dist = max_dist  # inches
+    self.procs = procs or cpu_count()
+    self.logger = logger or logging.getLogger(__name__)
+    self.step = 2*pi / angles
+    self.load()
+
+  def key(self):
+    """ Content hash of everything the table depends on """
+    h = hashlib.sha1()
+    h.update(self.map.data.astype(uint16).tostring())
+    h.update("%s %s %r %d %r" % (self.map.xdim, self.map.ydim, self.map.scale, self.angles, self.max_dist))
+    return h.hexdigest()[:16]
+
+  def refresh(self, rects = None):
+    """
+    Bring the table back in line with the map after its walls changed
+
+    rects lists the (x1, y1, x2, y2) cell rectangles (x2, y2 exclusive) that
+    changed. Rectangles that are now solid wall or now entirely free are patched
+    in place, touching only the rays whose line of sight crosses them. Without
+    rects, or for a partially filled rectangle, the whole table is reloaded.
+    """
+    if rects is None:
+      self.load()
+      return
+    for rect in rects:
+      x1, y1, x2, y2 = rect
+      walls = self.map.walls[y1:y2, x1:x2]
+      if walls.all():
+        self.add_rect(rect)
+      elif not walls.any():
+        self.clear_rect(rect)
+      else:
+        self.logger.debug("RayTable: mixed update in %s, reloading" % (rect,))
+        self.load()
+        return
+    self.logger.debug("RayTable: patched %d changed regions" % len(rects))
+
+  def load(self):
+    """ Map the table for the current map contents, building it first if nobody has yet """
+    self.path = os.path.join(table_dir, 'ray_%s.u16' % self.key())
+    shape = (self.angles, self.map.ydim, self.map.xdim)
+    if not os.path.exists(self.path):
+      self.build(shape)
+      self.prune()
+    else:
+      self.logger.debug("RayTable: mapping existing table %s" % self.path)
+      try:
+        os.utime(self.path, None)  # mark it used, see prune()
+      except OSError:
+        pass
+    # copy-on-write, so refreshing entries in memory never touches the shared file
+    self.table = memmap(self.path, dtype=uint16, mode='c', shape=shape)
+
+  def build(self, shape):
+    self.logger.info("RayTable: building %s table for %s" % (shape, self.map))
+    if not os.path.isdir(table_dir):
+      os.makedirs(table_dir)
+    tmp = "%s.%d.tmp" % (self.path, os.getpid())
+    memmap(tmp, dtype=uint16, mode='w+', shape=shape).flush()
+
+    walls = self.map.walls
+    max_cells = self.max_dist / self.map.scale
+    jobs = [ (tmp, shape, walls, max_cells, self.map.scale, range(k, self.angles, self.procs))
+             for k in range(min(self.procs, self.angles)) ]
+    if len(jobs) > 1:
+      pool = Pool(len(jobs))
+      pool.map(_build_angles, jobs)
+      pool.close()
+      pool.join()
+    else:
+      _build_angles(jobs[0])
+
+    # rename is atomic, other processes only ever see a finished table
+    os.rename(tmp, self.path)
+    self.logger.info("RayTable: table saved to %s" % self.path)
+
+  def prune(self):
+    """
+    Delete all but the KEEP most recently used tables
+
+    Every zone layout the map goes through gets a table of its own, this keeps
+    them from piling up. Processes that still have a deleted table mapped keep
+    their copy until they unmap it.
+    """
+    tables = sorted(glob.glob(os.path.join(table_dir, 'ray_*.u16')), key=os.path.getmtime, reverse=True)
+    for path in tables[KEEP:]:
+      if path == self.path:
+        continue
+      try:
+        os.remove(path)
+        self.logger.debug("RayTable: deleted stale table %s" % path)
+      except OSError:
+        pass  # someone else got there first
+
+  def lookup(self, x, y, theta):
+    """ Distances (inches) for arrays of sensor poses, inf where no wall is in range """
+    scale = self.map.scale
+    cx = (x / scale).astype(int)
+    cy = (y / scale).astype(int)
+    inside = (0 <= x) & (cx < self.map.xdim) & (0 <= y) & (cy < self.map.ydim)
+    a = (theta / self.step + 0.5).astype(int) % self.angles
+    raw = self.table[a * inside, cy * inside, cx * inside]
+
+    dist = raw * 0.1
+    # the table is measured from the cell center, move that to the sensor's actual position
+    a = a * self.step
+    dist -= ((x - (cx + 0.5) * scale) * cos(a) + (y - (cy + 0.5) * scale) * sin(a))
+    dist = maximum(dist, 0.0)
+    dist[(raw == NO_WALL) | ~inside] = inf
+    return dist
+
+  def add_rect(self, rect):
+    """ rect became solid wall: rays crossing it now stop at its near face if nothing is closer """
+    x1, y1, x2, y2 = rect
+    per_cell = self.map.scale * 10  # table units per cell
+    max_cells = self.max_dist / self.map.scale
+    self.table[:, y1:y2, x1:x2] = 0
+    for k in range(self.angles):
+      c, s = heading(2*pi * k / self.angles)
+      cx, cy = shadow(rect, c, s, max_cells, self.map.xdim, self.map.ydim)
+      t_in, t_out = slab(cx + 0.5, cy + 0.5, c, s, x1, y1, x2, y2)
+      new = where(t_in <= t_out, maximum(t_in, 0.0) * per_cell + 0.5, NO_WALL)
+      closer = new < self.table[k, cy, cx]
+      self.table[k, cy[closer], cx[closer]] = new[closer]
+
+  def clear_rect(self, rect):
+    """ rect was cleared: rays that used to stop on it carry on to whatever lies behind it """
+    x1, y1, x2, y2 = rect
+    per_cell = self.map.scale * 10
+    max_cells = self.max_dist / self.map.scale
+    walls = self.map.walls
+    for k in range(self.angles):
+      c, s = heading(2*pi * k / self.angles)
+      cx, cy = shadow(rect, c, s, max_cells, self.map.xdim, self.map.ydim)
+      t_in, t_out = slab(cx + 0.5, cy + 0.5, c, s, x1, y1, x2, y2)
+      old = self.table[k, cy, cx]
+      d = old / per_cell
+      # only rays whose old return landed on the rect change
+      ended = (old != NO_WALL) & (t_in <= t_out) & (d >= t_in - 0.5) & (d <= t_out + 0.5)
+      cx, cy, t_out = cx[ended], cy[ended], t_out[ended]
+      dist = self.continue_rays(k, c, s, cx + 0.5, cy + 0.5, t_out, rect, walls)
+      dist[dist > max_cells] = inf
+      self.table[k, cy, cx] = where(dist < inf, minimum(dist * per_cell + 0.5, NO_WALL - 1), NO_WALL)
+
+  def continue_rays(self, k, c, s, px, py, t, rect, walls):
+    """
+    Distance (cells) along rays from (px, py) that pick up again at t, just past rect
+
+    Reuses the table entry of the first cell past the rect, corrected for the offset
+    of the ray from that cell's center. Cells whose own ray still clips the rect are
+    stepped over, since their entries are about to change too.
+    """
+    x1, y1, x2, y2 = rect
+    per_cell = self.map.scale * 10
+    dist = zeros(len(px)) + inf
+    ray = arange(len(px))
+    t = t + 0.75
+    for attempt in range(4):
+      qx = px + t * c
+      qy = py + t * s
+      bx = floor(qx).astype(int)
+      by = floor(qy).astype(int)
+      inside = (0 <= bx) & (bx < self.map.xdim) & (0 <= by) & (by < self.map.ydim)
+      ray, px, py, t, qx, qy, bx, by = [ a[inside] for a in (ray, px, py, t, qx, qy, bx, by) ]
+
+      # ran straight into a wall cell, stop at its face
+      wall = walls[by, bx]
+      t_in, t_out = slab(px[wall], py[wall], c, s, bx[wall], by[wall], bx[wall] + 1, by[wall] + 1)
+      dist[ray[wall]] = minimum(maximum(t_in, 0.0), t[wall])
+
+      ray, px, py, t, qx, qy, bx, by = [ a[~wall] for a in (ray, px, py, t, qx, qy, bx, by) ]
+      t_in, t_out = slab(bx + 0.5, by + 0.5, c, s, x1, y1, x2, y2)
+      clean = ~((t_in <= t_out) & (t_out > 0)) | (attempt == 3)
+      old = self.table[k, by[clean], bx[clean]]
+      rest = old / per_cell - ((qx[clean] - bx[clean] - 0.5) * c + (qy[clean] - by[clean] - 0.5) * s)
+      dist[ray[clean]] = where(old == NO_WALL, inf, t[clean] + maximum(rest, 0.0))
+
+      ray, px, py, t = ray[~clean], px[~clean], py[~clean], t[~clean] + 0.75
+      if not len(ray):
+        break
+    return dist
+
+######################################################
+
+def heading(theta):
+  """ cos/sin with exact zeros on the axes, so axis-aligned rays take the simple branches """
+  c = cos(theta)
+  s = sin(theta)
+  if abs(c) < 1e-12: c = 0.0
+  if abs(s) < 1e-12: s = 0.0
+  return c, s
+
+def slab(px, py, c, s, x1, y1, x2, y2):
+  """ Entry/exit distances of rays from (px, py) along (c, s) through boxes [x1,x2]x[y1,y2],
+      t_in > t_out where the ray's line misses the box """
+  t_in = zeros(len(px)) - inf
+  t_out = zeros(len(px)) + inf
+  for p, d, lo, hi in ((px, c, x1, x2), (py, s, y1, y2)):
+    if d != 0.0:
+      ta = (lo - p) / d
+      tb = (hi - p) / d
+      t_in = maximum(t_in, minimum(ta, tb))
+      t_out = minimum(t_out, maximum(ta, tb))
+    else:
+      t_in[(p < lo) | (p > hi)] = inf
+  return t_in, t_out
+
+def shadow(rect, c, s, max_cells, xdim, ydim):
+  """ Cells whose center ray along (c, s) passes through rect within max_cells, as (x, y) index arrays.
+      The region is rasterized a row at a time, so only the cells in the rect's shadow are visited. """
+  x1, y1, x2, y2 = rect
+  row = arange(ydim)
+  y = row + 0.5
+  if s != 0.0:
+    ta = (y1 - y) / s
+    tb = (y2 - y) / s
+    t_lo = maximum(minimum(ta, tb), 0.0)
+    t_hi = minimum(maximum(ta, tb), max_cells)
+  else:
+    across = (y1 <= y) & (y <= y2)
+    t_lo = where(across, 0.0, inf)
+    t_hi = where(across, max_cells, -inf)
+  ok = t_lo <= t_hi
+  row, t_lo, t_hi = row[ok], t_lo[ok], t_hi[ok]
+
+  # x range of the rect swept back along the ray, for each row
+  lo = maximum(ceil(x1 - maximum(c * t_lo, c * t_hi) - 0.5), 0).astype(int)
+  hi = minimum(floor(x2 - minimum(c * t_lo, c * t_hi) - 0.5), xdim - 1).astype(int)
+  n = maximum(hi - lo + 1, 0)
+  cy = repeat(row, n)
+  cx = repeat(lo, n) + arange(n.sum()) - repeat(n.cumsum() - n, n)
+  return cx, cy
+
+def _build_angles(job):
+  """ Pool worker: fills in the table slices for a list of angle indexes """
+  path, shape, walls, max_cells, scale, indexes = job
+  table = memmap(path, dtype=uint16, mode='r+', shape=shape)
+  for k in indexes:
+    dist = band_distances(walls, 2*pi * k / shape[0])
+    dist[dist > max_cells] = inf
+    table[k] = where(dist < inf, minimum(dist * scale * 10 + 0.5, NO_WALL - 1), NO_WALL)
+  table.flush()
+
+def band_distances(walls, theta):
+  """
+  Distance (cells) from each cell center to the first wall along heading theta
+
+  Rays are grouped into parallel bands BAND cells wide. Every wall cell is clipped
+  against the center line of each band it overlaps, and each cell's ray becomes a
+  sorted search for the first wall interval ahead of it in its own band.
+  """
+  ydim, xdim = walls.shape
+  c, s = heading(theta)
+  span = float(xdim + ydim + 2)  # bigger than any u coordinate, keeps bands apart in the sort key
+
+  # u is distance along the ray, v is the perpendicular offset that picks the band
+  wy, wx = nonzero(walls)
+  corners_v = array([ -s*(wx+i) + c*(wy+j) for i in (0,1) for j in (0,1) ])
+  b_lo = floor(corners_v.min(axis=0) / BAND).astype(int)
+  b_hi = floor(corners_v.max(axis=0) / BAND).astype(int)
+  nbands = b_hi - b_lo + 1
+  wall = repeat(arange(len(wx)), nbands)
+  band = repeat(b_lo, nbands) + arange(nbands.sum()) - repeat(nbands.cumsum() - nbands, nbands)
+  wx = wx[wall]
+  wy = wy[wall]
+
+  # clip the band's center line against the wall cell
+  v = (band + 0.5) * BAND
+  u_in, u_out = slab(-s * v, c * v, c, s, wx, wy, wx + 1, wy + 1)
+  hit = u_in <= u_out
+  band, u_in, u_out = band[hit], u_in[hit], u_out[hit]
+
+  order = (band * span + u_out).argsort()
+  band, u_in, u_out = band[order], u_in[order], u_out[order]
+  keys = band * span + u_out
+
+  # cell center queries
+  cy, cx = nonzero(~walls)
+  px = cx + 0.5
+  py = cy + 0.5
+  u0 = c * px + s * py
+  b0 = floor((-s * px + c * py) / BAND).astype(int)
+  first = searchsorted(keys, b0 * span + u0, side='right')
+  found = first < len(keys)
+  first[~found] = 0
+  found &= band[first] == b0
+
+  dist = zeros(walls.shape)
+  free = where(found, maximum(u_in[first] - u0, 0.0), inf)
+  dist[cy, cx] = free
+  return dist
@@ -0,0 +1,49 @@
+import struct
+import pickle
+import time
+
+# Append-only log of what the localizer process saw, for replaying real runs offline.
+#
+# Each record is a fixed header (kind, wall clock time, payload length) followed by
+# the payload pickled with protocol 2. Records are flushed as they are written, so
+# a run that dies still leaves a readable log, at worst with a torn last record
+# that read() drops.
+
+HEADER = struct.Struct('<BdI')
+
+# record kinds
+START = 1   # {'x', 'y', 'theta'} starting pose
+MSGS = 2    # list of nav messages handled in one update
+ZONES = 3   # {'zones': zones dict, 'zone_change': counter} when the map zones change
+POSE = 4    # {'x', 'y', 'theta'} pose published after an update
+
+class Recorder(object):
+
+  def __init__(self, path, logger = None):
+    self.path = path
+    self.logger = logger
+    self.f = open(path, 'ab')
+    logger.info("Recording localizer input to %s" % path)
+
+  def write(self, kind, payload):
+    data = pickle.dumps(payload, 2)
+    self.f.write(HEADER.pack(kind, time.time(), len(data)))
+    self.f.write(data)
+    self.f.flush()
+
+  def close(self):
+    self.f.close()
+
+def read(path):
+  """ Generates the (kind, time, payload) records of a log """
+  f = open(path, 'rb')
+  while True:
+    head = f.read(HEADER.size)
+    if len(head) < HEADER.size:
+      break
+    kind, stamp, length = HEADER.unpack(head)
+    data = f.read(length)
+    if len(data) < length:
+      break  # torn final record
+    yield kind, stamp, pickle.loads(data)
+  f.close()
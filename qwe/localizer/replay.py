@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+# Replay a recorded localizer log through the localizer's update path as fast as it
+# will go, and report throughput and how far the replayed poses land from the ones
+# published during the recorded run.
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+from numpy import random, sqrt, mean, arctan2, sin, cos
+
+import localizer, map, raytable, distfield, freespace, recorder
+from pose import Pose
+
+sys.path.append('..')
+import mapping.map_class
+sys.modules['map_class'] = mapping.map_class  # deal with the fact we pickled a module in another dir
+import mapping.pickler
+
+parser = argparse.ArgumentParser(description='Replay a recorded localizer log')
+parser.add_argument('log', help='Log written by the localizer (see config["record"])')
+parser.add_argument('-m', '--map', help='Pickled course map', default='../mapping/map.pkl')
+parser.add_argument('-w', '--waypoints', help='Pickled waypoints', default='../mapping/waypoints.pkl')
+parser.add_argument('-s', '--seed', help='Random seed', type=int, default=1)
+parser.add_argument('--json', help='Print the summary as JSON', action='store_true')
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.WARN)
+logger = logging.getLogger(__name__)
+
+random.seed(args.seed)
+localizer.config["record"] = None
+localizer.config["metrics"] = None  # keep out of a live localizer's timings
+localizer.config["snapshot"] = None  # and out of its viewers' snapshot
+course_map = mapping.pickler.unpickle_map(args.map)
+waypoints = mapping.pickler.unpickle_waypoints(args.waypoints)
+themap = map.Map.from_map_class(course_map, logger = logger)
+themap.raytable = raytable.RayTable(themap, logger = logger)
+themap.distfield = distfield.DistanceField(themap, logger = logger)
+themap.freespace = freespace.FreeSpace(themap, localizer.config["footprint"], logger = logger)
+
+tracker = None
+bot_loc = {}
+bot_state = {'zone_change': 0}
+zones = {}
+step_time = []
+err_xy = []
+err_theta = []
+messages = 0
+
+for kind, stamp, payload in recorder.read(args.log):
+  if kind == recorder.START:
+    tracker = localizer.Tracker(themap, Pose(payload['x'], payload['y'], payload['theta']), logger)
+  elif kind == recorder.ZONES:
+    zones = payload['zones']
+    bot_state['zone_change'] = payload['zone_change']
+  elif kind == recorder.MSGS:
+    t = time.time()
+    tracker.sync_zones(zones, waypoints, bot_state)
+    tracker.step(payload)
+    tracker.publish(bot_loc, bot_state)
+    step_time.append(time.time() - t)
+    messages += len(payload)
+  elif kind == recorder.POSE and step_time:
+    err_xy.append((bot_loc['x'] - payload['x']) ** 2 + (bot_loc['y'] - payload['y']) ** 2)
+    err_theta.append(arctan2(sin(bot_loc['theta'] - payload['theta']), cos(bot_loc['theta'] - payload['theta'])) ** 2)
+if tracker:
+  tracker.stop()
+
+if not step_time:
+  print "No updates in %s" % args.log
+  sys.exit(1)
+
+summary = { 'updates': len(step_time),
+            'messages': messages,
+            'updates_per_s': len(step_time) / sum(step_time),
+            'mean_update_ms': mean(step_time) * 1000,
+            'max_update_ms': max(step_time) * 1000,
+            'rmse_xy': float(sqrt(mean(err_xy))) if err_xy else None,
+            'rmse_theta': float(sqrt(mean(err_theta))) if err_theta else None }
+if args.json:
+  print json.dumps(summary, indent = 2, sort_keys = True)
+else:
+  print "%s: %d updates (%d messages)" % (args.log, summary['updates'], summary['messages'])
+  print "  %0.1f updates/s, %0.2f ms mean, %0.2f ms worst" % (
+      summary['updates_per_s'], summary['mean_update_ms'], summary['max_update_ms'])
+  if err_xy:
+    print "  vs recorded poses: RMSE %0.2f in, %0.3f rad" % (summary['rmse_xy'], summary['rmse_theta'])
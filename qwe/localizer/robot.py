@@ -2,7 +2,6 @@
 from numpy import array, sort, pi, cos, sin
 from numpy.linalg import norm
 
-from raycast import wall
 from random import gauss
 
 from sensors import *
@@ -63,11 +62,8 @@ class SimRobot(Robot):
   #   currently a very simple model -- straightline distance to closest wall
   def sense(self, map, noisy = True):
     #print "SimRobot: Robot sense:"
-    sensed = {}
-    for name,sensor in self.sensors.items():
-      val = sensor.sense(self.pose, map, noisy = noisy)
-      sensed[name] = val
-    return sensed
+    sensed = sense_all(self.sensors, array([self.x]), array([self.y]), array([self.theta]), map, noisy = noisy)
+    return dict( (name, float(val[0])) for name,val in sensed.items() )
 
   # simulate robot motion
   #   all moves are restricted to: turn first, then go forward
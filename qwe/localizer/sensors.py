@@ -3,61 +3,99 @@ import raycast
 from numpy import random
 from pose import *
 
-from numpy import pi
-from numpy.linalg import norm
+from numpy import pi, array, cos, sin, inf, newaxis, concatenate, cumsum, full, where, log, logaddexp, zeros, linspace
+from probability import TabulatedPDF
 
 class Sensor(object):
   name = ''
+  model = 'beam'  # predicts a reading per particle, see Ultrasonic for 'field'
   def __init__(self, name):
     self.name = name
 
 class Ultrasonic(Sensor):
-  def __init__(self, name, rel_pose, noise = 0.0, cone = False, failure = 0.2):  # better to use *args, **kwargs??
+  # model: 'beam' raycasts the expected reading from each particle and compares it to the
+  #   measurement, 'field' projects the measured endpoint into the map and scores how
+  #   close it lands to a wall using the map's distance field
+  # cone: model the beam as cone_rays rays fanned evenly across cone_width radians, the
+  #   closest return wins
+  def __init__(self, name, rel_pose, noise = 0.0, cone = False, failure = 0.2, model = 'beam',
+               cone_width = pi/6, cone_rays = 3):  # better to use *args, **kwargs??
     Sensor.__init__(self, name)
+    self.model = model
     self.rel_pose = rel_pose # relative to robot center (inches)
     self.noise = noise # 1st std deviation, so 2*noise is 95%
     self.max = 196.0  # inches
     # TODO: figure out how we convert this precision value to gaussians
     self.resolution = 0.1  # inches, from datasheet (0.3cm)
     self.cone = cone
+    self.cone_width = cone_width
+    self.cone_rays = cone_rays
+    spread = linspace(-cone_width/2, cone_width/2, cone_rays) if cone and cone_rays > 1 else zeros(1)
+    # (x, y, theta) of each ray relative to the robot center, see transform()
+    self.offsets = array([ (rel_pose.x, rel_pose.y, rel_pose.theta + d) for d in spread ])
     self.gauss_var = 3.0
     self.failure = failure
+    self._pdf = None
+    self._field_pdf = None
+
+  @property
+  def pdf(self):
+    if self._pdf is None:
+      self._pdf = TabulatedPDF(self.gauss_var, self.max, self.resolution, self.failure)
+    return self._pdf
+
+  def field_pdf(self, map):
+    if self._field_pdf is None:
+      self._field_pdf = TabulatedPDF(self.gauss_var, map.distfield.max_dist, self.resolution, self.failure)
+    return self._field_pdf
+
+  def endpoint_distance(self, x, y, theta, measured, map, c = None, s = None):
+    """ Likelihood-field model: distance from the measured endpoint to the nearest wall, for arrays of robot poses """
+    sx, sy, stheta = self.rays(x, y, theta, c, s)
+    dist = map.distfield.lookup(sx + measured * cos(stheta), sy + measured * sin(stheta))
+    return dist.min(axis=0)  # best fitting ray of the cone
+
+  def field_log_likelihood(self, dist, measured, map):
+    """ Log-likelihood of one measured reading given the endpoint_distance() of an array of poses """
+    if measured >= self.max:
+      return zeros(len(dist))  # nothing came back, so no endpoint to score
+    return self.field_pdf(map).log_prob(dist)
+
+  def log_likelihood(self, expected, measured):
+    """ Log-likelihood of one measured reading for an array of expected readings """
+    # modeled "no wall" is a return at max range
+    expected = where(expected < 0, self.max, expected)
+    logp = self.pdf.log_prob(expected - measured)
+    if measured >= self.max and self.failure > 0.0:
+      # a max range reading also fits a missed echo
+      logp = logaddexp(logp, log(self.failure))
+    return logp
 
   def sense(self, pose, map, noisy = False):
-    if self.cone:  # 15 degree cone
-      left = self.sense1(pose + Pose(0,0,-pi/12), map, noisy)
-      center = self.sense1(pose, map,noisy)
-      right = self.sense1(pose + Pose(0,0,pi/12), map, noisy)
-      return min([left,center,right])
-    else:
-      return self.sense1(pose, map, noisy)
-
-  def sense1(self, pose, map, noisy):
+    return self.sense_all(array([pose.x]), array([pose.y]), array([pose.theta]), map, noisy)[0]
+
+  def sense_all(self, x, y, theta, map, noisy = False):
+    """ Batched sense for arrays of robot poses, returns an array of readings """
+    sx, sy, stheta = self.rays(x, y, theta)
+    return self.ranges(cast(sx, sy, stheta, self.max, map), noisy)
+
+  def rays(self, x, y, theta, c = None, s = None):
     """
-    Calculates ultrasonic sensor response
+    Sensor origin and beam angle for arrays of robot poses
 
-    Parameters
-    ----------
-    pose -- robot absolute coordinates and angle (inches)
+    Returns x, y, theta arrays shaped (rays, N): one row for a straight beam,
+    cone_rays rows for a cone
     """
+    return transform(self.offsets, x, y, theta, c, s)
 
-    sense_pose = pose.offset(self.rel_pose.x, self.rel_pose.y, self.rel_pose.theta)
-    #sense_pose.theta = self.rel_pose.theta
-
-    #print "Sensor: ", self.name
-    #print "Pose: ", sense_pose
-    wx,wy = raycast.find_wall(sense_pose.x, sense_pose.y, sense_pose.theta, self.max, map)
-    #print "Wall sense: ", wx, wy
-    if wx <0:  # no wall seen
-     #val = self.max
-     val = -0.13
-    else:
-      val = norm( [sense_pose.x-wx, sense_pose.y-wy] )
-      if noisy:
-        val += random.normal(0, self.noise)
-        if random.random() < self.failure:
-          return -0.14
-    #print
+  def ranges(self, dist, noisy = False):
+    """ Turns wall distances for the rays from rays() into one reading per pose """
+    val = dist.min(axis=0)  # closest return of the cone wins
+    seen = val < inf
+    val[~seen] = -0.13  # no wall seen
+    if noisy:
+      val[seen] += random.normal(0, self.noise, seen.sum())
+      val[seen & (random.random(len(val)) < self.failure)] = -0.14
     return val
 
 class Compass(Sensor):
@@ -65,6 +103,11 @@ class Compass(Sensor):
     Sensor.__init__(self, name)
     self.noise = noise
     self.gauss_var = 0.1
+    self.pdf = TabulatedPDF(self.gauss_var, pi, 0.001)
+
+  def log_likelihood(self, expected, measured):
+    """ Log-likelihood of one measured heading for an array of expected headings """
+    return self.pdf.log_prob((expected - measured + pi) % (2*pi) - pi)
 
   def sense(self, pose, map, noisy = False):
     val = pose.theta
@@ -72,7 +115,67 @@ class Compass(Sensor):
       val += random.normal(0, self.noise)
     return val
 
+  def sense_all(self, x, y, theta, map, noisy = False):
+    val = theta.copy()
+    if noisy:
+      val += random.normal(0, self.noise, len(val))
+    return val
+
 class Accelerometer(Sensor):
   def __init__(self, name):
     Sensor.__init__(self, name)
   
+
+def cast(sx, sy, stheta, max_dist, map):
+  """
+  Distance to the first wall for arrays of sensor poses, inf where nothing is in range
+
+  Looks the answer up in the map's precomputed ray table when it has one,
+  otherwise raycasts
+  """
+  table = getattr(map, 'raytable', None)
+  if table is not None:
+    dist = table.lookup(sx, sy, stheta)
+    return where(dist > max_dist, inf, dist)
+  return raycast.cast_rays(sx, sy, stheta, max_dist, map)
+
+def transform(offsets, x, y, theta, c = None, s = None):
+  """
+  World origin and heading of sensor rays for arrays of robot poses
+
+  offsets has one (x, y, theta) row per ray, relative to the robot center. Pass the
+  poses' cos/sin(theta) as c and s when they're already known (the particles cache
+  them). Returns x, y, theta arrays shaped (rays, N).
+  """
+  if c is None:
+    c = cos(theta)
+    s = sin(theta)
+  rx = offsets[:, 0:1]
+  ry = offsets[:, 1:2]
+  sx = x + rx * c - ry * s
+  sy = y + rx * s + ry * c
+  stheta = (theta + offsets[:, 2:3]) % (2*pi)
+  return sx, sy, stheta
+
+def sense_all(sensors, x, y, theta, map, noisy = False, c = None, s = None):
+  """
+  Batched sensing of every sensor in a sensor dict for arrays of robot poses
+
+  Every ray of every ultrasonic is placed with one transform() and cast together
+  in a single raycast pass. c and s are optional cached cos/sin(theta).
+  Returns a dict of sensor name -> array of readings
+  """
+  sensed = {}
+  sonar = [ (name, sensor) for name,sensor in sensors.items() if isinstance(sensor, Ultrasonic) ]
+  if sonar:
+    offsets = concatenate([ sensor.offsets for name,sensor in sonar ])
+    sx, sy, stheta = transform(offsets, x, y, theta, c, s)
+    max_dist = concatenate([ full((len(sensor.offsets), 1), sensor.max) for name,sensor in sonar ])
+    dist = cast(sx, sy, stheta, max_dist, map)
+    ends = cumsum([ len(sensor.offsets) for name,sensor in sonar ])
+    for (name,sensor),end in zip(sonar, ends):
+      sensed[name] = sensor.ranges(dist[end - len(sensor.offsets):end], noisy)
+  for name,sensor in sensors.items():
+    if name not in sensed:
+      sensed[name] = sensor.sense_all(x, y, theta, map, noisy)
+  return sensed
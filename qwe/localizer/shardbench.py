@@ -0,0 +1,59 @@
+#!/usr/bin/python
+
+# Time particle filter updates on the course map, single process vs sharded over workers
+
+import argparse
+import logging
+import sys
+import time
+
+from numpy import random
+
+import particles, sharded, map, raytable, robot
+import std_sensors, std_noise
+from pose import Pose
+
+sys.path.append('..')
+import mapping.map_class
+sys.modules['map_class'] = mapping.map_class  # deal with the fact we pickled a module in another dir
+import mapping.pickler
+
+parser = argparse.ArgumentParser(description='Sharded particle filter benchmark')
+parser.add_argument('-n', '--num', help='Number of particles', type=int, default=5000)
+parser.add_argument('-u', '--updates', help='Updates to time per configuration', type=int, default=20)
+parser.add_argument('-w', '--workers', help='Worker counts to try', type=int, nargs='+', default=[1, 2, 4])
+parser.add_argument('-m', '--map', help='Pickled course map', default='../mapping/map.pkl')
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.WARN)
+logger = logging.getLogger(__name__)
+
+themap = map.Map.from_map_class(mapping.pickler.unpickle_map(args.map), logger = logger)
+themap.raytable = raytable.RayTable(themap, logger = logger)
+start = Pose(20.0, 20.0, 0.0)
+
+def bench(workers):
+  random.seed(1)
+  simbot = robot.SimRobot(start, std_sensors.offset_str, std_noise.noise_params)
+  if workers:
+    loc = sharded.ShardedLocalizer(std_sensors.offset_str, std_noise.noise_params, themap, args.num, start,
+                                   logger = logger, workers = workers)
+  else:
+    loc = particles.ParticleLocalizer(std_sensors.offset_str, std_noise.noise_params, themap, args.num, start,
+                                      logger = logger)
+  t = time.time()
+  for i in range(args.updates):
+    simbot.move(0.05, 0.5)
+    loc.move(0.05, 0.5)
+    loc.update(simbot.sense(themap))
+  elapsed = time.time() - t
+  if workers:
+    loc.stop()
+  return elapsed
+
+print "%s, %d particles, %d updates" % (themap, args.num, args.updates)
+base = bench(0)
+print "  single process: %7.1f updates/s" % (args.updates / base)
+for workers in args.workers:
+  elapsed = bench(workers)
+  print "  %2d workers:     %7.1f updates/s  (%0.2fx)" % (workers, args.updates / elapsed, base / elapsed)
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+
+from numpy import frombuffer, random
+from multiprocessing import Process, Pipe, RawArray
+import traceback
+
+from particles import ParticleLocalizer
+
+# Particle filter spread over worker processes.
+#
+# The particle state block and the per-particle likelihood arrays live in shared
+# memory. Each worker owns a contiguous slice of the particles and runs move, sense
+# and likelihood on it; normalization and resampling stay in the parent, which
+# writes the next generation straight into the shared back buffer.
+#
+# Workers are forked once at startup and inherit the map and ray table, later map
+# changes are shipped to them as the changed wall rectangles, in order. Map.update()
+# has already built any ray table the new layout needs in the parent by then, so
+# workers only map it. Workers are daemonic and can't start a build Pool, so one that
+# does have to build a table (say it was pruned meanwhile) builds it in-process.
+
+def span(index, workers, pcount):
+  """ Slots [lo, hi) of the particle set handled by worker index """
+  return pcount * index // workers, pcount * (index + 1) // workers
+
+def patch_map(map, changes):
+  """ Replay a parent map update: changes is the full wall grid, or a list of (rect, walls) """
+  if isinstance(changes, list):
+    for (x1, y1, x2, y2), walls in changes:
+      map.data[y1:y2, x1:x2] = walls
+    rects = [rect for rect, walls in changes]
+  else:
+    map.set_data(changes)
+    rects = None
+  map.refresh(rects)
+
+def _worker(loc, index, workers, conn):
+  random.seed()  # don't replay the parent's noise stream in every worker
+  p = loc.p
+  if p.map.raytable:
+    p.map.raytable.procs = 1
+  while True:
+    cmd = conn.recv()
+    if cmd[0] == 'stop':
+      break
+    try:
+      if cmd[0] == 'map':
+        patch_map(p.map, cmd[1])
+      else:
+        op, front, pcount, args = cmd
+        p.front = front
+        p.resize(pcount)
+        lo, hi = span(index, workers, pcount)
+        part = p.shard(lo, hi)
+        if op == 'move':
+          part.move(*args)
+        elif op == 'measure':
+          part.particle_sense()
+          loc.likelihood(part, args, loc._log_lik[lo:hi], loc._raw_error[lo:hi])
+      conn.send(None)
+    except Exception:
+      conn.send(traceback.format_exc())
+  conn.close()
+
+class ShardedLocalizer(ParticleLocalizer):
+  """ ParticleLocalizer running move and sense/likelihood on a pool of worker processes """
+
+  def __init__(self, *args, **kwargs):
+    self.workers = kwargs.pop('workers', 2)
+    ParticleLocalizer.__init__(self, *args, **kwargs)
+    self.pending = []  # map updates the workers haven't seen yet
+    self.p.map.watchers.append(self.map_changed)
+    self.conns = []
+    self.procs = []
+    for i in range(self.workers):
+      conn, child = Pipe()
+      proc = Process(target=_worker, args=(self, i, self.workers, child))
+      proc.daemon = True
+      proc.start()
+      self.conns.append(conn)
+      self.procs.append(proc)
+    self.logger.debug("ShardedLocalizer: %d workers started" % self.workers)
+
+  def alloc(self, nbytes):
+    return RawArray('b', nbytes)
+
+  def array(self, n):
+    return frombuffer(RawArray('d', n))
+
+  def call(self, *cmd):
+    """ Run a command on every worker and wait for all of them to finish """
+    for conn in self.conns:
+      conn.send(cmd)
+    errors = [e for e in [conn.recv() for conn in self.conns] if e]
+    if errors:
+      raise RuntimeError("ShardedLocalizer worker failed:\n%s" % errors[0])
+
+  def map_changed(self, rects):
+    # snapshot what changed now, so workers replay exactly the parent's sequence of updates
+    data = self.p.map.data
+    if rects is None:
+      self.pending = [data.copy()]
+    else:
+      self.pending.append([((x1, y1, x2, y2), data[y1:y2, x1:x2].copy()) for x1, y1, x2, y2 in rects])
+
+  def sync_map(self):
+    for changes in self.pending:
+      self.call('map', changes)
+    if self.pending:
+      self.logger.debug("ShardedLocalizer: sent %d map updates to workers" % len(self.pending))
+    self.pending = []
+
+  def move(self, turn, move):
+    self.sync_map()
+    self.metrics.mark()
+    self.call('move', self.p.front, self.pcount, (turn, move))
+    self.metrics.lap('move')
+
+  def measure(self, measured):
+    self.sync_map()
+    self.call('measure', self.p.front, self.pcount, measured)
+
+  def stop(self):
+    for conn in self.conns:
+      conn.send(('stop',))
+    for proc in self.procs:
+      proc.join()
+    if self.map_changed in self.p.map.watchers:
+      self.p.map.watchers.remove(self.map_changed)
+    self.conns = []
+    self.procs = []
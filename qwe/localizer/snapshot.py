@@ -0,0 +1,135 @@
+#!/usr/bin/python
+
+from numpy import memmap, float32, float64, arctan2, sin, cos, cov, array, nan
+import os
+import sys
+import time
+
+from metrics import monotonic
+from pose import Pose
+
+# Latest particle cloud of a running localizer, for viewers in other processes.
+#
+# The file is a float64 header (layout version, sequence number, pose guess,
+# covariance, ...) followed by float32 rows of x, y, theta and weight for up to
+# capacity particles. The writer bumps the sequence number to odd before it
+# changes anything and back to even after, so a reader that sees the same even
+# number either side of its copy knows the copy is whole (a seqlock): readers
+# never block the localizer, and can poll at whatever rate they like.
+
+LAYOUT = 1
+HEADER = 32  # float64 slots, room to grow
+
+# header slots
+VERSION, SEQ, STAMP, UPDATES, COUNT, CAPACITY, GUESS_X, GUESS_Y, GUESS_THETA, COV = range(10)  # COV: 3x3, 9 slots
+ROWS = 4  # x, y, theta, weight
+
+def default_path():
+  shm = '/dev/shm'
+  return os.path.join(shm if os.path.isdir(shm) else '/tmp', 'qwe-localizer.snapshot')
+
+class Snapshot(object):
+  """ Shared memory particle snapshot, written at most rate times a second """
+
+  def __init__(self, path, capacity = None, rate = 10.0, readonly = False):
+    self.path = path
+    self.interval = 1.0 / rate if rate else 0.0
+    self.last = None
+    if readonly:
+      self.header = memmap(path, dtype=float64, mode='r', shape=(HEADER,))
+      if self.header[VERSION] != LAYOUT:
+        raise ValueError("%s: snapshot layout %d, expected %d" % (path, self.header[VERSION], LAYOUT))
+      capacity = int(self.header[CAPACITY])
+      mode = 'r'
+    else:
+      # grow the file in place rather than recreating it: a viewer that still has it
+      # mapped would fault on pages past the end of a file that was cut to zero
+      fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+      try:
+        size = HEADER * 8 + ROWS * capacity * 4
+        if os.fstat(fd).st_size < size:
+          os.ftruncate(fd, size)
+      finally:
+        os.close(fd)
+      mode = 'r+'
+      self.header = memmap(path, dtype=float64, mode=mode, shape=(HEADER,))
+    self.rows = memmap(path, dtype=float32, mode=mode, offset=HEADER * 8, shape=(ROWS, capacity))
+    self.capacity = capacity
+    if not readonly:
+      self.header[:] = nan
+      self.header[VERSION] = LAYOUT
+      self.header[SEQ] = 0
+      self.header[UPDATES] = self.header[COUNT] = 0
+      self.header[CAPACITY] = capacity
+
+  def publish(self, localizer, guess, force = False):
+    """ Copy out the localizer's particles and guess, unless the last copy was too recent; returns whether it did """
+    now = monotonic()
+    if not force and self.last is not None and now - self.last < self.interval:
+      return False
+    self.last = now
+    p = localizer.p
+    n = min(localizer.pcount, self.capacity)
+    w = localizer.weight[:n]
+    total = w.sum()
+    if total > 0:
+      # weighted covariance, with headings taken relative to the guess so they don't wrap
+      dtheta = arctan2(sin(p.theta[:n] - guess.theta), cos(p.theta[:n] - guess.theta))
+      c = cov(array([p.x[:n], p.y[:n], dtheta]), aweights = w / total, bias = True) if n > 1 else [nan] * 9
+    else:
+      c = [nan] * 9
+
+    h = self.header
+    h[SEQ] += 1  # odd: being written
+    self.rows[0, :n] = p.x[:n]
+    self.rows[1, :n] = p.y[:n]
+    self.rows[2, :n] = p.theta[:n]
+    self.rows[3, :n] = w
+    h[STAMP] = time.time()
+    h[UPDATES] = localizer.updates
+    h[COUNT] = n
+    h[GUESS_X:GUESS_THETA+1] = guess.x, guess.y, guess.theta
+    h[COV:COV+9] = array(c).ravel()
+    h[SEQ] += 1  # even: whole again
+    return True
+
+  def read(self, tries = 100):
+    """
+    A consistent copy of the latest snapshot, or None if nothing has been published
+    yet (or the writer kept getting in the way)
+
+    Returns a dict of seq, stamp, updates, guess (Pose), cov (3x3, x/y/theta) and
+    x, y, theta, weight arrays.
+    """
+    h = self.header
+    for i in range(tries):
+      seq = h[SEQ]
+      if seq == 0:
+        return None
+      if seq % 2:
+        time.sleep(0)  # mid write, let the writer finish
+        continue
+      head = array(h)
+      n = int(head[COUNT])
+      rows = array(self.rows[:, :n])
+      if h[SEQ] == seq:
+        return { 'seq': int(seq) // 2, 'stamp': head[STAMP], 'updates': int(head[UPDATES]),
+                 'guess': Pose(head[GUESS_X], head[GUESS_Y], head[GUESS_THETA]),
+                 'cov': head[COV:COV+9].reshape(3, 3),
+                 'x': rows[0], 'y': rows[1], 'theta': rows[2], 'weight': rows[3] }
+    return None
+
+def main():
+  path = sys.argv[1] if len(sys.argv) > 1 else default_path()
+  snap = Snapshot(path, readonly = True).read()
+  if snap is None:
+    print "%s: nothing published yet" % path
+    return
+  print "%s: snapshot %d, update %d, %0.2f s old" % (path, snap['seq'], snap['updates'], time.time() - snap['stamp'])
+  print "  %d particles, guess %s" % (len(snap['x']), snap['guess'])
+  print "  covariance (x, y, theta):"
+  for row in snap['cov']:
+    print "    %10.4f %10.4f %10.4f" % tuple(row)
+
+if __name__ == '__main__':
+  main()
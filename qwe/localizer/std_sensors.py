@@ -30,5 +30,13 @@ offset_str['right'] = Ultrasonic('right', Pose(+3.4,-5.0,-pi/2), ultra_noise, fa
 offset_str['back'] = Ultrasonic('back', Pose(-1.6,0.0,-pi), ultra_noise, failure = 0)
 offset_str['heading'] = Compass('heading', compass_noise)
 
+# same layout, scored with the likelihood-field model instead of raycasting
+offset_field = {}
+offset_field['front'] = Ultrasonic('front', Pose(+8.4,0.0,0.0), ultra_noise, failure = 0, model = 'field')
+offset_field['left'] = Ultrasonic('left', Pose(+3.4,5.0,pi/2), ultra_noise, failure = 0, model = 'field')
+offset_field['right'] = Ultrasonic('right', Pose(+3.4,-5.0,-pi/2), ultra_noise, failure = 0, model = 'field')
+offset_field['back'] = Ultrasonic('back', Pose(-1.6,0.0,-pi), ultra_noise, failure = 0, model = 'field')
+offset_field['heading'] = Compass('heading', compass_noise)
+
 default = offset_str
 #default = compass_only
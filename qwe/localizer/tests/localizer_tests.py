@@ -0,0 +1,1139 @@
+#!/usr/bin/env python
+
+# Standard library imports
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+import logging
+import Queue
+import numpy as np
+
+# Dict of error codes and their human-readable names
+errors = {100 : "ERROR_BAD_CWD"}
+errors.update(dict((v,k) for k,v in errors.iteritems())) # Converts errors to a two-way dict
+
+# Find path to ./qwe/localizer directory. Allows for flexibility in the location tests are fired from.
+if os.getcwd().endswith("qwe"):
+  path_to_localizer = "./localizer/"
+elif os.getcwd().endswith("qwe/localizer"):
+  path_to_localizer = "./"
+elif os.getcwd().endswith("qwe/localizer/tests"):
+  path_to_localizer = "../"
+else:
+  print "Error: Bad CWD"
+  sys.exit(errors["ERROR_BAD_CWD"])
+
+sys.path.insert(0, path_to_localizer) # Localizer modules import each other by bare name, ahead of the localizer package
+sys.path.append(path_to_localizer + "..") # Makes mapping imports work as if in qwe
+
+# Local module imports
+import map
+import raycast
+import raytable
+import distfield
+import freespace
+import probability
+import particles
+import sensors
+import sharded
+import mapping.map_class
+import histogram
+import localizer
+import recorder
+import metrics
+import snapshot
+import std_sensors
+import std_noise
+from pose import Pose
+
+logging.basicConfig(level=logging.WARN)
+logger = logging.getLogger("unittest")
+
+path_to_map = path_to_localizer + "maps/test3.map"
+
+def table_distances(table, x, y, k):
+  """Table entries for cells x, y and angle indexes k, in inches with inf for no wall"""
+  raw = np.array(table[k, y, x], dtype=float)
+  return np.where(raw == raytable.NO_WALL, np.inf, raw * 0.1)
+
+def exact_distances(m, x, y, theta, max_dist=196.0):
+  """Brute force distance (inches) from points x, y along theta to the nearest face of any wall cell, inf if none in range"""
+  wy, wx = np.nonzero(m.data == 1)
+  px = x[:, np.newaxis] / m.scale
+  py = y[:, np.newaxis] / m.scale
+  c = np.cos(theta)[:, np.newaxis]
+  s = np.sin(theta)[:, np.newaxis]
+  t_in = np.zeros((len(px), len(wx))) - np.inf
+  t_out = np.zeros((len(px), len(wx))) + np.inf
+  for p, d, lo in ((px, c, wx), (py, s, wy)):
+    with np.errstate(divide="ignore", invalid="ignore"):
+      ta = (lo - p) / d
+      tb = (lo + 1 - p) / d
+    along = np.abs(d) > 1e-12
+    inside = (lo <= p) & (p <= lo + 1)
+    t_in = np.maximum(t_in, np.where(along, np.minimum(ta, tb), np.where(inside, -np.inf, np.inf)))
+    t_out = np.minimum(t_out, np.where(along, np.maximum(ta, tb), np.where(inside, np.inf, -np.inf)))
+  t = np.where((t_in <= t_out) & (t_out >= 0), np.maximum(t_in, 0.0), np.inf).min(axis=1) * m.scale
+  return np.where(t > max_dist, np.inf, t)
+
+class TestRaycast(unittest.TestCase):
+
+  def setUp(self):
+    self.map = map.Map(path_to_map, 3.0, logger=logger)
+    self.map.data[10:14, 8:20] = 1
+    self.map.data[20:22, 25:27] = 1
+
+  def test_matches_raywall(self):
+    """Rays between cell centers stop in the wall cell raywall finds, unless the line only grazes a corner of that cell"""
+    m = self.map
+    rs = np.random.RandomState(0)
+    free = np.argwhere(m.data == 0)
+    for i in range(500):
+      y1, x1 = free[rs.randint(len(free))]
+      x2, y2 = rs.randint(0, m.xdim), rs.randint(0, m.ydim)
+      if (x1, y1) == (x2, y2):
+        continue
+      wx, wy = raycast.raywall(x1, y1, x2, y2, m)
+      theta = np.arctan2(y2 - y1, x2 - x1)
+      length = np.hypot(x2 - x1, y2 - y1) * m.scale
+      dist = raycast.cast_rays((x1 + 0.5) * m.scale, (y1 + 0.5) * m.scale, theta, length, m)
+      if dist < np.inf:
+        # Nudge past the face to find the cell the ray stopped in
+        hit = (int(x1 + 0.5 + (dist / m.scale + 1e-9) * np.cos(theta)), int(y1 + 0.5 + (dist / m.scale + 1e-9) * np.sin(theta)))
+      else:
+        hit = (-1, -1)
+      if hit == (wx, wy):
+        continue
+      # Both are right when the line runs exactly through a corner, they just break the tie differently
+      cx, cy = (wx, wy) if wx >= 0 else hit
+      corners = np.array([(cx + i, cy + j) for i in (0, 1) for j in (0, 1)]) - (x1 + 0.5, y1 + 0.5)
+      off_line = np.abs(corners[:, 0] * np.sin(theta) - corners[:, 1] * np.cos(theta))
+      self.assertLess(off_line.min(), 1e-6, "Ray {} to {} hit {} but raywall found {}".format((x1, y1), (x2, y2), hit,
+                      (wx, wy)))
+
+  def test_matches_exact(self):
+    """Random rays agree with a brute force intersection against every wall cell"""
+    rs = np.random.RandomState(1)
+    n = 2000
+    x, y = rs.uniform(0, self.map.x_inches, n), rs.uniform(0, self.map.y_inches, n)
+    theta = rs.uniform(0, 2 * np.pi, n)
+    free = self.map.data[(y / self.map.scale).astype(int), (x / self.map.scale).astype(int)] != 1
+    x, y, theta = x[free], y[free], theta[free]
+    dist = raycast.cast_rays(x, y, theta, 196.0, self.map)
+    exact = exact_distances(self.map, x, y, theta)
+    self.assertTrue(((dist < np.inf) == (exact < np.inf)).all())
+    self.assertTrue(np.allclose(dist[dist < np.inf], exact[exact < np.inf]))
+
+  def test_fractional_start(self):
+    """Distances run from the true start position to the wall face, not from the cell center"""
+    m = self.map
+    # Block spans x 24-60, y 30-42 inches
+    dist = raycast.cast_rays(np.array([10.3, 30.1, 45.0, 50.0]), np.array([35.2, 20.7, 55.5, 36.0]),
+                             np.array([0.0, np.pi/2, 3*np.pi/2, np.arctan2(6.0, 20.0)]), 196.0, m)
+    self.assertTrue(np.allclose(dist[:3], [24 - 10.3, 30 - 20.7, 55.5 - 42]), "Got {}".format(dist[:3]))
+    self.assertAlmostEqual(dist[3], 0.0) # Starts inside the block
+
+  def test_max_dist(self):
+    """Walls beyond max_dist read as inf"""
+    dist = raycast.cast_rays(np.array([10.3, 10.3]), np.array([35.2, 35.2]), 0.0, np.array([13.0, 14.0]), self.map)
+    self.assertEqual(dist[0], np.inf)
+    self.assertAlmostEqual(dist[1], 24 - 10.3)
+
+class TableTestCase(unittest.TestCase):
+  """Builds ray tables and distance fields in a scratch directory, so tests never touch localizer/tables"""
+
+  def setUp(self):
+    self.table_dir = tempfile.mkdtemp()
+    self.saved_table_dir = raytable.table_dir
+    raytable.table_dir = distfield.table_dir = self.table_dir
+    self.map = map.Map(path_to_map, 3.0, logger=logger)
+
+  def tearDown(self):
+    raytable.table_dir = distfield.table_dir = self.saved_table_dir
+    shutil.rmtree(self.table_dir)
+
+  def table_errors(self, table):
+    """Differences between a ray table and exact distances over every free cell and table angle"""
+    m = self.map
+    k, y, x = np.mgrid[0:table.shape[0], 0:m.ydim, 0:m.xdim]
+    free = m.data[y, x] != 1
+    k, y, x = k[free], y[free], x[free]
+    looked_up = table_distances(table, x, y, k)
+    exact = np.concatenate([exact_distances(m, (x[i:i+5000] + 0.5) * m.scale, (y[i:i+5000] + 0.5) * m.scale,
+                                            k[i:i+5000] * 2 * np.pi / table.shape[0]) for i in range(0, len(x), 5000)])
+    hit = exact < np.inf
+    self.assertTrue(((looked_up < np.inf) == hit).all(), "Ray table and exact distances disagree on whether a wall is in \
+      range")
+    return np.abs(looked_up[hit] - exact[hit])
+
+class TestRayTable(TableTestCase):
+
+  def test_matches_exact(self):
+    """Table entries agree with exact distances from cell centers, apart from rays that graze a wall corner"""
+    err = self.table_errors(raytable.RayTable(self.map, procs=1, logger=logger).table)
+    self.assertLess(np.median(err), 0.25, "Median table error {} inches".format(np.median(err)))
+    self.assertLess(np.percentile(err, 90), 1.0, "90th percentile table error {} inches".format(np.percentile(err, 90)))
+
+  def test_lookup_off_center(self):
+    """Lookups from anywhere in a cell are corrected to the sensor's actual position along the ray"""
+    table = raytable.RayTable(self.map, procs=1, logger=logger)
+    x = np.array([20.1, 21.0, 22.4, 50.2])
+    y = np.array([40.0, 40.9, 41.3, 30.7])
+    theta = np.array([0.0, np.pi/2, np.pi, 3*np.pi/2])
+    looked_up = table.lookup(x, y, theta)
+    exact = exact_distances(self.map, x, y, theta)
+    self.assertTrue(np.allclose(looked_up, exact, atol=0.06), "Expected {} but looked up {}".format(exact, looked_up))
+
+  def test_reuses_table_file(self):
+    """A second table for the same map maps the file the first one built"""
+    first = raytable.RayTable(self.map, procs=1, logger=logger)
+    second = raytable.RayTable(self.map, procs=1, logger=logger)
+    self.assertEqual(first.path, second.path)
+    self.assertEqual(os.listdir(self.table_dir), [os.path.basename(first.path)])
+
+  def test_default_logger(self):
+    """A table can be built without passing a logger"""
+    table = raytable.RayTable(self.map, procs=1)
+    table.refresh([(8, 10, 20, 14)])
+    self.assertTrue(os.path.exists(table.path))
+
+  def test_prunes_stale_tables(self):
+    """Saving a new table deletes all but the most recently used ones"""
+    keep = raytable.KEEP
+    raytable.KEEP = 3
+    try:
+      paths = []
+      for x in 8, 12, 16:
+        self.map.data[20, x] = 1 # a new wall layout needs a new table
+        paths.append(raytable.RayTable(self.map, procs=1, logger=logger).path)
+        os.utime(paths[-1], (len(paths), len(paths))) # ordered mtimes, whatever the file system's resolution
+      self.assertEqual(sorted(os.listdir(self.table_dir)), sorted(os.path.basename(p) for p in paths))
+      self.map.data[20, 20] = 1
+      newest = raytable.RayTable(self.map, procs=1, logger=logger).path
+      self.assertEqual(sorted(os.listdir(self.table_dir)), sorted(os.path.basename(p) for p in paths[1:] + [newest]))
+    finally:
+      raytable.KEEP = keep
+
+class TestMapRefresh(TableTestCase):
+
+  def setUp(self):
+    TableTestCase.setUp(self)
+    self.map.raytable = raytable.RayTable(self.map, procs=1, logger=logger)
+    self.map.distfield = distfield.DistanceField(self.map, logger=logger)
+    self.map.freespace = freespace.FreeSpace(self.map, 4.0, logger=logger)
+
+  def change(self, rect, value):
+    """Set a rect of the map to wall or free and refresh just that rect, like a zone update"""
+    x1, y1, x2, y2 = rect
+    self.map.data[y1:y2, x1:x2] = value
+    self.map.refresh([rect])
+
+  def assertPatchAccurate(self):
+    """The patched ray table is about as close to exact distances as a table built from scratch"""
+    patched = self.table_errors(self.map.raytable.table)
+    fresh = self.table_errors(raytable.RayTable(self.map, procs=1, logger=logger).table)
+    self.assertLess(patched.mean(), fresh.mean() + 0.1, "Patched table mean error {} inches, fresh {}".format(patched.mean(),
+                    fresh.mean()))
+    self.assertLess(np.percentile(patched, 90), np.percentile(fresh, 90) + 0.25, "Patched table 90th percentile error {} \
+      inches, fresh {}".format(np.percentile(patched, 90), np.percentile(fresh, 90)))
+
+  def assertFieldsFresh(self):
+    """The distance field and free space index match ones computed over the whole map"""
+    m = self.map
+    field = m.distfield.encode(distfield.distances(m.data == 1, m.distfield.max_cells))
+    self.assertTrue((m.distfield.field == field).all(), "Refreshed distance field differs from a full rebuild")
+    self.assertTrue((m.freespace.mask == m.freespace.free(0, 0, m.xdim, m.ydim)).all(), "Refreshed free space mask \
+      differs from a full rebuild")
+    self.assertTrue((m.freespace.index == np.flatnonzero(m.freespace.mask)).all())
+
+  def test_add_rect(self):
+    """A block of new wall is patched into the table"""
+    self.change((8, 10, 20, 14), 1)
+    self.assertTrue((self.map.raytable.table[:, 10:14, 8:20] == 0).all(), "Cells inside the new wall should read 0")
+    self.assertPatchAccurate()
+    self.assertFieldsFresh()
+
+  def test_small_rect(self):
+    """A wall block a couple of cells across is patched in too"""
+    self.change((25, 20, 27, 22), 1)
+    self.assertPatchAccurate()
+    self.assertFieldsFresh()
+
+  def test_clear_rect(self):
+    """Clearing a block again lets rays through to whatever is behind it"""
+    original = np.array(self.map.raytable.table)
+    self.change((8, 10, 20, 14), 1)
+    self.change((8, 10, 20, 14), 0)
+    self.assertPatchAccurate()
+    self.assertFieldsFresh()
+    changed = np.abs(np.array(self.map.raytable.table, dtype=int) - original) > 10
+    self.assertLess(changed.mean(), 0.05, "{:.1%} of table entries moved more than an inch".format(changed.mean()))
+
+  def test_mixed_rect_reloads(self):
+    """A rect that is only partly wall reloads the whole table for the new map"""
+    x1, y1, x2, y2 = rect = (8, 10, 20, 14)
+    self.map.data[y1, x1:x2] = 1
+    self.map.refresh([rect])
+    self.assertEqual(self.map.raytable.path, os.path.join(self.table_dir, "ray_%s.u16" % self.map.raytable.key()))
+    self.assertFieldsFresh()
+
+  def back_with_map_class(self):
+    """Give the test map a map_class grid to update() from, the way the course map has one"""
+    m = self.map
+    m.map_obj = mapping.map_class.MapClass(1.0 / m.scale, (m.ydim, m.xdim))
+    m.map_obj.grid['desc'][m.data == 1] = 8
+    self.updates = []
+    m.watchers.append(self.updates.append)
+
+  def test_update_dirty(self):
+    """update() refreshes the areas fillCoords changed"""
+    self.back_with_map_class()
+    self.map.map_obj.fillCoords((8, 10), (19, 13), {'desc': 8})
+    self.map.update()
+    self.assertEqual(self.updates, [[(8, 10, 20, 14)]])
+    self.assertTrue((self.map.data[10:14, 8:20] == 1).all())
+    self.assertPatchAccurate()
+    self.assertFieldsFresh()
+
+  def test_update_undirtied_change(self):
+    """A grid change fillCoords didn't see is still found and refreshed"""
+    self.back_with_map_class()
+    self.map.map_obj.grid['desc'][10:14, 8:20] = 8
+    self.map.update()
+    self.assertEqual(self.updates, [[(8, 10, 20, 14)]])
+    self.assertTrue((self.map.data[10:14, 8:20] == 1).all())
+    self.assertPatchAccurate()
+    self.assertFieldsFresh()
+    self.map.update()
+    self.assertEqual(self.updates[-1], [], "Nothing changed since the last update")
+
+class TestProbability(unittest.TestCase):
+
+  def test_logsumexp_very_negative(self):
+    """logsumexp stays finite and exact where a plain exp() would underflow to zero"""
+    a = np.array([-1000.0, -1001.0, -1002.0])
+    self.assertEqual(np.exp(a).sum(), 0.0)
+    expected = -1000.0 + np.log(1.0 + np.exp(-1.0) + np.exp(-2.0))
+    self.assertAlmostEqual(probability.logsumexp(a), expected, places=9)
+
+  def test_logsumexp_all_impossible(self):
+    self.assertEqual(probability.logsumexp(np.array([-np.inf, -np.inf])), -np.inf)
+    self.assertEqual(probability.logsumexp(np.array([-np.inf, 0.0])), 0.0)
+
+  def test_tabulated_matches_analytic(self):
+    """The table is within one grid step of the analytic log pdf"""
+    sigma, span, step = 3.0, 40.0, 0.25
+    pdf = probability.TabulatedPDF(sigma, span, step)
+    err = np.linspace(-span, span, 2001)
+    analytic = np.log(probability.ngaussian(0.0, sigma, err))
+    # rounding to the nearest grid point moves err by at most step/2
+    slope = np.abs(err) / sigma**2 + step / (2 * sigma**2)
+    tol = slope * step / 2 + 1e-9
+    self.assertTrue((np.abs(pdf.log_prob(err) - analytic) <= tol).all())
+
+  def test_tabulated_failure_floor(self):
+    """The failure component floors far errors, and errors past the span clamp to the edge"""
+    pdf = probability.TabulatedPDF(3.0, 40.0, 0.25, failure=0.01)
+    self.assertAlmostEqual(pdf.log_prob(np.array([0.0]))[0], np.log(0.99 + 0.01), places=9)
+    far = pdf.log_prob(np.array([-35.0, 39.0, 500.0, -500.0]))
+    self.assertTrue(np.allclose(far, np.log(0.01), atol=1e-6))
+
+class TestResample(unittest.TestCase):
+
+  def setUp(self):
+    self.map = map.Map(path_to_map, 3.0, logger=logger)
+    self.weight = np.array([0.35, 0.05, 0.2, 0.0, 0.12, 0.08, 0.02, 0.1, 0.03, 0.05])
+    self.n = len(self.weight)
+    self.loc = particles.ParticleLocalizer(std_sensors.offset_str, std_noise.noise_params, self.map, self.n,
+                                           Pose(30.0, 40.0, 0.0), logger=logger)
+
+  def resample(self):
+    """Resample the test weights, returns how many copies of each particle survived"""
+    loc = self.loc
+    loc.p.x[:] = np.arange(self.n) # Tag particles by index
+    loc.weight[:] = self.weight
+    loc.resample()
+    return np.bincount(loc.p.x.astype(int), minlength=self.n)
+
+  def test_systematic_counts(self):
+    """Every particle gets floor or ceil of its expected number of copies, whatever the random offset"""
+    for seed in range(50):
+      np.random.seed(seed)
+      counts = self.resample()
+      self.assertEqual(counts.sum(), self.n)
+      self.assertTrue((counts >= np.floor(self.n * self.weight)).all() and (counts <= np.ceil(self.n * self.weight)).all(),
+                      "Seed {}: expected about {} copies but got {}".format(seed, self.n * self.weight, counts))
+
+  def test_resets_weights(self):
+    """Survivors go into the back buffer and start over with equal weights"""
+    front = self.loc.p.front
+    self.resample()
+    self.assertNotEqual(self.loc.p.front, front, "Resampling should write into the back buffer and flip")
+    self.assertTrue(np.allclose(self.loc.weight, 1.0 / self.n))
+
+  def adaptive(self, spread):
+    """A KLD-sampling localizer with pmin 50 and pmax 2000, its particles spread over spread inches around one pose"""
+    np.random.seed(4)
+    loc = particles.ParticleLocalizer(std_sensors.offset_str, std_noise.noise_params, self.map, 500,
+                                      Pose(30.0, 40.0, 0.5), logger=logger, pmin=50, pmax=2000, kld_chunk=100)
+    loc.p.x[:] = 30.0 + np.random.uniform(0.0, spread, 500)
+    loc.p.y[:] = 40.0 + np.random.uniform(0.0, spread, 500)
+    loc.p.theta[:] = 0.5
+    self.drawn = []
+    systematic = loc.systematic
+    def counted(cdf, count):
+      self.drawn.append(count)
+      return systematic(cdf, count)
+    loc.systematic = counted
+    return loc
+
+  def assertSmallestPrefix(self, loc):
+    """The new particle count is the first at which the bins occupied so far satisfy the KLD bound"""
+    n = loc.pcount
+    bins = (loc.p.pose[:, :n] / loc.kld_bins).astype(int)
+    bins[2] %= int(round(2*np.pi / loc.kld_bins[2, 0]))
+    seen = set()
+    occupied = []
+    for b in zip(*bins):
+      seen.add(b)
+      occupied.append(len(seen))
+    bound = probability.kld_bound(np.array(occupied, dtype=float), loc.kld_err, loc.kld_z)
+    self.assertTrue(n >= bound[-1] or n == loc.pmax)
+    self.assertFalse(((np.arange(1, n) >= bound[:-1]) & (np.arange(1, n) >= loc.pmin)).any(),
+                     "The bound was already met before {} particles".format(n))
+
+  def test_kld_concentrated(self):
+    """A cloud in a single bin shrinks after drawing one chunk, not pmax"""
+    loc = self.adaptive(0.5)
+    loc.resample()
+    self.assertLess(loc.pcount, 100)
+    self.assertEqual(self.drawn, [100])
+    self.assertSmallestPrefix(loc)
+
+  def test_kld_spread(self):
+    """A spread out cloud grows chunk by chunk, stopping where the bound is met"""
+    loc = self.adaptive(8.0)
+    loc.resample()
+    self.assertTrue(100 < loc.pcount < 2000, "Expected somewhere between pmin and pmax, got {}".format(loc.pcount))
+    self.assertEqual(self.drawn, [100] * (loc.pcount // 100 + (loc.pcount % 100 > 0)))
+    self.assertSmallestPrefix(loc)
+    self.assertTrue(np.allclose(loc.weight, 1.0 / loc.pcount))
+
+  def test_kld_capped(self):
+    """A cloud too spread out for any count stops at pmax"""
+    loc = self.adaptive(60.0)
+    loc.p.theta[:] = np.random.uniform(0.0, 2*np.pi, 500)
+    loc.resample()
+    self.assertEqual(loc.pcount, 2000)
+    self.assertEqual(sum(self.drawn), 2000)
+
+class FakeSensor(object):
+  """Stands in for a sensor model, scoring every particle with a preset log-likelihood"""
+  model = 'beam'
+
+  def __init__(self, n):
+    self.loglik = np.zeros(n)
+
+  def log_likelihood(self, sensed, measured):
+    return self.loglik[:len(sensed)]
+
+class TestWeights(unittest.TestCase):
+
+  def setUp(self):
+    self.map = map.Map(path_to_map, 3.0, logger=logger)
+    self.n = 200
+    self.sensor = FakeSensor(self.n)
+    self.loc = particles.ParticleLocalizer({'fake': self.sensor}, std_noise.noise_params, self.map, self.n,
+                                           Pose(30.0, 40.0, 0.0), logger=logger, ess_threshold=0.5)
+    self.loc.p.particle_sense = lambda: None
+
+  def update(self, loglik):
+    self.sensor.loglik[:] = loglik
+    self.loc.update({'fake': 1.0})
+
+  def test_normalizes(self):
+    """Weights are the carried likelihoods normalized, even when every likelihood would underflow"""
+    np.random.seed(1)
+    first = np.random.uniform(-2000.0, -1990.0, self.n)
+    second = np.random.uniform(-1.0, 0.0, self.n)
+    self.loc.ess_threshold = 0.0 # never resample, so weights carry over
+    self.update(first)
+    self.update(second)
+    expected = np.exp(first + second - (first + second).max())
+    expected /= expected.sum()
+    self.assertAlmostEqual(self.loc.weight.sum(), 1.0, 5)
+    self.assertTrue(np.allclose(self.loc.weight, expected, rtol=1e-3))
+    self.assertTrue(np.allclose(self.loc.log_weight, np.log(expected), atol=1e-3))
+    self.assertTrue(np.isfinite(self.loc.score()))
+
+  def test_all_impossible(self):
+    """When no particle fits, weights go to zero and the next update starts from uniform"""
+    self.update(np.zeros(self.n) - np.inf)
+    self.assertEqual(self.loc.weight.sum(), 0.0)
+    self.assertEqual(self.loc.ess, 0.0)
+    self.assertTrue(np.allclose(self.loc.log_weight, -np.log(self.n)))
+    self.update(np.zeros(self.n))
+    self.assertTrue(np.allclose(self.loc.weight, 1.0 / self.n))
+
+  def test_uniform_skips_resample(self):
+    """Equal likelihoods leave ESS at the particle count, so nothing is resampled"""
+    x = np.array(self.loc.p.x)
+    for i in range(3):
+      self.update(np.zeros(self.n))
+    self.assertAlmostEqual(self.loc.ess / self.n, 1.0, 5)
+    self.assertEqual(self.loc.resamples, 0)
+    self.assertEqual(self.loc.updates, 3)
+    self.assertTrue((self.loc.p.x == x).all())
+
+  def test_degenerate_resamples(self):
+    """One particle holding all the weight drops ESS to about 1 and triggers a resample"""
+    loglik = np.zeros(self.n) - 50.0
+    loglik[7] = 0.0
+    x = self.loc.p.x[7]
+    self.update(loglik)
+    self.assertEqual(self.loc.resamples, 1)
+    self.assertTrue((self.loc.p.x == x).all(), "Only the one good particle should survive")
+    self.assertTrue(np.allclose(self.loc.weight, 1.0 / self.n))
+    self.assertTrue(np.allclose(self.loc.log_weight, -np.log(self.n)))
+
+  def test_gating_off(self):
+    """Without a threshold every update resamples, as before"""
+    self.loc.ess_threshold = None
+    self.update(np.zeros(self.n))
+    self.update(np.zeros(self.n))
+    self.assertEqual(self.loc.resamples, 2)
+
+class TestSharded(TableTestCase):
+
+  def setUp(self):
+    TableTestCase.setUp(self)
+    self.noise = {'move': 0.0, 'turn': 0.0} # noiseless, so worker moves are deterministic too
+    self.measured = {'front': 20.0, 'left': 12.0, 'right': 30.0, 'back': 8.0, 'heading': 0.5}
+    self.single = self.localizer(particles.ParticleLocalizer)
+    self.sharded = self.localizer(sharded.ShardedLocalizer, workers=2)
+
+  def tearDown(self):
+    self.sharded.stop()
+    TableTestCase.tearDown(self)
+
+  def localizer(self, cls, **kwargs):
+    np.random.seed(5)
+    m = map.Map(path_to_map, 3.0, logger=logger)
+    m.raytable = raytable.RayTable(m, procs=2, logger=logger)
+    return cls(std_sensors.offset_str, self.noise, m, 301, logger=logger, ess_threshold=0.5, **kwargs)
+
+  def assertSame(self):
+    a, b = self.single, self.sharded
+    self.assertEqual(a.pcount, b.pcount)
+    self.assertTrue((a.p.state == b.p.state).all())
+    self.assertTrue(np.allclose(a.log_lik, b.log_lik))
+    self.assertTrue(np.allclose(a.weight, b.weight))
+    self.assertEqual((a.ess > 0, a.resamples), (b.ess > 0, b.resamples))
+
+  def step(self, turn, forward):
+    for loc in self.single, self.sharded:
+      np.random.seed(11) # resampling draws in the parent
+      loc.move(turn, forward)
+      loc.update(self.measured)
+
+  def test_matches_single_process(self):
+    """Two workers move, sense and weigh their halves exactly like one process doing all of them"""
+    self.step(0.0, 0.0)
+    self.assertSame()
+    self.step(0.3, 4.0)
+    self.step(-1.0, 2.5)
+    self.assertSame()
+
+  def test_map_change(self):
+    """Workers replay a zone change before the next update"""
+    self.step(0.0, 0.0)
+    rect = (8, 10, 20, 14)
+    for loc in self.single, self.sharded:
+      m = loc.p.map
+      m.data[10:14, 8:20] = 1
+      m.refresh([rect]) # what update() does before telling the watchers
+      for watcher in m.watchers:
+        watcher([rect])
+    self.step(0.5, 3.0)
+    self.assertSame()
+
+  def test_worker_builds_table(self):
+    """A worker left to build the table for a new layout itself does so without a Pool"""
+    self.step(0.0, 0.0)
+    rect = (8, 10, 20, 14)
+    for loc in self.single, self.sharded:
+      m = loc.p.map
+      m.data[10, 8:20] = 1 # only partly wall, so the table is reloaded
+      if loc is self.single:
+        m.refresh([rect])
+      for watcher in m.watchers:
+        watcher([rect])
+    # the sharded parent never refreshed, and the single one's table is gone, so the workers find no table for the
+    # new layout
+    os.remove(self.single.p.map.raytable.path)
+    self.step(0.5, 3.0)
+    self.assertSame()
+
+class TestDistanceField(TableTestCase):
+
+  def brute_distances(self, walls, max_cells):
+    """Distance from every cell to every wall cell, keeping the nearest"""
+    wy, wx = np.nonzero(walls)
+    y, x = np.mgrid[0:walls.shape[0], 0:walls.shape[1]]
+    d = np.hypot(x[..., np.newaxis] - wx, y[..., np.newaxis] - wy)
+    return np.minimum(d.min(axis=2) if len(wx) else max_cells, max_cells)
+
+  def test_distances_exact(self):
+    """The separable transform matches brute force, clamped at max_cells"""
+    np.random.seed(3)
+    for density, max_cells in (0.02, 5), (0.1, 3), (0.005, 40), (0.0, 4):
+      walls = np.random.random_sample((23, 31)) < density
+      self.assertTrue(np.allclose(distfield.distances(walls, max_cells), self.brute_distances(walls, max_cells)))
+
+  def test_map_field(self):
+    """The field over the test map is the encoded brute force distance"""
+    field = distfield.DistanceField(self.map, logger=logger)
+    walls = self.map.data == 1
+    self.assertTrue((field.field == field.encode(self.brute_distances(walls, field.max_cells))).all())
+    self.assertTrue((field.field[walls] == 0).all())
+
+  def test_lookup(self):
+    field = distfield.DistanceField(self.map, logger=logger)
+    y, x = np.nonzero(self.map.data != 1)
+    self.assertTrue(np.allclose(field.lookup((x + 0.5) * self.map.scale, (y + 0.5) * self.map.scale), field.field[y, x] * 0.1))
+    self.assertTrue((field.lookup(np.array([-1.0, 1e4]), np.array([5.0, 5.0])) == field.max_dist).all())
+
+  def test_field_log_likelihood(self):
+    """Endpoints on a wall score the peak, far ones the failure floor, and max range readings nothing"""
+    self.map.distfield = distfield.DistanceField(self.map, logger=logger)
+    sensor = sensors.Ultrasonic('front', Pose(0.0, 0.0, 0.0), failure=0.1, model='field')
+    dist = np.array([0.0, 3.0, 12.0])
+    logp = sensor.field_log_likelihood(dist, 50.0, self.map)
+    self.assertAlmostEqual(logp[0], 0.0, 6)
+    self.assertAlmostEqual(logp[1], np.logaddexp(np.log(0.9) - 3.0**2 / (2 * sensor.gauss_var**2), np.log(0.1)), 6)
+    self.assertAlmostEqual(logp[2], np.logaddexp(np.log(0.9) - 12.0**2 / (2 * sensor.gauss_var**2), np.log(0.1)), 6)
+    self.assertTrue((sensor.field_log_likelihood(dist, sensor.max, self.map) == 0.0).all())
+
+  def test_endpoint_distance(self):
+    """A reading that ends right on a wall scores that wall, one that stops short scores the gap"""
+    self.map.distfield = distfield.DistanceField(self.map, logger=logger)
+    sensor = sensors.Ultrasonic('front', Pose(0.0, 0.0, 0.0), model='field')
+    x, y, theta = np.array([30.0, 30.0]), np.array([40.0, 40.0]), np.array([0.0, 0.0])
+    wall = exact_distances(self.map, x[:1], y[:1], theta[:1])[0]
+    dist = sensor.endpoint_distance(x, y, theta, wall + 0.1, self.map)
+    self.assertLess(dist[0], self.map.scale)
+    dist = sensor.endpoint_distance(x, y, theta, wall - 6.0, self.map)
+    self.assertGreater(dist[0], 6.0 - self.map.scale)
+
+class TestFreeSpace(TableTestCase):
+
+  def setUp(self):
+    TableTestCase.setUp(self)
+    self.map.distfield = distfield.DistanceField(self.map, logger=logger)
+    self.space = freespace.FreeSpace(self.map, 4.0, logger=logger)
+    self.map.freespace = self.space
+
+  def clearance(self, x, y):
+    """Exact distance (inches) from the cells holding (x, y) to the nearest wall surface"""
+    m = self.map
+    wy, wx = np.nonzero(m.data == 1)
+    cx, cy = np.floor(x / m.scale), np.floor(y / m.scale)
+    d = np.hypot(cx[:, np.newaxis] - wx, cy[:, np.newaxis] - wy).min(axis=1)
+    return (d - 0.5) * m.scale
+
+  def test_sample_clearance(self):
+    """Every sample lands on the map, off the walls and at least the footprint radius from them"""
+    np.random.seed(2)
+    x, y, theta = self.space.sample(5000)
+    m = self.map
+    self.assertTrue(((0 <= x) & (x < m.x_inches) & (0 <= y) & (y < m.y_inches)).all())
+    self.assertTrue(((0 <= theta) & (theta < 2 * np.pi)).all())
+    self.assertGreaterEqual(self.clearance(x, y).min(), self.space.radius - 0.05)
+    # and only cells that close to a wall are left out
+    cy, cx = np.mgrid[0:m.ydim, 0:m.xdim]
+    clear = self.clearance((cx.ravel() + 0.5) * m.scale, (cy.ravel() + 0.5) * m.scale) >= self.space.radius + 0.05
+    self.assertTrue(self.space.mask.ravel()[clear].all())
+
+  def test_sample_out(self):
+    """Samples can be written straight into a block of particle state"""
+    out = np.zeros((3, 100), dtype=np.float32)
+    self.assertIs(self.space.sample(100, out), out)
+    self.assertTrue((out[0] > 0).any())
+
+  def test_refresh_after_add(self):
+    """Refreshing after a block of wall is added drops the cells in and around it"""
+    rect = (8, 10, 20, 14)
+    self.map.data[10:14, 8:20] = 1
+    self.map.refresh([rect])
+    self.assertFalse(self.space.mask[10:14, 8:20].any())
+    self.assertTrue((self.space.mask == self.space.free(0, 0, self.map.xdim, self.map.ydim)).all())
+    np.random.seed(4)
+    x, y, theta = self.space.sample(5000)
+    self.assertGreaterEqual(self.clearance(x, y).min(), self.space.radius - 0.05)
+
+class TestCone(unittest.TestCase):
+
+  def setUp(self):
+    self.map = map.Map(path_to_map, 3.0, logger=logger)
+    self.x = np.array([30.0, 70.5, 15.0, 50.0])
+    self.y = np.array([40.0, 20.5, 70.0, 45.0])
+    self.theta = np.array([0.3, 2.0, 4.5, 0.0])
+
+  def test_fan(self):
+    """cone_rays rays are spread evenly across cone_width, centered on the sensor heading"""
+    sensor = sensors.Ultrasonic("front", Pose(8.4, 0.0, 0.1), cone=True, cone_width=0.6, cone_rays=5)
+    sx, sy, stheta = sensor.rays(np.zeros(1), np.zeros(1), np.zeros(1))
+    self.assertEqual(stheta.shape, (5, 1))
+    self.assertTrue(np.allclose(stheta[:, 0], np.array([-0.2, -0.05, 0.1, 0.25, 0.4]) % (2*np.pi)))
+    self.assertTrue((sx == 8.4).all() and (sy == 0.0).all())
+
+  def test_closest_ray_wins(self):
+    """A cone reads the closest return of its rays, each cast on its own"""
+    sensor = sensors.Ultrasonic("front", Pose(8.4, 0.0, 0.0), cone=True, cone_width=np.pi/4, cone_rays=7)
+    readings = sensor.sense_all(self.x, self.y, self.theta, self.map)
+    sx, sy, stheta = sensor.rays(self.x, self.y, self.theta)
+    for i in range(len(self.x)):
+      expected = min(sensors.cast(sx[k, i:i+1], sy[k, i:i+1], stheta[k, i:i+1], sensor.max, self.map)[0] for k in range(7))
+      self.assertAlmostEqual(readings[i], expected, 6)
+
+  def test_single_ray_is_beam(self):
+    """A one ray cone reads the same as a plain beam"""
+    cone = sensors.Ultrasonic("front", Pose(8.4, 0.0, 0.0), cone=True, cone_rays=1)
+    beam = sensors.Ultrasonic("front", Pose(8.4, 0.0, 0.0))
+    self.assertTrue((cone.sense_all(self.x, self.y, self.theta, self.map) == \
+                     beam.sense_all(self.x, self.y, self.theta, self.map)).all())
+
+  def test_batched_sensing(self):
+    """sense_all for a sensor dict with cones matches sensing each sensor on its own"""
+    layout = dict((name, s) for name,s in std_sensors.centered_cone.items())
+    layout["heading"] = std_sensors.offset_str["heading"]
+    batched = sensors.sense_all(layout, self.x, self.y, self.theta, self.map)
+    for name,sensor in layout.items():
+      self.assertTrue(np.allclose(batched[name], sensor.sense_all(self.x, self.y, self.theta, self.map)),
+                      "Batched {} readings differ".format(name))
+
+class TestGridLocalizer(unittest.TestCase):
+
+  def setUp(self):
+    self.map = map.Map(path_to_map, 3.0, logger=logger)
+    self.grid = histogram.GridLocalizer(std_sensors.offset_str, std_noise.noise_params, self.map, cell=3.0, angles=36,
+                                        logger=logger)
+
+  def sense(self, pose):
+    """Noise free readings of the standard sensors from pose"""
+    readings = sensors.sense_all(std_sensors.offset_str, np.array([pose.x]), np.array([pose.y]), np.array([pose.theta]),
+                                 self.map)
+    return dict((name, value[0]) for name,value in readings.items())
+
+  def test_global_localization(self):
+    """One update from a uniform belief puts the mode within a couple of cells and a heading bin of the robot"""
+    for pose in (Pose(30.0, 40.0, 0.3), Pose(70.5, 20.5, 2.0), Pose(15.0, 70.0, 4.5)):
+      self.grid.belief[:] = self.grid.free / self.grid.free.sum()
+      self.grid.update(self.sense(pose))
+      mode = self.grid.mode()
+      self.assertLess(np.hypot(mode.x - pose.x, mode.y - pose.y), 2 * self.grid.cell, "Expected {} but mode is {}".format(pose,
+                      mode))
+      self.assertLess(abs((mode.theta - pose.theta + np.pi) % (2 * np.pi) - np.pi), self.grid.step)
+
+  def test_move(self):
+    """Motion carries a concentrated belief along its heading layer, turning moves it between layers"""
+    grid = self.grid
+    grid.belief[:] = 0.0
+    grid.belief[0, 10, 10] = 1.0
+    grid.move(0.0, 2 * grid.cell)
+    mode = grid.mode()
+    self.assertEqual((mode.x, mode.y, mode.theta), ((12 + 0.5) * grid.cell, (10 + 0.5) * grid.cell, 0.0))
+    grid.move(np.pi / 2, 0.0)
+    self.assertAlmostEqual(grid.mode().theta, np.pi / 2)
+    self.assertAlmostEqual(grid.belief.sum(), 1.0)
+
+  def test_map_change(self):
+    """Cells that become wall lose their belief"""
+    grid = self.grid
+    self.map.data[10:14, 8:20] = 1
+    # The test map isn't backed by a map_class, so tell the watchers what update() would have
+    for watcher in self.map.watchers:
+      watcher([(8, 10, 20, 14)])
+    self.assertEqual(grid.belief[:, 10:14, 8:20].sum(), 0.0)
+    self.assertAlmostEqual(grid.belief.sum(), 1.0)
+
+  def test_shift_helpers(self):
+    """Fractional shifts interpolate, wrapped shifts and blurs keep all the mass"""
+    a = np.zeros(10)
+    a[3] = 1.0
+    self.assertTrue(np.allclose(histogram.interpolate(a, 1.25, 0), np.eye(10)[4] * 0.75 + np.eye(10)[5] * 0.25))
+    self.assertAlmostEqual(histogram.interpolate(a, 8.5, 0, wrap=True).sum(), 1.0)
+    self.assertAlmostEqual(histogram.blur(a, 1.0, 0, wrap=True).sum(), 1.0)
+    self.assertEqual(histogram.translate(a, -4, 0).sum(), 0.0)
+
+class TestCoalesce(unittest.TestCase):
+
+  def test_compose(self):
+    """The turn, move, turn from compose ends where the burst of moves does"""
+    np.random.seed(0)
+    for burst in range(20):
+      msgs = [{"dTheta" : t, "dXY" : d} for t,d in zip(np.random.uniform(-1, 1, 5), np.random.uniform(-2, 3, 5))]
+      x = y = theta = 0.0
+      for msg in msgs:
+        theta += msg["dTheta"]
+        x += msg["dXY"] * np.cos(theta)
+        y += msg["dXY"] * np.sin(theta)
+      turn, move, final = localizer.compose(msgs)
+      self.assertAlmostEqual(move * np.cos(turn), x)
+      self.assertAlmostEqual(move * np.sin(turn), y)
+      self.assertAlmostEqual(turn + final, theta)
+      self.assertGreaterEqual(move, 0.0)
+
+  def test_compose_turn_in_place(self):
+    """Turns with no net displacement come out as a single turn"""
+    self.assertEqual(localizer.compose([{"dTheta" : 0.5, "dXY" : 0.0}, {"dTheta" : 0.25, "dXY" : 0.0}]), (0.0, 0.0, 0.75))
+
+  def test_drain(self):
+    """Everything already queued comes out in one batch, up to and including a die"""
+    q = Queue.Queue()
+    for item in ["a", "b", "die", "c"]:
+      q.put(item)
+    self.assertEqual(localizer.drain(q), ["a", "b", "die"])
+    self.assertEqual(localizer.drain(q), ["c"])
+
+  def test_drain_idle(self):
+    """idle runs while nothing is queued and more work is left, then drain blocks as usual"""
+    q = Queue.Queue()
+    calls = []
+    def idle():
+      calls.append(1)
+      if len(calls) == 3:
+        q.put("msg")
+      return True
+    self.assertEqual(localizer.drain(q, idle), ["msg"])
+    self.assertEqual(len(calls), 3)
+
+class TestRecorder(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, "test.rec")
+    self.records = [(recorder.START, {"x" : 1.0, "y" : 2.0, "theta" : 0.5}),
+                    (recorder.ZONES, {"zones" : {"A" : 1}, "zone_change" : 3}),
+                    (recorder.MSGS, [{"dTheta" : 0.1, "dXY" : 1.5, "sensorData" : {"heading" : 0.2}}, "die"]),
+                    (recorder.POSE, {"x" : 1.5, "y" : 2.1, "theta" : 0.6})]
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def write(self):
+    rec = recorder.Recorder(self.path, logger=logger)
+    for kind, payload in self.records:
+      rec.write(kind, payload)
+    rec.close()
+
+  def test_round_trip(self):
+    """Records read back in order with the kinds and payloads they were written with"""
+    self.write()
+    read = list(recorder.read(self.path))
+    self.assertEqual([(kind, payload) for kind, stamp, payload in read], self.records)
+    stamps = [stamp for kind, stamp, payload in read]
+    self.assertEqual(stamps, sorted(stamps))
+
+  def test_appends(self):
+    """A second recorder on the same file adds to it"""
+    self.write()
+    self.write()
+    self.assertEqual(len(list(recorder.read(self.path))), 2 * len(self.records))
+
+  def test_torn_record(self):
+    """A log cut off in the middle of its last record still reads up to the record before"""
+    self.write()
+    size = os.path.getsize(self.path)
+    with open(self.path, "r+b") as f:
+      f.truncate(size - 3)
+    self.assertEqual([(kind, payload) for kind, stamp, payload in recorder.read(self.path)], self.records[:-1])
+
+class TestMetrics(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, "test.metrics")
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def fill(self, m, count):
+    for i in range(count):
+      m.set("pcount", i)
+      m.set("sense", i * 0.001)
+      m.commit()
+
+  def test_ring(self):
+    """The ring keeps the last committed values, oldest first, less the slot open for the next update"""
+    m = metrics.Metrics(size=8)
+    self.fill(m, 5)
+    self.assertEqual(m.count, 5)
+    self.assertEqual(m.recent("pcount"), [0, 1, 2, 3, 4])
+    self.fill(m, 6)
+    self.assertEqual(m.count, 11)
+    self.assertEqual(m.recent("pcount"), [4, 0, 1, 2, 3, 4, 5])
+    self.assertEqual(m.recent("ess"), [], "Fields nobody set stay empty")
+
+  def test_committed(self):
+    """A value set for the committed update lands in its slot, not the open one"""
+    m = metrics.Metrics(size=4)
+    self.fill(m, 3)
+    m.set("guess", 0.5, committed=True)
+    self.assertEqual(m.recent("guess"), [0.5])
+    m.commit()
+    self.assertEqual(m.recent("guess"), [0.5], "Nothing was set for the update just committed")
+
+  def test_shared_file(self):
+    """A read only Metrics on the same file sees what the writer committed"""
+    m = metrics.Metrics(size=16, path=self.path)
+    self.fill(m, 20)
+    reader = metrics.Metrics(path=self.path, readonly=True)
+    self.assertEqual(reader.size, 16)
+    self.assertEqual(reader.count, 20)
+    self.assertEqual(reader.recent("pcount"), m.recent("pcount"))
+
+  def test_restarted_writer(self):
+    """A new writer on a live file starts the rings over in place, without cutting the file under a reader"""
+    m = metrics.Metrics(size=16, path=self.path)
+    self.fill(m, 20)
+    reader = metrics.Metrics(path=self.path, readonly=True)
+    inode = os.stat(self.path).st_ino
+    m = metrics.Metrics(size=8, path=self.path)
+    self.assertEqual(os.stat(self.path).st_ino, inode)
+    self.assertEqual(m.size, 16, "The ring should keep the size the file already has")
+    self.assertEqual(reader.count, 0)
+    self.assertEqual(reader.recent("pcount"), [])
+    self.fill(m, 3)
+    self.assertEqual(reader.recent("pcount"), [0, 1, 2])
+    m = metrics.Metrics(size=32, path=self.path)
+    self.assertEqual(os.path.getsize(self.path), (len(metrics.FIELDS) + 1) * 32 * 8)
+
+  def test_summary(self):
+    """summary() reports the last value, mean and percentiles, timings in milliseconds"""
+    m = metrics.Metrics(size=128)
+    self.fill(m, 101)
+    summary = m.summary()
+    self.assertEqual(summary["updates"], 101)
+    self.assertNotIn("ess", summary)
+    pcount = summary["pcount"]
+    self.assertEqual(pcount["last"], 100)
+    self.assertAlmostEqual(pcount["mean"], 50.0)
+    self.assertAlmostEqual(pcount["p50"], 50.0)
+    self.assertAlmostEqual(pcount["p90"], 90.0)
+    self.assertAlmostEqual(pcount["p99"], 99.0)
+    self.assertAlmostEqual(summary["sense"]["p90"], 90.0)
+    self.assertAlmostEqual(summary["sense"]["last"], 100.0)
+
+class TestMap(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.map = map.Map(path_to_map, 3.0, logger=logger)
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_loads_csv(self):
+    """A .map file loads bottom row first, the same as parsing the CSV by hand"""
+    rows = [[int(v) for v in line.split(",")] for line in open(path_to_map).read().split()]
+    self.assertTrue((self.map.data == np.array(rows[::-1])).all())
+
+  def test_layout(self):
+    """The wall grid is a contiguous uint8 array with a bool view over the same memory"""
+    m = self.map
+    self.assertEqual(m.data.dtype, np.uint8)
+    self.assertTrue(m.data.flags["C_CONTIGUOUS"])
+    self.assertEqual(m.walls.dtype, np.bool_)
+    self.assertTrue((m.walls == (m.data == 1)).all())
+    m.data[5, 7] = 1
+    self.assertTrue(m.walls[5, 7], "In-place patches of data should show through walls")
+
+  def test_dims(self):
+    """The cached extents match the grid"""
+    m = self.map
+    self.assertEqual((m.ydim, m.xdim), m.data.shape)
+    self.assertEqual((m.x_inches, m.y_inches), (m.xdim * 3.0, m.ydim * 3.0))
+    m.set_data(np.ones((4, 6), dtype=int))
+    self.assertEqual((m.xdim, m.ydim, m.x_inches, m.y_inches), (6, 4, 18.0, 12.0))
+    self.assertEqual(m.data.dtype, np.uint8)
+
+  def test_npy_round_trip(self):
+    """save() writes a .npy that loads back to the same grid and extents"""
+    path = os.path.join(self.dir, "test3.npy")
+    self.map.save(path)
+    loaded = map.Map(path, 3.0, logger=logger)
+    self.assertTrue((loaded.data == self.map.data).all())
+    self.assertEqual(loaded.data.dtype, np.uint8)
+    self.assertTrue(loaded.data.flags["C_CONTIGUOUS"])
+    self.assertEqual((loaded.xdim, loaded.ydim, loaded.x_inches, loaded.y_inches),
+                     (self.map.xdim, self.map.ydim, self.map.x_inches, self.map.y_inches))
+
+  def test_xy(self):
+    """xy() lists wall cell centers"""
+    m = self.map
+    expected = [[x + 0.5, y + 0.5] for y in range(m.ydim) for x in range(m.xdim) if m.data[y][x] == 1]
+    self.assertEqual(m.xy().tolist(), expected)
+
+class TestBudget(unittest.TestCase):
+
+  def setUp(self):
+    self.map = map.Map(path_to_map, 3.0, logger=logger)
+    pose = Pose(30.0, 40.0, 0.3)
+    readings = sensors.sense_all(std_sensors.offset_str, np.array([pose.x]), np.array([pose.y]), np.array([pose.theta]),
+                                 self.map)
+    self.measured = dict((name, value[0]) for name,value in readings.items())
+
+  def localizer(self, budget):
+    np.random.seed(9)
+    # never resample, so weights can be compared particle for particle
+    return particles.ParticleLocalizer(std_sensors.offset_str, std_noise.noise_params, self.map, 400, Pose(30.0, 40.0, 0.3),
+                                       logger=logger, ess_threshold=0.0, budget=budget, chunk=50)
+
+  def by_particle(self, loc):
+    """Weights and likelihoods in a fixed particle order, whatever shuffling the update did"""
+    order = np.lexsort((loc.p.theta, loc.p.y, loc.p.x))
+    return loc.p.pose[:, order], loc.weight[order], loc.log_lik[order]
+
+  def test_tiny_budget(self):
+    """A budget too small for anything senses just one chunk, the estimate goes by that chunk"""
+    loc = self.localizer(1e-9)
+    loc.update(self.measured)
+    self.assertEqual(loc.partial[1], loc.chunk)
+    self.assertEqual(loc.updates, 0)
+    self.assertTrue((loc.weight[loc.chunk:] == 0).all())
+    self.assertAlmostEqual(loc.weight.sum(), 1.0, 5)
+    guess = loc.guess()
+    self.assertTrue(np.isfinite([guess.x, guess.y, guess.theta]).all())
+    self.assertTrue(np.isfinite(loc.score()))
+
+  def test_work_finishes(self):
+    """work() senses the rest chunk by chunk and ends up where a full update does"""
+    full = self.localizer(None)
+    full.update(self.measured)
+    loc = self.localizer(1e-9)
+    loc.update(self.measured)
+    chunks = 2 # the one update() sensed and the last, after which work() has nothing left
+    while loc.work():
+      chunks += 1
+    self.assertEqual(chunks, loc.pcount // loc.chunk)
+    self.assertIsNone(loc.partial)
+    self.assertEqual((loc.updates, loc.cut_short), (1, 0))
+    for a, b in zip(self.by_particle(full), self.by_particle(loc)):
+      self.assertTrue(np.allclose(a, b, atol=1e-6))
+
+  def test_settle(self):
+    """Settling early weighs unsensed particles by the mean likelihood, keeping their relative weights"""
+    loc = self.localizer(1e-9)
+    loc.update(self.measured)
+    loc.work()
+    done = loc.partial[1]
+    sensed = np.array(loc.log_lik[:done])
+    prior = np.array(loc.log_weight)
+    loc.settle()
+    self.assertIsNone(loc.partial)
+    self.assertEqual((loc.updates, loc.cut_short), (1, 1))
+    mean = probability.logsumexp(sensed) - np.log(done)
+    self.assertTrue(np.allclose(loc.log_lik[done:], mean))
+    expected = prior + np.concatenate((sensed, np.zeros(loc.pcount - done) + mean))
+    expected = np.exp(expected - probability.logsumexp(expected))
+    self.assertTrue(np.allclose(loc.weight, expected, atol=1e-6))
+
+  def test_move_settles(self):
+    """A move while an update is unfinished settles it first"""
+    loc = self.localizer(1e-9)
+    loc.update(self.measured)
+    self.assertIsNotNone(loc.partial)
+    loc.move(0.1, 1.0)
+    self.assertIsNone(loc.partial)
+    self.assertEqual((loc.updates, loc.cut_short), (1, 1))
+
+  def test_no_budget(self):
+    """Without a budget update() senses every particle in place, in one go"""
+    loc = self.localizer(None)
+    pose = np.array(loc.p.pose)
+    loc.update(self.measured)
+    self.assertIsNone(loc.partial)
+    self.assertEqual((loc.updates, loc.cut_short), (1, 0))
+    self.assertTrue((loc.p.pose == pose).all(), "Particles should not be shuffled")
+    readings = sensors.sense_all(std_sensors.offset_str, loc.p.x, loc.p.y, loc.p.theta, self.map)
+    expected = sum(sensor.log_likelihood(readings[name], self.measured[name]) for name,sensor in std_sensors.offset_str.items())
+    self.assertTrue(np.allclose(loc.log_lik, expected, atol=1e-4))
+
+class TestSnapshot(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, "test.snapshot")
+    self.map = map.Map(path_to_map, 3.0, logger=logger)
+    np.random.seed(6)
+    self.loc = particles.ParticleLocalizer(std_sensors.offset_str, std_noise.noise_params, self.map, 50, Pose(30.0, 40.0, 0.3),
+                                           logger=logger)
+    self.loc.weight[:] = np.random.random_sample(50)
+    self.loc.weight /= self.loc.weight.sum()
+    self.writer = snapshot.Snapshot(self.path, capacity=64, rate=None)
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_round_trip(self):
+    """A reader gets back the cloud, weights and guess the writer published"""
+    reader = snapshot.Snapshot(self.path, readonly=True)
+    self.assertIsNone(reader.read(), "Nothing is published yet")
+    guess = self.loc.guess()
+    self.assertTrue(self.writer.publish(self.loc, guess))
+    snap = reader.read()
+    self.assertEqual(snap["seq"], 1)
+    for name in "x", "y", "theta":
+      self.assertTrue(np.allclose(snap[name], getattr(self.loc.p, name)))
+    self.assertTrue(np.allclose(snap["weight"], self.loc.weight))
+    self.assertEqual((snap["guess"].x, snap["guess"].y, snap["guess"].theta), (guess.x, guess.y, guess.theta))
+    self.assertAlmostEqual(snap["cov"][0, 0], np.cov(self.loc.p.x, aweights=self.loc.weight, bias=True), 3)
+    self.writer.publish(self.loc, guess)
+    self.assertEqual(reader.read()["seq"], 2)
+
+  def test_rate_limit(self):
+    writer = snapshot.Snapshot(self.path, capacity=64, rate=0.001)
+    guess = self.loc.guess()
+    self.assertTrue(writer.publish(self.loc, guess))
+    self.assertFalse(writer.publish(self.loc, guess))
+    self.assertTrue(writer.publish(self.loc, guess, force=True))
+
+  def test_retries_odd(self):
+    """A reader that finds a write in progress waits for it, and gives up if it never ends"""
+    reader = snapshot.Snapshot(self.path, readonly=True)
+    self.writer.publish(self.loc, self.loc.guess())
+    header = self.writer.header
+    header[snapshot.SEQ] += 1
+    self.assertIsNone(reader.read(tries=5))
+    sleep = snapshot.time.sleep
+    def finish(seconds):
+      header[snapshot.SEQ] += 1 # the writer gets to run
+    snapshot.time.sleep = finish
+    try:
+      snap = reader.read()
+    finally:
+      snapshot.time.sleep = sleep
+    self.assertEqual(snap["seq"], 2)
+
+  def test_retries_changed(self):
+    """A reader whose copy overlapped a write throws it away and copies again"""
+    reader = snapshot.Snapshot(self.path, readonly=True)
+    self.writer.publish(self.loc, self.loc.guess())
+    writer, rows = self.writer, reader.rows
+    copies = []
+    class Racing(object):
+      def __getitem__(self, key):
+        copies.append(key)
+        if len(copies) == 1:
+          writer.header[snapshot.SEQ] += 2 # a whole publish slips in mid copy
+        return rows[key]
+    reader.rows = Racing()
+    snap = reader.read()
+    self.assertEqual(len(copies), 2)
+    self.assertEqual(snap["seq"], 2)
+
+if __name__ == "__main__":
+  unittest.main() # Execute all tests
@@ -9,6 +9,7 @@ class MapClass:
 		self.scale = res
 		# make a numpy 2D array
 		self.grid = np.zeros(mapSize, dtype = [('desc', np.uint8),('status', '|S1'),('color', '|S1'),('level', '|S1'),('path', '|S1')])
+		self.dirty = []		#areas changed by fillCoords, see takeDirty
 
 	def ydim(self): 	#return the y dimension of grid (number of rows)
 		return(len(self.grid))
@@ -32,11 +33,22 @@ class MapClass:
 		#calc range of x to fill over
 		if x1 <= x2: x_range = (x1, x2+1)
 		else: x_range = (x2, x1+1)
-		#now fill
-		for y in xrange(y_range[0],y_range[1]):	
-			for x in xrange(x_range[0],x_range[1]):
-				for key in prop:
-					self.grid[y][x][key] = prop[key]
+		#now fill, remembering the area as dirty if anything actually changed
+		area = self.grid[y_range[0]:y_range[1], x_range[0]:x_range[1]]
+		changed = False
+		for key in prop:
+			if (area[key] != prop[key]).any():
+				area[key] = prop[key]
+				changed = True
+		if changed:
+			if not hasattr(self, 'dirty'):	#maps pickled before dirty tracking existed
+				self.dirty = []
+			self.dirty.append((x_range[0], y_range[0], x_range[1], y_range[1]))
+
+	def takeDirty(self):	#return the list of (x1, y1, x2, y2) areas changed by fillCoords since the last call (x2, y2 exclusive) and reset it
+		dirty = getattr(self, 'dirty', [])
+		self.dirty = []
+		return dirty
 
 	def fillLoc(self, waypoints, key, prop):	#fill a location in a layer with a value (both given by prop dict).  The location to be filled is identified by key (key comes from waypoints['key'], i.e. key could be "L01")
                 x = waypoints[key][0][0]	# get x and y coords of location
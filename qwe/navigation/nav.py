@@ -12,7 +12,7 @@ continues with the current plan."""
 import logging.config
 from collections import namedtuple
 from subprocess import call
-from os import chdir, getcwd
+from os import getcwd
 from sys import exit
 from math import sqrt, degrees, radians
 from datetime import datetime
@@ -20,18 +20,16 @@ import pprint as pp
 from time import sleep
 import numpy as np
 
+import sbpl_server
+import plan_cache
+from nav_errors import errors
+
 # Movement objects for issuing macro or micro movement commands to nav. Populate and pass to qMove_nav queue.
 macro_move = namedtuple("macro_move", ["x", "y", "theta", "timestamp"])
 micro_move_XY = namedtuple("micro_move_XY", ["distance", "speed", "timestamp"])
 micro_move_theta = namedtuple("micro_move_theta", ["angle", "timestamp"])
 micro_move_XYTheta = namedtuple("micro_move_XYTheta", ["distance", "speed", "angle", "timestamp"])
 
-# Dict of error codes and their human-readable names
-errors = { 100 : "ERROR_BAD_CWD",  101 : "ERROR_SBPL_BUILD", 102 : "ERROR_SBPL_RUN", 103 : "ERROR_BUILD_ENV", 
-  104 : "ERROR_BAD_RESOLUTION", 105 : "WARNING_SHORT_SOL", 106 : "ERROR_ARCS_DISALLOWED", 107 : "ERROR_DYNAMIC_DEM_UNKN", 108 :
-  "ERROR_NO_CHANGE", 109 : "ERROR_FAILED_MOVE", 110 : "NO_SOL", 111 : "UNKNOWN_ERROR", 112 : "ERROR_SENSORS", 113 : "BAD_INPUT" }
-errors.update(dict((v,k) for k,v in errors.iteritems())) # Converts errors to a two-way dict
-
 # TODO These need to be calibrated
 env_config = { "obsthresh" : "1", "cost_ins" : "1", "cost_cir" : "0", "cellsize" : "0.00635", "nominalvel" : "1000.0", 
   "timetoturn45" : "2" }
@@ -39,7 +37,8 @@ env_config = { "obsthresh" : "1", "cost_ins" : "1", "cost_cir" : "0", "cellsize"
 config = { "steps_between_locs" : 5, "XYErr" : (float(env_config["cellsize"]) * 7), "thetaErr" : (0.39269908169 * 1.01),
 "loc_wait" : .01, "default_left_US" : 100, "default_right_US" : 100, "default_front_US" : 100, "default_back_US" : 100, 
 "default_accel_x" : 0, "default_accel_y" : 0, "default_accel_z" : 980, "default_heading" : 0, "XY_mv_len" : .15,
-"max_sensor_tries" : 10, "SBPL_retries" : 10, "SBPL_recover_offset" : .03, "map_height_in" : 73, "map_width_in" : 97 }
+"max_sensor_tries" : 10, "SBPL_retries" : 10, "SBPL_recover_offset" : .03, "map_height_in" : 73, "map_width_in" : 97,
+"plan_cache_size" : 32 }
 
 class Nav:
 
@@ -67,6 +66,9 @@ class Nav:
     self.testQueue = testQueue
     self.logger.debug("Passed-in data stored to Nav object")
 
+    # Solutions already found, reused when the same trip comes up again or the bot is still on one
+    self.plan_cache = plan_cache.PlanCache(config["plan_cache_size"])
+
   def start(self, doLoop=True):
     """Setup nav here. Finds path from cwd to qwe directory and then sets up paths from cwd to required files. Opens a file
     descriptor for /dev/null that can be used to suppress output. Compiles SBPL using a bash script. Unless doLoop param is True,
@@ -91,16 +93,11 @@ class Nav:
       return errors["ERROR_BAD_CWD"]
 
     # Setup paths to required files
-    self.build_env_script = path_to_qwe + "../scripts/build_env_file.sh"
     self.build_sbpl_script = path_to_qwe + "navigation/build_sbpl.sh"
     self.sbpl_executable = path_to_qwe + "navigation/sbpl/cmake_build/bin/test_sbpl"
-    self.sbpl_exec_from_sol_dir = "../sbpl/cmake_build/bin/test_sbpl"
     self.env_file = path_to_qwe + "navigation/envs/env.cfg"
-    self.env_file_from_sol_dir = "../envs/env.cfg"
     self.mprim_file = path_to_qwe + "navigation/mprim/prim_tip_priority_4inch_step3"
-    self.mprim_file_from_sol_dir = "../mprim/prim_tip_priority_4inch_step3"
     self.map_file = path_to_qwe + "navigation/maps/binary_map.txt"
-    self.sol_file = path_to_qwe + "navigation/sols/sol.txt"
     self.sol_dir = path_to_qwe + "navigation/sols"
     self.sbpl_build_dir = path_to_qwe + "navigation/sbpl/cmake_build"
     self.script_dir = path_to_qwe + "../scripts"
@@ -115,6 +112,10 @@ class Nav:
       self.logger.critical("Failed to build SBPL. Script return value was: " + str(build_rv))
       return errors["ERROR_SBPL_BUILD"]
 
+    # SBPL process that keeps the map and mprims loaded between plans, started by the first genSol
+    self.planner = sbpl_server.PlannerServer(self.sbpl_executable, self.env_file, self.map_file, self.mprim_file, self.sol_dir,
+                                             self.logger)
+
     if doLoop: # Call main loop that will handle movement commands passed in via qMove_nav
       self.logger.debug("Calling main loop function")
       self.loop()
@@ -125,8 +126,9 @@ class Nav:
     """Use SBPL to generate a series of steps, within some set of acceptable motion primitives, that move the robot from the
     current location to the goal pose
 
-    Eventually the SBPL code will be modified such that it can be called directly from here and params can be passed in-memory, to
-    avoid file IP and spawning new processes.
+    SBPL runs as a long-lived process (see sbpl_server) that loads the map and motion primitives once, so each call only costs the
+    search itself. Solutions are cached (see plan_cache), and a cached one that starts at or passes through the current pose is
+    used instead of planning again. Steps are returned as a list of records with the same fields as the old sol.txt lines.
 
     :param goal_x: X coordinate of goal pose
     :param goal_y: Y coordinate of goal pose
@@ -135,63 +137,32 @@ class Nav:
 
     self.logger.debug("Generating plan")
 
+    # Check for a cached solution first. The map version is the zone change counter planner bumps as zones fill.
+    start = (self.XYFrombot_locUC(self.bot_loc["x"]), self.XYFrombot_locUC(self.bot_loc["y"]), \
+             self.thetaFrombot_locUC(self.bot_loc["theta"]))
+    goal = (goal_x, goal_y, goal_theta)
+    map_version = self.bot_state.get("zone_change", 0)
+    sol = self.plan_cache.get(start, goal, env_config, map_version, config["XYErr"], config["thetaErr"])
+    self.bot_state["plan_cache"] = self.plan_cache.stats()
+    if sol is not None:
+      self.logger.info("Using cached solution with {} steps, cache stats {}".format(len(sol), self.plan_cache.stats()))
+      return list(sol)
+
     for i in range(config["SBPL_retries"]):
       # Translate bot_loc into internal units
       curX = self.XYFrombot_locUC(self.bot_loc["x"])
       curY = self.XYFrombot_locUC(self.bot_loc["y"])
       curTheta = self.thetaFrombot_locUC(self.bot_loc["theta"])
 
-      # Build environment file for input into SBPL
-      # TODO Upgrade this to call SBPL directly, as described above
       self.logger.debug("env_config: {}".format(str(env_config)))
       self.logger.debug("Current pose: {} {} {}".format(curX, curY, curTheta))
       self.logger.debug("Goal pose: {} {} {}".format(goal_x, goal_y, goal_theta))
-      self.logger.debug("Map file: " + str(self.map_file))
-      self.logger.debug("Environment file to write: " + str(self.env_file))
-      self.logger.debug("Environment script to use {}".format(self.build_env_script))
-      self.logger.debug("CWD: {}".format(getcwd()))
-
-      build_env_rv = call([self.build_env_script, env_config["obsthresh"],
-                                                  env_config["cost_ins"],
-                                                  env_config["cost_cir"],
-                                                  env_config["cellsize"],
-                                                  env_config["nominalvel"],
-                                                  env_config["timetoturn45"],
-                                                  str(curX),
-                                                  str(curY),
-                                                  str(curTheta),
-                                                  str(goal_x),
-                                                  str(goal_y),
-                                                  str(goal_theta),
-                                                  str(self.env_file),
-                                                  str(self.map_file)],
-                                                  cwd=str(getcwd()))
-
-      # Check results of build_env_script call
-      if build_env_rv != 0:
-        self.logger.critical("Failed to build env file. Script return value was: " + str(build_env_rv))
-        return errors["ERROR_BUILD_ENV"]
-      self.logger.info("Successfully built env file. Return value was: " + str(build_env_rv))
 
       # Run SBPL
-      origCWD = getcwd()
-      self.logger.debug("Changing dir from {}".format(origCWD))
-      chdir(self.sol_dir)
-      self.logger.debug("Running SBPL CWD {}".format(getcwd()))
-      self.logger.debug("Running SBPL with executable {}".format(self.sbpl_exec_from_sol_dir))
-      self.logger.debug("Running SBPL with env_file {}".format(self.env_file_from_sol_dir))
-      self.logger.debug("Running SBPL with mprim_file {}".format(self.mprim_file_from_sol_dir))
-      sbpl_rv = call([self.sbpl_exec_from_sol_dir, self.env_file_from_sol_dir, self.mprim_file_from_sol_dir])
-      chdir(origCWD)
+      sol = self.planner.plan((curX, curY, curTheta), (goal_x, goal_y, goal_theta), env_config)
 
       # Check results of SBPL run
-      if sbpl_rv == -6:
-        self.logger.critical("Failed to run SBPL. SBPL return value was: " + str(sbpl_rv))
-        return errors["ERROR_BAD_RESOLUTION"]
-      if sbpl_rv < 0:
-        self.logger.critical("Failed to run SBPL. SBPL return value was: " + str(sbpl_rv))
-        return errors["ERROR_SBPL_RUN"]
-      if sbpl_rv == 1:
+      if sol is errors["NO_SOL"]:
         # No solution found
         # Attempt to recover by offsetting bot_loc, hopefully avoiding pathological cases
         self.logger.info("Attempting to recover from SBPL failure, changing goal pose ({} {} {}) by {}".format(goal_x, goal_y, \
@@ -200,31 +171,23 @@ class Nav:
         goal_y += config["SBPL_recover_offset"]
         self.logger.info("New goal pose is ({} {} {})".format(goal_x, goal_y, goal_theta))
         continue
-
+      elif not isinstance(sol, np.ndarray):
+        self.logger.critical("Failed to run SBPL: " + errors[sol])
+        return sol
       else:
-        self.logger.info("Successfully ran SBPL. Return value was: " + str(sbpl_rv))
+        self.logger.info("Successfully ran SBPL, solution has {} steps".format(len(sol)))
         break
 
-    if sbpl_rv == 1:
+    if sol is errors["NO_SOL"]:
       # No solution found
       self.logger.warning("SBPL failed to find a solution after {} attempts".format(config["SBPL_retries"]))
       return errors["NO_SOL"]
 
-    # Read solution file into memory and return it
-    sol = []
-    sol_lables = ["x", "y", "theta", "cont_x", "cont_y", "cont_theta"]
-    for line in open(self.sol_file, "r").readlines():
-      self.logger.debug("Read sol step: " + str(line).rstrip("\n"))
-      sol.append(dict(zip(sol_lables, line.split())))
-    #self.logger.debug("Built sol list of dicts: " + str(sol))
-
-    # Convert all values to floats
     for step in sol:
-      for key in step:
-        step[key] = float(step[key])
+      self.logger.debug("Sol step: " + str(step))
+    self.plan_cache.put(start, goal, env_config, map_version, sol)
+    return list(sol)
 
-    return sol
-      
   def loop(self):
     """Main loop of nav. Blocks and waits for motion commands passed in on qMove_nav"""
 
@@ -254,6 +217,7 @@ class Nav:
       elif type(move_cmd) == str and move_cmd == "die":
         self.logger.warning("Received die command, nav is exiting.")
         self.bot_state["naving"] = False
+        self.planner.stop()
 
         if self.testQueue is not None:
           self.testQueue.put("die")
@@ -0,0 +1,7 @@
+"""Error codes shared by nav and the modules it imports, so they don't have to import nav back."""
+
+# Dict of error codes and their human-readable names
+errors = { 100 : "ERROR_BAD_CWD",  101 : "ERROR_SBPL_BUILD", 102 : "ERROR_SBPL_RUN", 103 : "ERROR_BUILD_ENV", 
+  104 : "ERROR_BAD_RESOLUTION", 105 : "WARNING_SHORT_SOL", 106 : "ERROR_ARCS_DISALLOWED", 107 : "ERROR_DYNAMIC_DEM_UNKN", 108 :
+  "ERROR_NO_CHANGE", 109 : "ERROR_FAILED_MOVE", 110 : "NO_SOL", 111 : "UNKNOWN_ERROR", 112 : "ERROR_SENSORS", 113 : "BAD_INPUT" }
+errors.update(dict((v,k) for k,v in errors.iteritems())) # Converts errors to a two-way dict
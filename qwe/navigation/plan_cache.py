@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""LRU cache of SBPL solutions for nav.
+
+Solutions are keyed on their start and goal poses, discretized the way SBPL discretizes them, plus the env_config they were planned
+with and a map version counter. An exact hit is therefore the plan SBPL would have returned. Without an exact hit, a cached plan to
+the same goal that passes within tolerance of the current pose is reused from that step on, the way nav would have carried on
+following it."""
+
+from collections import OrderedDict
+from math import pi, floor
+import numpy as np
+
+class PlanCache:
+
+  def __init__(self, size, num_thetas=16):
+    """Setup plan cache
+
+    :param size: Most solutions to keep, least recently used ones are evicted first
+    :param num_thetas: Number of headings SBPL discretizes theta into (must match the mprims)"""
+    self.size = size
+    self.num_thetas = num_thetas
+    self.plans = OrderedDict() # Keys in order of use, least recent first
+    self.hits = 0
+    self.spliced = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def cell(self, pose, cellsize):
+    """Discretize an (x, y, theta) pose in meters and radians like SBPL's CONTXY2DISC and ContTheta2Disc"""
+    x, y, theta = pose
+    width = 2 * pi / self.num_thetas
+    return (int(floor(x / cellsize)), int(floor(y / cellsize)), int((theta % (2 * pi) + width / 2) / width) % self.num_thetas)
+
+  def key(self, start, goal, env_config, map_version):
+    cellsize = float(env_config["cellsize"])
+    return (self.cell(start, cellsize), self.cell(goal, cellsize), tuple(sorted(env_config.items())), map_version)
+
+  def get(self, start, goal, env_config, map_version, acceptXYErr, acceptThetaErr):
+    """Find a cached solution from start to goal.
+
+    :param start: (x, y, theta) current pose
+    :param goal: (x, y, theta) goal pose
+    :param env_config: Values used by SBPL in env.cfg file
+    :param map_version: Counter that changes whenever the map does
+    :param acceptXYErr: Error in XY plane accepted when splicing into a cached solution
+    :param acceptThetaErr: Error in theta dimension accepted when splicing into a cached solution
+    :returns: Structured array of solution steps, or None"""
+    key = self.key(start, goal, env_config, map_version)
+    if key in self.plans:
+      self.plans[key] = self.plans.pop(key) # Now most recently used
+      self.hits += 1
+      return self.plans[key]
+
+    # Otherwise pick up a plan to the same goal where it passes closest to start, most recently used plans first
+    x, y, theta = start
+    for other in reversed(self.plans.keys()):
+      if other[1:] != key[1:]:
+        continue
+      sol = self.plans[other]
+      near = ((abs(sol["cont_x"] - x) <= acceptXYErr) & (abs(sol["cont_y"] - y) <= acceptXYErr) &
+              (abs((sol["cont_theta"] - theta + pi) % (2 * pi) - pi) <= acceptThetaErr))
+      if near.any():
+        steps = near.nonzero()[0]
+        step = steps[np.argmin((sol["cont_x"][steps] - x) ** 2 + (sol["cont_y"][steps] - y) ** 2)]
+        self.plans[other] = self.plans.pop(other)
+        self.spliced += 1
+        return sol[step:]
+
+    self.misses += 1
+    return None
+
+  def put(self, start, goal, env_config, map_version, sol):
+    """Store a solution from start to goal, evicting the least recently used one if the cache is full"""
+    key = self.key(start, goal, env_config, map_version)
+    self.plans.pop(key, None)
+    self.plans[key] = sol
+    while len(self.plans) > self.size:
+      self.plans.popitem(last=False)
+      self.evictions += 1
+
+  def clear(self):
+    self.plans.clear()
+
+  def stats(self):
+    """Cache size and hit/miss counts, for monitoring"""
+    lookups = self.hits + self.spliced + self.misses
+    return { "plans" : len(self.plans), "hits" : self.hits, "spliced" : self.spliced, "misses" : self.misses,
+      "evictions" : self.evictions, "hit_rate" : (self.hits + self.spliced) / float(lookups) if lookups else 0.0 }
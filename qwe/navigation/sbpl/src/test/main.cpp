@@ -27,9 +27,11 @@
  * POSSIBILITY OF SUCH DAMAGE.
  */
 
+#include <cstdio>
 #include <cstring>
 #include <iostream>
 #include <string>
+#include <unistd.h>
 
 using namespace std;
 
@@ -166,7 +168,7 @@ enum MainResultType
  *******************************************************************************/
 void PrintUsage(char *argv[])
 {
-	printf("USAGE: %s [-s] [--env=<env_t>] [--planner=<planner_t>] [--search-dir=<search_t>] <cfg file> [mot prims]\n", argv[0]);
+	printf("USAGE: %s [-s] [--serve] [--env=<env_t>] [--planner=<planner_t>] [--search-dir=<search_t>] <cfg file> [mot prims]\n", argv[0]);
 	printf("See '%s -h' for help.\n", argv[0]);
 }
 
@@ -183,11 +185,14 @@ void PrintHelp(char** argv)
 	printf("Search-Based Planning Library\n");
 	printf("\n");
 	printf("    %s -h\n", argv[0]);
-	printf("    %s [-s] [--env=<env_t>] [--planner=<planner_t>] [--search-dir=<search_t>] <env cfg> [mot prim]\n", argv[0]);
+	printf("    %s [-s] [--serve] [--env=<env_t>] [--planner=<planner_t>] [--search-dir=<search_t>] <env cfg> [mot prim]\n", argv[0]);
 	printf("\n");
 	printf("[-s]                      (optional) Find a solution for an example navigation\n");
 	printf("                          scenario where the robot only identifies obstacles as\n");
 	printf("                          it approaches them.\n");
+	printf("[--serve]                 (optional) xytheta only: load the environment once,\n");
+	printf("                          then answer \"plan <start> <goal>\" lines from stdin\n");
+	printf("                          on stdout until stdin closes. See servexythetalat.\n");
 	printf("[--env=<env_t>]           (optional) Select an environment type to choose what\n");
 	printf("                          example to run. The default is \"xytheta\".\n");
 	printf("<env_t>                   One of 2d, xytheta, xythetamlev, robarm.\n");
@@ -226,6 +231,24 @@ bool CheckIsNavigating(int numOptions, char** argv)
 	return false;
 }
 
+/*******************************************************************************
+ * CheckIsServing
+ * @brief Returns whether the --serve option is being used.
+ *
+ * @param numOptions The number of options passed through the command line
+ * @param argv The command-line arguments
+ * @return whether the --serve option was passed in on the cmd line
+ *******************************************************************************/
+bool CheckIsServing(int numOptions, char** argv)
+{
+	for (int i = 1; i < numOptions + 1; i++) {
+		if (strcmp(argv[i], "--serve") == 0) {
+			return true;
+		}
+	}
+	return false;
+}
+
 /*******************************************************************************
  * CheckSearchDirection -
  * @brief Returns the search direction being used
@@ -600,6 +623,121 @@ int planxythetalat(PlannerType plannerType, char* envCfgFilename, char* motPrimF
 	return bRet;
 }
 
+/*******************************************************************************
+ * servexythetalat
+ * @brief Plans in (x,y,theta) like planxythetalat, but loads the environment
+ *        and motion primitives once and then answers any number of requests
+ *
+ * @desc Reads one request per line from stdin until it is closed or reads
+ *       "quit":
+ *           plan <start x> <start y> <start theta> <goal x> <goal y> <goal theta>
+ *       in meters and radians. Each is answered on stdout with "sol <n>" and
+ *       the n solution steps in the sol.txt format planxythetalat writes,
+ *       "nosol" if there is no solution, or "error <reason>". A "ready" line
+ *       is written once the environment is loaded. Everything else that would
+ *       be printed goes to stderr, so stdout only carries answers.
+ * @param plannerType The type of planner to be used
+ * @param envCfgFilename The environment config file, its start and end are
+ *                       only used until the first request
+ * @param motPrimFilename The motion primitives file
+ * @return 1 once stdin is done; 0 if the environment could not be loaded
+ *******************************************************************************/
+int servexythetalat(PlannerType plannerType, char* envCfgFilename, char* motPrimFilename, bool forwardSearch)
+{
+	double allocated_time_secs = 10.0; // in seconds
+	double initialEpsilon = 3.0;
+	MDPConfig MDPCfg;
+	bool bsearchuntilfirstsolution = false;
+
+	// answers go out on the real stdout, the library's chatter on stderr
+	fflush(stdout);
+	FILE* fOut = fdopen(dup(fileno(stdout)), "w");
+	dup2(fileno(stderr), fileno(stdout));
+
+	// no footprint, as in planxythetalat
+	vector<sbpl_2Dpt_t> perimeterptsV;
+
+	EnvironmentNAVXYTHETALAT environment_navxythetalat;
+	if (!environment_navxythetalat.InitializeEnv(envCfgFilename, perimeterptsV, motPrimFilename) ||
+		!environment_navxythetalat.InitializeMDPCfg(&MDPCfg))
+	{
+		fprintf(fOut, "error failed to load environment\n");
+		fclose(fOut);
+		return 0;
+	}
+	const EnvNAVXYTHETALATConfig_t* cfg = environment_navxythetalat.GetEnvNavConfig();
+
+	SBPLPlanner* planner = NULL;
+	switch (plannerType) {
+	case PLANNER_TYPE_ARASTAR:
+		planner = new ARAPlanner(&environment_navxythetalat, forwardSearch);
+		break;
+	case PLANNER_TYPE_ADSTAR:
+		planner = new ADPlanner(&environment_navxythetalat, forwardSearch);
+		break;
+	case PLANNER_TYPE_ANASTAR:
+		planner = new anaPlanner(&environment_navxythetalat, forwardSearch);
+		break;
+	default:
+		fprintf(fOut, "error planner not supported for xytheta\n");
+		fclose(fOut);
+		return 0;
+	}
+	planner->set_initialsolution_eps(initialEpsilon);
+	planner->set_search_mode(bsearchuntilfirstsolution);
+
+	fprintf(fOut, "ready\n");
+	fflush(fOut);
+
+	char line[256];
+	while (fgets(line, sizeof(line), stdin) != NULL) {
+		if (strncmp(line, "quit", 4) == 0) {
+			break;
+		}
+
+		double sx, sy, stheta, gx, gy, gtheta;
+		if (sscanf(line, "plan %lf %lf %lf %lf %lf %lf", &sx, &sy, &stheta, &gx, &gy, &gtheta) != 6) {
+			fprintf(fOut, "error bad request\n");
+			fflush(fOut);
+			continue;
+		}
+
+		int startID = environment_navxythetalat.SetStart(sx, sy, stheta);
+		int goalID = environment_navxythetalat.SetGoal(gx, gy, gtheta);
+		if (startID < 0 || goalID < 0 || planner->set_start(startID) == 0 || planner->set_goal(goalID) == 0) {
+			fprintf(fOut, "error start or goal outside of map\n");
+			fflush(fOut);
+			continue;
+		}
+
+		// same search a fresh process would do, just without the loading
+		planner->force_planning_from_scratch();
+		vector<int> solution_stateIDs_V;
+		if (!planner->replan(allocated_time_secs, &solution_stateIDs_V)) {
+			fprintf(fOut, "nosol\n");
+			fflush(fOut);
+			continue;
+		}
+
+		fprintf(fOut, "sol %d\n", (int)solution_stateIDs_V.size());
+		for (size_t i = 0; i < solution_stateIDs_V.size(); i++) {
+			int x;
+			int y;
+			int theta;
+			environment_navxythetalat.GetCoordFromState(solution_stateIDs_V[i], x, y, theta);
+
+			fprintf(fOut, "%d %d %d\t\t%.7f %.7f %.7f\n", x, y, theta, DISCXY2CONT(x, cfg->cellsize_m),
+					DISCXY2CONT(y, cfg->cellsize_m), DiscTheta2Cont(theta, cfg->NumThetaDirs));
+		}
+		fflush(fOut);
+	}
+
+	delete planner;
+	fclose(fOut);
+
+	return 1;
+}
+
 /*******************************************************************************
  * planxythetamlevlat
  * @brief An example of planning with a multiple-level (x,y,theta) lattice
@@ -1580,6 +1718,7 @@ int main(int argc, char *argv[])
 	// Check command line arguments to find environment type and whether or not to
 	// use one of the navigating examples.
 	bool navigating = CheckIsNavigating(numOptions, argv);
+	bool serving = CheckIsServing(numOptions, argv);
 	std::string environmentType = CheckEnvironmentType(numOptions, argv);
 	std::string plannerType = CheckPlannerType(numOptions, argv);
 	std::string searchDir = CheckSearchDirection(numOptions, argv);
@@ -1616,7 +1755,10 @@ int main(int argc, char *argv[])
 		plannerRes = plan2duu(planner, argv[envArgIdx]);
 		break;
 	case ENV_TYPE_XYTHETA:
-		if (navigating) {
+		if (serving) {
+			plannerRes = servexythetalat(planner, argv[envArgIdx], motPrimFilename, forwardSearch);
+		}
+		else if (navigating) {
 			plannerRes = planandnavigatexythetalat(planner, argv[envArgIdx], motPrimFilename, forwardSearch);
 		}
 		else {
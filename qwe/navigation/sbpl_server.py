@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""Long-lived SBPL planner for nav.
+
+Runs test_sbpl in its --serve mode, which loads the environment (map) and motion primitives once and then answers plan
+requests read from its stdin for as long as it runs. Each plan then costs only the search, rather than a bash script, a fresh
+process that re-parses the map and mprims, and a round trip through sols/sol.txt. Solutions come back as numpy structured arrays
+with the same fields sol.txt has."""
+
+from subprocess import Popen, PIPE
+from StringIO import StringIO
+from os.path import abspath
+import numpy as np
+
+from nav_errors import errors
+
+# One row per solution step: discrete cell and heading index, then the continuous pose (meters, radians)
+sol_dtype = np.dtype([("x", int), ("y", int), ("theta", int), ("cont_x", float), ("cont_y", float), ("cont_theta", float)])
+
+class PlannerServer:
+
+  def __init__(self, sbpl_executable, env_file, map_file, mprim_file, work_dir, logger):
+    """Setup planner server. The SBPL process isn't started until the first plan.
+
+    :param sbpl_executable: Path to test_sbpl
+    :param env_file: Path of the env.cfg to write for SBPL to load
+    :param map_file: Path to the map SBPL plans on
+    :param mprim_file: Path to the motion primitives to plan with
+    :param work_dir: Directory to run SBPL in, it leaves its debug files there
+    :param logger: Used for standard Python logging"""
+    self.sbpl_executable = abspath(sbpl_executable)
+    self.env_file = abspath(env_file)
+    self.map_file = abspath(map_file)
+    self.mprim_file = abspath(mprim_file)
+    self.work_dir = work_dir
+    self.logger = logger
+    self.proc = None
+    self.env_config = None # env_config the running process was started with
+    self.plans = 0
+
+  def start(self, start, goal, env_config):
+    """Write the environment file and start SBPL on it. Blocks until SBPL has loaded everything.
+
+    :param start: (x, y, theta) start pose written to the env file, replaced by every request
+    :param goal: (x, y, theta) goal pose written to the env file, replaced by every request
+    :param env_config: Values used by SBPL in env.cfg file"""
+    self.stop()
+
+    # Same env.cfg that scripts/build_env_file.sh writes, without the bash
+    try:
+      grid = open(self.map_file, "r").read()
+      y_len = grid.count("\n")
+      x_len = (grid.count("0") + grid.count("1")) / y_len
+      env = open(self.env_file, "w")
+      env.write("discretization(cells): {} {}\n".format(x_len, y_len))
+      env.write("obsthresh: {}\n".format(env_config["obsthresh"]))
+      env.write("cost_inscribed_thresh: {}\n".format(env_config["cost_ins"]))
+      env.write("cost_possibly_circumscribed_thresh: {}\n".format(env_config["cost_cir"]))
+      env.write("cellsize(meters): {}\n".format(env_config["cellsize"]))
+      env.write("nominalvel(mpersecs): {}\n".format(env_config["nominalvel"]))
+      env.write("timetoturn45degsinplace(secs): {}\n".format(env_config["timetoturn45"]))
+      env.write("start(meters,rads): {} {} {}\n".format(*start))
+      env.write("end(meters,rads): {} {} {}\n".format(*goal))
+      env.write("environment:\n")
+      env.write(grid)
+      env.close()
+    except (IOError, ZeroDivisionError) as e:
+      self.logger.critical("Failed to build env file: {}".format(e))
+      return errors["ERROR_BUILD_ENV"]
+    self.logger.debug("Wrote env file {} ({} x {} cells)".format(self.env_file, x_len, y_len))
+
+    # SBPL's own output goes to stderr, discard it like the old per-plan runs did
+    self.devnull = open("/dev/null", "w")
+    self.proc = Popen([self.sbpl_executable, "--serve", self.env_file, self.mprim_file], stdin=PIPE, stdout=PIPE,
+                      stderr=self.devnull, cwd=self.work_dir)
+    while True:
+      line = self.proc.stdout.readline()
+      if line == "" or line.startswith("error"):
+        return self.died("loading environment: " + line.strip())
+      if line.strip() == "ready":
+        break
+    self.env_config = dict(env_config)
+    self.logger.info("SBPL planner server started, pid {}".format(self.proc.pid))
+
+  def plan(self, start, goal, env_config):
+    """Find a solution from start to goal, starting (or restarting) SBPL first if needed.
+
+    :param start: (x, y, theta) current pose, meters and radians
+    :param goal: (x, y, theta) goal pose, meters and radians
+    :param env_config: Values used by SBPL in env.cfg file
+    :returns: Structured array of sol_dtype steps, or a nav_errors code (NO_SOL if there is no solution)"""
+    if self.proc is None or self.proc.poll() is not None or env_config != self.env_config:
+      rv = self.start(start, goal, env_config)
+      if rv is not None:
+        return rv
+
+    try:
+      self.proc.stdin.write("plan {} {} {} {} {} {}\n".format(*(tuple(start) + tuple(goal))))
+      self.proc.stdin.flush()
+      head = self.proc.stdout.readline().split()
+      if head and head[0] == "sol":
+        steps = [self.proc.stdout.readline() for i in range(int(head[1]))]
+    except IOError as e:
+      return self.died(str(e))
+    self.plans += 1
+
+    if not head:
+      return self.died("planning")
+    if head[0] == "nosol":
+      return errors["NO_SOL"]
+    if head[0] != "sol":
+      self.logger.error("SBPL rejected plan request: {}".format(" ".join(head)))
+      return errors["ERROR_SBPL_RUN"]
+    return np.loadtxt(StringIO("".join(steps)), dtype=sol_dtype, ndmin=1)
+
+  def died(self, doing):
+    """Clean up after SBPL exits or fails unexpectedly. The next plan starts it again."""
+    rv = self.proc.wait()
+    self.logger.critical("SBPL planner server failed while {} (return value {})".format(doing, rv))
+    self.stop()
+    # SBPL aborts (SIGABRT, -6) when the mprims don't match the env resolution
+    return errors["ERROR_BAD_RESOLUTION"] if rv == -6 else errors["ERROR_SBPL_RUN"]
+
+  def stop(self):
+    """Ask SBPL to exit and wait for it"""
+    if self.proc is None:
+      return
+    if self.proc.poll() is None:
+      try:
+        self.proc.stdin.write("quit\n")
+        self.proc.stdin.close()
+      except IOError:
+        pass
+    self.proc.wait()
+    self.devnull.close()
+    self.proc = None
+    self.env_config = None
@@ -7,11 +7,14 @@ import logging
 import logging.config
 from multiprocessing import Process, Manager, Queue
 import os
+import shutil
+import tempfile
 import pprint as pp
 from datetime import datetime
 from time import sleep
 from math import pi, radians, degrees, sqrt
 from random import randint
+import numpy as np
 
 # Dict of error codes and their human-readable names
 errors = {100 : "ERROR_BAD_CWD"}
@@ -36,6 +39,8 @@ sys.path.append(path_to_qwe + "mapping") # Makes map unpickle work
 # Local module imports
 import mapping.pickler as mapper
 import navigation.nav as nav
+import navigation.plan_cache as plan_cache
+import navigation.sbpl_server as sbpl_server
 import localizer.localizer as localizer
 import comm.serial_interface as comm
 
@@ -2571,5 +2576,150 @@ class TestwhichXYTheta(unittest.TestCase):
     self.assertEqual(result, nav.errors["ERROR_NO_CHANGE"], "Expected {} but received \
       {}".format(nav.errors["ERROR_NO_CHANGE"], result))
 
+# Stands in for test_sbpl --serve. The goal x of each plan request picks the answer: 1 a two step solution, 2 no solution, 3 a
+# rejected request, anything else kills the process.
+fake_sbpl = """#!{python}
+import sys
+assert sys.argv[1] == "--serve"
+print "ready"
+sys.stdout.flush()
+while True:
+  line = sys.stdin.readline()
+  if not line or line.strip() == "quit":
+    break
+  goal_x = float(line.split()[4])
+  if goal_x == 1:
+    print "sol 2"
+    print "10 20 0 0.250 0.500 0.000"
+    print "11 20 1 0.275 0.500 0.393"
+  elif goal_x == 2:
+    print "nosol"
+  elif goal_x == 3:
+    print "error bad goal"
+  else:
+    sys.exit(1)
+  sys.stdout.flush()
+"""
+
+class TestPlannerServer(unittest.TestCase):
+
+  def setUp(self):
+    """Point a planner server at a fake test_sbpl in a scratch directory"""
+    self.logger = logging.getLogger("unittest")
+    self.dir = tempfile.mkdtemp()
+    self.sbpl = os.path.join(self.dir, "test_sbpl")
+    with open(self.sbpl, "w") as f:
+      f.write(fake_sbpl.format(python=sys.executable))
+    os.chmod(self.sbpl, 0755)
+    self.map_file = os.path.join(self.dir, "map.txt")
+    with open(self.map_file, "w") as f:
+      f.write("0 0 0 0\n0 1 1 0\n0 0 0 0\n")
+    self.env_file = os.path.join(self.dir, "env.cfg")
+    self.env_config = { "obsthresh" : 1, "cost_ins" : 1, "cost_cir" : 0, "cellsize" : 0.025, "nominalvel" : 1.0,
+                        "timetoturn45" : 2.0 }
+    self.server = sbpl_server.PlannerServer(self.sbpl, self.env_file, self.map_file, os.path.join(self.dir, "mprim"), self.dir,
+                                            self.logger)
+
+  def tearDown(self):
+    self.server.stop()
+    shutil.rmtree(self.dir)
+
+  def plan(self, goal_x):
+    return self.server.plan((0.1, 0.2, 0.0), (goal_x, 0.5, 0.0), self.env_config)
+
+  def test_sol(self):
+    """A solution comes back as a structured array of steps, and the server stays up for the next plan"""
+    sol = self.plan(1)
+    self.assertEqual(sol.dtype, sbpl_server.sol_dtype)
+    self.assertEqual(len(sol), 2)
+    self.assertEqual((sol[1]["x"], sol[1]["y"], sol[1]["theta"]), (11, 20, 1))
+    self.assertAlmostEqual(sol[1]["cont_theta"], 0.393)
+    pid = self.server.proc.pid
+    self.assertEqual(len(self.plan(1)), 2)
+    self.assertEqual(self.server.proc.pid, pid, "Planning again should reuse the running server")
+    self.assertEqual(self.server.plans, 2)
+
+  def test_env_file(self):
+    """The env file describes the map's size and holds the grid itself"""
+    self.plan(1)
+    env = open(self.env_file).read()
+    self.assertIn("discretization(cells): 4 3\n", env)
+    self.assertIn("cellsize(meters): 0.025\n", env)
+    self.assertTrue(env.endswith("environment:\n" + open(self.map_file).read()))
+
+  def test_nosol(self):
+    self.assertEqual(self.plan(2), nav.errors["NO_SOL"])
+    self.assertIsNotNone(self.server.proc, "No solution isn't a reason to restart")
+
+  def test_error(self):
+    self.assertEqual(self.plan(3), nav.errors["ERROR_SBPL_RUN"])
+    self.assertEqual(len(self.plan(1)), 2)
+
+  def test_dead_child(self):
+    """A server that dies mid plan is reported, cleaned up and started again for the next plan"""
+    self.assertEqual(self.plan(4), nav.errors["ERROR_SBPL_RUN"])
+    self.assertIsNone(self.server.proc)
+    self.assertEqual(len(self.plan(1)), 2)
+
+  def test_env_config_change(self):
+    """Changing the env config restarts the server on a new env file"""
+    self.plan(1)
+    pid = self.server.proc.pid
+    self.env_config["cellsize"] = 0.05
+    self.plan(1)
+    self.assertNotEqual(self.server.proc.pid, pid)
+    self.assertIn("cellsize(meters): 0.05\n", open(self.env_file).read())
+class TestPlanCache(unittest.TestCase):
+
+  def setUp(self):
+    """Build a small cache and a fake three step solution"""
+    self.cache = plan_cache.PlanCache(2)
+    self.start = (0.30, 0.30, 0.0)
+    self.goal = (0.60, 0.30, 0.0)
+    self.sol = np.array([(47, 47, 0, 0.3016250, 0.3016250, 0.0), (52, 47, 0, 0.3333750, 0.3016250, 0.0),
+                         (94, 47, 0, 0.6000750, 0.3016250, 0.0)], dtype=sbpl_server.sol_dtype)
+
+  def test_exact_hit(self):
+    """A start in the same SBPL cell as a cached one returns the whole cached solution"""
+    self.cache.put(self.start, self.goal, nav.env_config, 0, self.sol)
+    sol = self.cache.get((0.301, 0.302, 0.01), self.goal, nav.env_config, 0, nav.config["XYErr"], nav.config["thetaErr"])
+    self.assertEqual(len(sol), 3)
+    self.assertEqual(self.cache.stats()["hits"], 1)
+
+  def test_splice(self):
+    """A start within tolerance of a later step of a cached solution to the same goal reuses it from that step"""
+    self.cache.put(self.start, self.goal, nav.env_config, 0, self.sol)
+    sol = self.cache.get((0.3335, 0.3010, 0.0), self.goal, nav.env_config, 0, nav.config["XYErr"], nav.config["thetaErr"])
+    self.assertEqual(len(sol), 2)
+    self.assertEqual(sol[0]["x"], 52)
+    self.assertEqual(self.cache.stats()["spliced"], 1)
+
+  def test_splice_wraps_theta(self):
+    """Headings either side of 0/2pi are close, so a solution near 2pi is spliced into from a start near 0"""
+    sol = self.sol.copy()
+    sol["cont_theta"] = 6.25
+    self.cache.put(self.start, self.goal, nav.env_config, 0, sol)
+    sol = self.cache.get((0.3335, 0.3010, 0.02), self.goal, nav.env_config, 0, nav.config["XYErr"], 0.1)
+    self.assertTrue(sol is not None)
+    self.assertEqual(sol[0]["x"], 52)
+    self.assertEqual(self.cache.stats()["spliced"], 1)
+
+  def test_miss_on_map_version(self):
+    """A solution planned on an older map is never reused"""
+    self.cache.put(self.start, self.goal, nav.env_config, 0, self.sol)
+    sol = self.cache.get(self.start, self.goal, nav.env_config, 1, nav.config["XYErr"], nav.config["thetaErr"])
+    self.assertTrue(sol is None)
+    self.assertEqual(self.cache.stats()["misses"], 1)
+
+  def test_lru_eviction(self):
+    """The least recently used solution is evicted once the cache is full"""
+    self.cache.put(self.start, self.goal, nav.env_config, 0, self.sol)
+    self.cache.put(self.start, (0.9, 0.3, 0.0), nav.env_config, 0, self.sol)
+    self.cache.get(self.start, self.goal, nav.env_config, 0, 0.0, 0.0)
+    self.cache.put(self.start, (1.2, 0.3, 0.0), nav.env_config, 0, self.sol)
+    self.assertTrue(self.cache.get(self.start, (0.9, 0.3, 0.0), nav.env_config, 0, 0.0, 0.0) is None)
+    self.assertTrue(self.cache.get(self.start, self.goal, nav.env_config, 0, 0.0, 0.0) is not None)
+    self.assertEqual(self.cache.stats()["evictions"], 1)
+
 if __name__ == "__main__":
   unittest.main() # Execute all tests